@@ -0,0 +1,297 @@
+"""
+Benchmarks of the IGRF calculations with baselines to catch regressions
+
+Measures the points per second and peak memory (with tracemalloc) of each
+calculation. Examples:
+
+    python benchmarks.py --save baseline.json
+    python benchmarks.py --compare baseline.json --threshold 20
+    python benchmarks.py --filter igrf_grid
+"""
+import sys
+import json
+import time
+import subprocess
+import argparse
+import datetime
+import tracemalloc
+import numpy as np
+
+import read_coef
+import coef_date
+import coef_cache
+import legendre
+import geomagnetic
+import field_lines
+import igrf
+import igrf_core
+import igrf_fast
+import igrf_point
+import igrf_table
+import inversion
+
+
+DATE = datetime.datetime(2023, 3, 1)
+
+
+def benchmark(function, n_points, repeat=3):
+    """
+    Time a function (best of *repeat* runs) and measure its peak memory
+
+    The function is run once before timing to fill any caches.
+    """
+    function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    seconds = min(times)
+    return {
+        "points": n_points,
+        "seconds": seconds,
+        "points_per_second": n_points / seconds,
+        "peak_memory_mb": peak / 1e6,
+    }
+
+
+def synthetic_coefs(n_max):
+    """
+    Coefficient arrays of degree n_max with IGRF-like decay for benchmarks
+    """
+    rng = np.random.default_rng(n_max)
+    degree = np.arange(n_max + 1)[:, np.newaxis]
+    scale = np.where(degree > 0, 3e4 / np.maximum(degree, 1)**2, 0)
+    mask = np.tri(n_max + 1, dtype=bool)
+    g = np.where(mask, rng.normal(size=(n_max + 1, n_max + 1)) * scale, 0)
+    h = np.where(mask, rng.normal(size=(n_max + 1, n_max + 1)) * scale, 0)
+    h[:, 0] = 0
+    return g, h
+
+
+def import_module_in_subprocess(module):
+    """
+    Start a new Python process that only imports the module
+    """
+    subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+
+
+def benchmark_cases():
+    """
+    Dict of benchmark name -> (number of points, function to time)
+    """
+    model = read_coef.read_gauss_model("igrf13coeffs.txt")
+    g_all, h_all, g_sv, h_sv, years = model.as_dicts()
+    rng = np.random.default_rng(0)
+    longitude = rng.uniform(0, 360, 100_000)
+    latitude = rng.uniform(-89, 89, 100_000)
+    x = np.cos(np.radians(90 - latitude[:10_000]))
+    dates = np.arange("1900-01", "2025-01", dtype="datetime64[M]")
+
+    cases = {
+        "read_gauss_coeffs": (195, lambda: read_coef.read_gauss_coeffs("igrf13coeffs.txt")),
+        "read_gauss_model": (195, lambda: read_coef.read_gauss_model("igrf13coeffs.txt")),
+        "legendre.associated_legendre_functions[point]": (
+            1, lambda: legendre.associated_legendre_functions(0.5, 13),
+        ),
+        "coef_date": (1, lambda: coef_date.coef_date(DATE, g_all, h_all, g_sv, h_sv, years)),
+        "coef_dates[1500]": (dates.size, lambda: coef_date.coef_dates(dates, model)),
+        "igrf.igrf": (1, lambda: igrf.igrf(45, 45, 0, DATE)),
+        "igrf_fast.igrf": (1, lambda: igrf_fast.igrf(45, 45, 0, DATE)),
+        "igrf_fast.igrf[uncached]": (
+            1, lambda: (coef_cache.clear_cache(), igrf_fast.igrf(45, 45, 0, DATE)),
+        ),
+    }
+    # Latency of single points against igrf_fast.igrf
+    for backend in ["python"] + [b for b in igrf_core.available_backends() if b == "numba"]:
+        evaluator = igrf_point.PointEvaluator(DATE, backend=backend)
+        cases[f"igrf_point.PointEvaluator[{backend}]"] = (
+            1, lambda evaluator=evaluator: evaluator(45, 45, 0),
+        )
+    for backend in igrf_core.available_backends():
+        cases[f"igrf_core.igrf_batch[100000,{backend}]"] = (
+            longitude.size, lambda backend=backend: igrf_core.igrf_batch(
+                longitude, latitude, 0, DATE, backend=backend,
+            ),
+        )
+    cases["igrf_core.igrf_batch[100000,gradient]"] = (
+        longitude.size, lambda: igrf_core.igrf_batch(longitude, latitude, 0, DATE, gradient=True),
+    )
+    times = DATE + rng.uniform(-1000, 1000, longitude.size) * datetime.timedelta(days=1)
+    cases["igrf_core.igrf_track[100000]"] = (
+        longitude.size, lambda: igrf_core.igrf_track(longitude, latitude, 0, times),
+    )
+    cases["geomagnetic.magnetic_local_time[100000]"] = (
+        longitude.size, lambda: geomagnetic.magnetic_local_time(longitude, latitude, times),
+    )
+    cases["inversion.NormalEquations.add[100000,n_max=13]"] = (
+        longitude.size, lambda: inversion.NormalEquations(13).add(longitude, latitude, 0, 1.0, 2.0, 3.0),
+    )
+    cases["field_lines.footprints[1000]"] = (
+        1000, lambda: field_lines.footprints(longitude[:1000], latitude[:1000], 400e3, DATE),
+    )
+    table = igrf_table.build_table(DATE, heights=(0, 10e3), tolerance=1)
+    for backend in igrf_core.available_backends():
+        cases[f"igrf_table.LookupTable.interpolate[100000,{backend}]"] = (
+            longitude.size, lambda backend=backend: table.interpolate(
+                longitude, latitude, 5e3, backend=backend,
+            ),
+        )
+    # Startup cost of a fresh process that imports each module
+    for module in ["igrf_core", "igrf_fast"]:
+        cases[f"import {module}"] = (1, lambda module=module: import_module_in_subprocess(module))
+    for n_max in [13, 100, 500]:
+        cases[f"legendre.schmidt_legendre[n_max={n_max}]"] = (
+            x.size * 100 // n_max**2, lambda n_max=n_max: legendre.schmidt_legendre(
+                x[: x.size * 100 // n_max**2], n_max,
+            ),
+        )
+    for spacing in [3, 1, 0.25]:
+        n_points = int(360 / spacing + 1) * int(180 / spacing + 1)
+        cases[f"igrf_fast.igrf_grid[spacing={spacing}]"] = (
+            n_points, lambda spacing=spacing: igrf_fast.igrf_grid(
+                (0, 360, -90, 90), spacing=spacing, height=1000, date=DATE,
+            ),
+        )
+    n_points = int(360 / 0.25 + 1) * int(180 / 0.25 + 1)
+    cases["igrf_fast.igrf_grid[spacing=0.25,float32]"] = (
+        n_points, lambda: igrf_fast.igrf_grid(
+            (0, 360, -90, 90), spacing=0.25, height=1000, date=DATE, precision="float32",
+        ),
+    )
+    months = [DATE - datetime.timedelta(days=30 * i) for i in range(120)]
+    cases["igrf_fast.igrf_grid_stack[spacing=1,dates=120]"] = (
+        120 * 361 * 181, lambda: igrf_fast.igrf_grid_stack(
+            (0, 360, -90, 90), spacing=1, height=1000, dates=months,
+        ),
+    )
+    grid_longitude = np.arange(0, 360.1, 1.0)
+    grid_latitude = np.arange(-89.5, 90, 1.0)
+    for n_max in [13, 60, 200]:
+        g, h = synthetic_coefs(n_max)
+        cases[f"igrf_fast._igrf_grid_internal[spacing=1,n_max={n_max}]"] = (
+            grid_longitude.size * grid_latitude.size,
+            lambda g=g, h=h: igrf_fast._igrf_grid_internal(
+                grid_longitude, grid_latitude, 1000, g, h,
+            ),
+        )
+    return cases
+
+
+def run(pattern=None, repeat=3):
+    """
+    Run the benchmarks whose names contain *pattern* (all if None)
+    """
+    results = {}
+    for name, (n_points, function) in benchmark_cases().items():
+        if pattern is None or pattern in name:
+            results[name] = benchmark(function, n_points, repeat)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    List the benchmarks that regressed by more than *threshold* percent
+
+    A regression is a drop in points per second or a rise in peak memory.
+    Benchmarks missing from the baseline are ignored.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        reference = baseline[name]
+        speed_change = 100 * (result["points_per_second"] / reference["points_per_second"] - 1)
+        if speed_change < -threshold:
+            regressions.append(f"{name}: {-speed_change:.1f}% fewer points per second")
+        memory_change = 100 * (
+            result["peak_memory_mb"] / max(reference["peak_memory_mb"], 1e-6) - 1
+        )
+        # Ignore changes in tiny amounts of memory which are mostly noise
+        if memory_change > threshold and result["peak_memory_mb"] > 1:
+            regressions.append(f"{name}: {memory_change:.1f}% more peak memory")
+    return regressions
+
+
+def main(argv=None):
+    """
+    Run the benchmarks from the command line
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the IGRF calculations.")
+    parser.add_argument("--save", help="Save the results as a JSON baseline to this file.")
+    parser.add_argument("--compare", help="JSON baseline to compare the results against.")
+    parser.add_argument(
+        "--threshold", type=float, default=20,
+        help="Percentage of regression that makes the comparison fail (default: 20).",
+    )
+    parser.add_argument("--filter", help="Only run benchmarks with this in their names.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark.")
+    args = parser.parse_args(argv)
+
+    results = run(args.filter, args.repeat)
+    for name, result in results.items():
+        print(
+            f"{name:60s} {result['points_per_second']:14.1f} points/s "
+            f"{result['peak_memory_mb']:10.2f} MB"
+        )
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+def test_benchmark():
+    "Check the measurements of a single benchmark"
+    result = benchmark(lambda: np.ones(1_000_000), n_points=10, repeat=2)
+    assert result["points"] == 10
+    assert result["points_per_second"] == 10 / result["seconds"]
+    assert 7 < result["peak_memory_mb"] < 9
+
+
+def test_compare():
+    "Check that only regressions beyond the threshold are reported"
+    baseline = {
+        "a": {"points_per_second": 100, "peak_memory_mb": 10},
+        "b": {"points_per_second": 100, "peak_memory_mb": 10},
+    }
+    results = {
+        "a": {"points_per_second": 85, "peak_memory_mb": 11.5},
+        "b": {"points_per_second": 70, "peak_memory_mb": 13},
+        "c": {"points_per_second": 1, "peak_memory_mb": 100},
+    }
+    regressions = compare(results, baseline, threshold=20)
+    assert len(regressions) == 2
+    assert all(regression.startswith("b:") for regression in regressions)
+    assert compare(results, baseline, threshold=40) == []
+
+
+def test_main_save_and_compare(tmp_path, capsys):
+    "Check saving a baseline and comparing against it"
+    path = tmp_path / "baseline.json"
+    assert main(["--filter", "coef_dates", "--repeat", "1", "--save", str(path)]) == 0
+    with open(path) as baseline_file:
+        baseline = json.load(baseline_file)
+    assert list(baseline) == ["coef_dates[1500]"]
+    baseline["coef_dates[1500]"]["points_per_second"] *= 1000
+    with open(path, "w") as baseline_file:
+        json.dump(baseline, baseline_file)
+    assert main(["--filter", "coef_dates", "--repeat", "1", "--compare", str(path)]) == 1
+    assert "REGRESSION coef_dates[1500]" in capsys.readouterr().err
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,267 @@
+"""
+Cache the coefficient files and the coefficients interpolated for each date
+so that they are only calculated once per process
+"""
+import os
+import types
+import shutil
+import threading
+import collections
+import datetime
+import numpy as np
+import read_coef
+import coef_date
+import instrument
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+class _ModelEntry:
+    """
+    A model read from a file and its nested dict version, built on first use
+
+    Most callers only use the packed arrays of the model, so the dicts
+    (slow to build at high degree) are only made when a date is interpolated
+    by CoefficientCache.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._dicts = None
+        self._lock = threading.Lock()
+
+    def dicts(self):
+        """
+        Return g, h, g_sv, h_sv, years as nested dicts
+        """
+        with self._lock:
+            if self._dicts is None:
+                self._dicts = self.model.as_dicts()
+            return self._dicts
+
+
+def _load(path):
+    """
+    Get the key (path and modification time) and the cached entry of a file
+    """
+    path = os.path.abspath(path)
+    try:
+        key = (path, os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        raise IOError(f"Gauss coefficient file '{path}' not found.") from None
+    with _models_lock:
+        if key not in _models:
+            for old_key in [k for k in _models if k[0] == path]:
+                del _models[old_key]
+            with instrument.stage("coefficient load"):
+                _models[key] = _ModelEntry(read_coef.read_gauss_model(path))
+        return key, _models[key]
+
+
+def load_model(path="igrf13coeffs.txt"):
+    """
+    Read a coefficient file only once (or again if it was modified)
+
+    Returns the GaussCoefficients model.
+    """
+    return _load(path)[1].model
+
+
+def _read_only(coefs):
+    """
+    Wrap the nested g and h dicts in read-only mappings
+    """
+    return tuple(
+        types.MappingProxyType({n: types.MappingProxyType(row) for n, row in coef.items()})
+        for coef in coefs
+    )
+
+
+class CoefficientCache:
+    """
+    Least recently used cache of the coefficients interpolated for each date
+
+    Keeps at most *maxsize* dates and counts hits, misses, and evictions.
+    The coefficients are shared by all callers so they are returned as
+    read-only mappings. A lock makes the cache safe to use from threads.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, date, path="igrf13coeffs.txt"):
+        """
+        Get the g and h for the date as read-only mappings indexed by [n][m]
+        """
+        model_key, entry = _load(path)
+        key = model_key + (date,)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+            with instrument.stage("date interpolation"):
+                coefs = _read_only(coef_date.coef_date(date, *entry.dicts()))
+            self._entries[key] = coefs
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return coefs
+
+    def info(self):
+        """
+        Return the cache statistics as a dict
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
+
+    def clear(self):
+        """
+        Remove all dates from the cache and reset the statistics
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+_cache = CoefficientCache()
+
+
+def coefficients(date, path="igrf13coeffs.txt"):
+    """
+    Get the g and h coefficients for a date using the process-wide cache
+    """
+    return _cache.get(date, path)
+
+
+def cache_info():
+    """
+    Statistics of the process-wide date cache
+    """
+    return _cache.info()
+
+
+def clear_cache():
+    """
+    Empty the process-wide model and date caches
+    """
+    with _models_lock:
+        _models.clear()
+    _cache.clear()
+
+
+def test_model_read_once():
+    "Check that the model is only read once and reused"
+    clear_cache()
+    first = load_model("igrf13coeffs.txt")
+    assert load_model("igrf13coeffs.txt") is first
+    assert len(_models) == 1
+
+
+def test_dicts_built_on_first_use(monkeypatch):
+    "Check that the dicts are only made for date interpolation and one stat per call"
+    clear_cache()
+    load_model()
+    (entry,) = _models.values()
+    assert entry._dicts is None
+    stats = []
+    stat = os.stat
+
+    def counted_stat(*args, **kwargs):
+        stats.append(args)
+        return stat(*args, **kwargs)
+
+    monkeypatch.setattr(os, "stat", counted_stat)
+    coefficients(datetime.datetime(2020, 1, 1))
+    assert entry._dicts is not None
+    assert len(stats) == 1
+    stats.clear()
+    coefficients(datetime.datetime(2020, 1, 1))
+    assert len(stats) == 1
+    assert cache_info()["hits"] == 1
+
+
+def test_model_reread_when_modified(tmp_path):
+    "Check that a modified file is read again"
+    path = tmp_path / "coefs.txt"
+    shutil.copy("igrf13coeffs.txt", path)
+    first = load_model(path)
+    assert load_model(path) is first
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    second = load_model(path)
+    assert second is not first
+    assert len([key for key in _models if key[0] == str(path)]) == 1
+
+
+def test_date_cache_hits_and_misses():
+    "Check the counters and that cached results match coef_date"
+    cache = CoefficientCache(maxsize=2)
+    date = datetime.datetime(2021, 6, 1)
+    g, h = cache.get(date)
+    assert cache.info() == {"hits": 0, "misses": 1, "evictions": 0, "size": 1, "maxsize": 2}
+    assert cache.get(date) == (g, h)
+    assert cache.info()["hits"] == 1
+    g_all, h_all, g_sv, h_sv, years = read_coef.read_gauss_coeffs("igrf13coeffs.txt")
+    g_date, h_date = coef_date.coef_date(date, g_all, h_all, g_sv, h_sv, years)
+    for n in g_date:
+        for m in g_date[n]:
+            np.testing.assert_allclose(g[n][m], g_date[n][m])
+        for m in h_date[n]:
+            np.testing.assert_allclose(h[n][m], h_date[n][m])
+
+
+def test_date_cache_eviction():
+    "Check that the least recently used date is evicted"
+    cache = CoefficientCache(maxsize=2)
+    dates = [datetime.datetime(2000 + i, 1, 1) for i in range(3)]
+    cache.get(dates[0])
+    cache.get(dates[1])
+    cache.get(dates[0])
+    cache.get(dates[2])
+    assert cache.info()["evictions"] == 1
+    assert cache.info()["size"] == 2
+    cache.get(dates[0])
+    assert cache.info()["hits"] == 2
+    cache.get(dates[1])
+    assert cache.info()["misses"] == 4
+    cache.clear()
+    assert cache.info() == {"hits": 0, "misses": 0, "evictions": 0, "size": 0, "maxsize": 2}
+
+
+def test_date_cache_read_only_and_threads():
+    "Check that the shared coefficients can't be modified and threads agree"
+    import pytest
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache = CoefficientCache(maxsize=4)
+    date = datetime.datetime(2019, 3, 1)
+    g, h = cache.get(date)
+    with pytest.raises(TypeError):
+        g[1][0] = 0.0
+    with pytest.raises(TypeError):
+        h[1] = {}
+    dates = [datetime.datetime(2000 + i % 8, 1, 1) for i in range(200)]
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(cache.get, dates))
+    for day, (g_day, _) in zip(dates, results):
+        assert g_day[1][0] == cache.get(day)[0][1][0]
+    info = cache.info()
+    assert info["size"] == 4
+    assert info["hits"] + info["misses"] == 1 + 200 + 200
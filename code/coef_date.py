@@ -2,11 +2,9 @@
 Week 4: Interpolating the coefficients for a given date
 """
 import datetime
-import pytest
-import pygmt
+import functools
 import numpy as np
 import read_coef
-import dipole_moment
 
 
 def coef_date(date, g, h, g_sv, h_sv, years):
@@ -20,7 +18,7 @@ def coef_date(date, g, h, g_sv, h_sv, years):
             f"Invalid date '{str(date)}'. Must be < {max_date} and >= {min_date}",
         )
 
-    index = int((date.year - years[0]) // 5)
+    index = min(int((date.year - years[0]) // 5), len(years) - 1)
     timedelta = date - datetime.datetime(int(years[index]), 1, 1)
     epoch = (
         datetime.datetime(year=int(years[index]) + 5, month=1, day=1)
@@ -49,8 +47,116 @@ def coef_date(date, g, h, g_sv, h_sv, years):
     return g_year, h_year
 
 
+@functools.lru_cache(maxsize=8)
+def interpolation_table(model):
+    """
+    Piecewise linear interpolation table for a GaussCoefficients model
+
+    Returns the start year of each segment and the g, h at that year and their
+    slopes per year, with shape (n_epochs, n_coefs). The last segment uses the
+    secular variation of the model. The table is cached for each model.
+    """
+    g_start = model.g.T.copy()
+    h_start = model.h.T.copy()
+    g_slope = np.empty_like(g_start)
+    h_slope = np.empty_like(h_start)
+    g_slope[:-1] = np.diff(g_start, axis=0) / np.diff(model.years)[:, np.newaxis]
+    h_slope[:-1] = np.diff(h_start, axis=0) / np.diff(model.years)[:, np.newaxis]
+    g_slope[-1] = model.g_sv
+    h_slope[-1] = model.h_sv
+    return model.years, g_start, h_start, g_slope, h_slope
+
+
+def _epochs(years):
+    """
+    Start of each epoch in *years* and the end of the last one as datetime64
+    """
+    return np.array(
+        [f"{int(year)}-01-01" for year in years] + [f"{int(years[-1]) + 5}-01-01"],
+        dtype="datetime64[us]",
+    )
+
+
+def decimal_years(dates, years):
+    """
+    Convert datetimes to the decimal years used by coef_dates
+
+    Within each interval between the epochs in *years*, the time is counted
+    in the same way as coef_date: the fraction of the seconds of the
+    interval. After the last epoch, a year is 365.25 days.
+    """
+    dates = np.asarray(dates, dtype="datetime64[us]")
+    epochs = _epochs(years)
+    index = np.clip(np.searchsorted(epochs, dates, side="right") - 1, 0, len(years) - 1)
+    elapsed = (dates - epochs[index]) / np.timedelta64(1, "s")
+    interval = (epochs[index + 1] - epochs[index]) / np.timedelta64(1, "s")
+    year_in_seconds = 365.25 * 24 * 60 * 60
+    last = index == len(years) - 1
+    fraction = np.where(
+        last,
+        elapsed / year_in_seconds,
+        elapsed / interval * (years[np.minimum(index + 1, len(years) - 1)] - years[index]),
+    )
+    return years[index] + fraction
+
+
+def decimal_years_to_dates(time, years):
+    """
+    Convert decimal years to datetime64, the inverse of decimal_years
+
+    So that a decimal year and its date get the same coefficients.
+    """
+    time = np.asarray(time, dtype="float64")
+    epochs = _epochs(years)
+    index = np.clip(np.searchsorted(years, time, side="right") - 1, 0, len(years) - 1)
+    last = index == len(years) - 1
+    # Seconds and decimal years in each interval (a year after the last epoch)
+    interval = np.where(
+        last, 365.25 * 24 * 60 * 60, (epochs[index + 1] - epochs[index]) / np.timedelta64(1, "s"),
+    )
+    length = np.where(last, 1, years[np.minimum(index + 1, len(years) - 1)] - years[index])
+    elapsed = (time - years[index]) / length * interval
+    return epochs[index] + np.round(elapsed * 1e6).astype("timedelta64[us]")
+
+
+def coef_dates(dates, model, secular_variation=False, rows=None):
+    """
+    Get the coefficients for an array of datetimes or decimal years
+
+    Returns g and h with shape (n_dates, n_coefs) in the packed order of the
+    GaussCoefficients model. If *secular_variation* is True, also returns
+    their rates of change per year at each date. *rows* is a list of rows
+    of the packed arrays (from model.index) to interpolate only those, in
+    which case n_coefs is the number of rows.
+    """
+    years, g_start, h_start, g_slope, h_slope = interpolation_table(model)
+    if rows is not None:
+        g_start, h_start = g_start[:, rows], h_start[:, rows]
+        g_slope, h_slope = g_slope[:, rows], h_slope[:, rows]
+    dates = np.atleast_1d(dates)
+    if np.issubdtype(dates.dtype, np.number):
+        time = dates.astype("float64")
+    else:
+        time = decimal_years(dates, years)
+    invalid = (time < years[0]) | (time >= years[-1] + 6)
+    if np.any(invalid):
+        raise ValueError(
+            f"Invalid date '{dates[invalid][0]}'. "
+            f"Must be < {years[-1] + 6} and >= {years[0]}",
+        )
+    index = np.clip(np.searchsorted(years, time, side="right") - 1, 0, len(years) - 1)
+    elapsed = (time - years[index])[:, np.newaxis]
+    g = g_start[index] + elapsed * g_slope[index]
+    h = h_start[index] + elapsed * h_slope[index]
+    if secular_variation:
+        return g, h, g_slope[index], h_slope[index]
+    return g, h
+
+
 def test_invalid_year():
     "Check if raises an error when year is invalid"
+    import pytest
+
     g, h, g_sv, h_sv, years = read_coef.read_gauss_coeffs("igrf13coeffs.txt")
     with pytest.raises(ValueError):
         coef_date(datetime.datetime.fromisoformat("1899-12-31T23:59:59"), g, h, g_sv, h_sv, years)
@@ -73,8 +179,81 @@ def test_interpolation():
                 np.testing.assert_allclose(h_date[n][m], h[n][m][i], atol=0.001)
 
 
+def test_coef_dates():
+    "Check that the vectorized version matches coef_date"
+    model = read_coef.read_gauss_model("igrf13coeffs.txt")
+    g_all, h_all, g_sv, h_sv, years = model.as_dicts()
+    dates = [
+        datetime.datetime(1900, 1, 1),
+        datetime.datetime(1933, 7, 19, 3, 20),
+        datetime.datetime(2015, 1, 1),
+        datetime.datetime(2019, 12, 31, 23, 59),
+        datetime.datetime(2020, 1, 1),
+        datetime.datetime(2024, 2, 29, 12),
+        datetime.datetime(2025, 12, 31),
+    ]
+    g, h = coef_dates(dates, model)
+    assert g.shape == h.shape == (len(dates), 104)
+    for i, date in enumerate(dates):
+        g_date, h_date = coef_date(date, g_all, h_all, g_sv, h_sv, years)
+        for n in g_date:
+            for m in g_date[n]:
+                np.testing.assert_allclose(g[i, model.index[n, m]], g_date[n][m], rtol=1e-12, atol=1e-9)
+            for m in h_date[n]:
+                np.testing.assert_allclose(h[i, model.index[n, m]], h_date[n][m], rtol=1e-12, atol=1e-9)
+    # Decimal years give the epoch values and a linear interpolation between them
+    g, h = coef_dates([1905.0, 1907.5, 2022.0], model)
+    np.testing.assert_allclose(g[0], model.g[:, 1])
+    np.testing.assert_allclose(g[1], (model.g[:, 1] + model.g[:, 2]) / 2)
+    np.testing.assert_allclose(h[2], model.h[:, -1] + 2 * model.h_sv)
+    g_numpy, _ = coef_dates(np.array(dates, dtype="datetime64[s]"), model)
+    np.testing.assert_allclose(g_numpy, coef_dates(dates, model)[0])
+    rows = [model.index[1, 0], model.index[1, 1]]
+    g_rows, h_rows = coef_dates(dates, model, rows=rows)
+    assert g_rows.shape == (len(dates), 2)
+    np.testing.assert_array_equal(g_rows, g_numpy[:, rows])
+
+
+def test_decimal_years_to_dates():
+    "Check that decimal years and their dates give the same coefficients"
+    model = read_coef.read_gauss_model("igrf13coeffs.txt")
+    time = np.array([1900.0, 1933.37, 2015.5, 2019.999, 2020.0, 2024.16, 2025.99])
+    dates = decimal_years_to_dates(time, model.years)
+    assert dates.dtype == np.dtype("datetime64[us]")
+    assert dates[0] == np.datetime64("1900-01-01")
+    # Half of the 1826 days between 2015 and 2020
+    assert dates[2] == np.datetime64("2015-07-02T14:24")
+    np.testing.assert_allclose(decimal_years(dates, model.years), time, rtol=0, atol=1e-9)
+    for a, b in zip(coef_dates(dates, model), coef_dates(time, model)):
+        np.testing.assert_allclose(a, b, rtol=0, atol=1e-6)
+
+
+def test_coef_dates_invalid():
+    "Check that dates out of range fail"
+    import pytest
+
+    model = read_coef.read_gauss_model("igrf13coeffs.txt")
+    with pytest.raises(ValueError):
+        coef_dates([2000.0, 1899.99], model)
+    with pytest.raises(ValueError):
+        coef_dates([datetime.datetime(2026, 1, 1)], model)
+    assert interpolation_table(model) is interpolation_table(model)
+
+
 if __name__ == "__main__":
-    g, h, g_sv, h_sv, years = read_coef.read_gauss_coeffs("igrf13coeffs.txt")
+    import pygmt
+    import dipole_moment
+
+    model = read_coef.read_gauss_model("igrf13coeffs.txt")
+    dates = np.arange("1900-01", "2025-01", dtype="datetime64[M]")
+    g, h = coef_dates(dates, model)
+    # dipole_moment works on arrays so give it all dates at once
+    mx, my, mz = dipole_moment.dipole_moment(
+        {1: {0: g[:, model.index[1, 0]], 1: g[:, model.index[1, 1]]}},
+        {1: {1: h[:, model.index[1, 1]]}},
+    )
+    amp, lon, lat = dipole_moment.to_spherical(mx, my, mz)
+    is_igrf = dates >= np.datetime64("2020-01")
     fig = pygmt.Figure()
     fig.coast(
         region=[60, 150, -85, -65],
@@ -82,16 +261,6 @@ if __name__ == "__main__":
         land="lightgray",
         frame=True,
     )
-    for year in range(1900, 2020):
-        for month in range(1, 13):
-            g_year, h_year = coef_date(datetime.datetime(int(year), month, day=1), g, h, g_sv, h_sv, years)
-            mx, my, mz = dipole_moment.dipole_moment(g_year, h_year)
-            amp, lon, lat = dipole_moment.to_spherical(mx, my, mz)
-            fig.plot(x=lon, y=lat, style="c0.1c", fill="black")
-    for year in range(2020, 2025):
-        for month in range(1, 13):
-            g_year, h_year = coef_date(datetime.datetime(int(year), month, day=1), g, h, g_sv, h_sv, years)
-            mx, my, mz = dipole_moment.dipole_moment(g_year, h_year)
-            amp, lon, lat = dipole_moment.to_spherical(mx, my, mz)
-            fig.plot(x=lon, y=lat, style="c0.1c", fill="blue")
+    fig.plot(x=lon[~is_igrf], y=lat[~is_igrf], style="c0.1c", fill="black")
+    fig.plot(x=lon[is_igrf], y=lat[is_igrf], style="c0.1c", fill="blue")
     fig.show()
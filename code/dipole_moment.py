@@ -1,8 +1,6 @@
 """
 Week 3: Calculate the dipole moment and the pole locations
 """
-import pytest
-import pygmt
 import numpy as np
 import read_coef
 
@@ -53,6 +51,8 @@ def to_spherical(x, y, z):
 
 def test_invalid_year():
     "Check if raises an error when year is invalid"
+    import pytest
+
     g, h, g_sv, h_sv, years = read_coef.read_gauss_coeffs("igrf13coeffs.txt")
     with pytest.raises(ValueError):
         coef_year(1902, g, h, g_sv, h_sv, years)
@@ -85,6 +85,8 @@ def test_h_year():
 
 
 if __name__ == "__main__":
+    import pygmt
+
     g, h, g_sv, h_sv, years = read_coef.read_gauss_coeffs("igrf13coeffs.txt")
     lons = []
     lats = []
@@ -0,0 +1,350 @@
+"""
+Trace magnetic field lines of many points at once
+
+Lines are integrated in Earth centered Cartesian coordinates with the
+adaptive Dormand-Prince 5(4) Runge-Kutta scheme. Every stage evaluates the
+field of all the lines that are still active in one batch, and lines leave
+the batch when they reach the stop height (or fail). Used to find field line
+footprints at an altitude and magnetically conjugate points.
+"""
+import numpy as np
+
+import coef_cache
+import igrf_core
+
+
+# Dormand-Prince 5(4) coefficients. The last row of A is also the 5th order
+# solution and its stage is the first stage of the next step.
+_A = [
+    [],
+    [1 / 5],
+    [3 / 40, 9 / 40],
+    [44 / 45, -56 / 15, 32 / 9],
+    [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+    [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+    [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+]
+# Difference between the 5th and 4th order weights
+_ERROR = np.array([
+    35 / 384 - 5179 / 57600, 0, 500 / 1113 - 7571 / 16695, 125 / 192 - 393 / 640,
+    -2187 / 6784 + 92097 / 339200, 11 / 84 - 187 / 2100, -1 / 40,
+])
+
+
+def trace_field_lines(longitude, latitude, height, date, direction=1, stop_height=0.0,
+                      tolerance=1.0, max_step=500e3, max_length=1e9, max_steps=20_000,
+                      return_traces=False, backend="auto", path="igrf13coeffs.txt"):
+    """
+    Follow the field lines from geodetic points until they reach stop_height
+
+    Lines go along the field if *direction* is 1 and against it if it's -1.
+    The end point is where a line first comes down through *stop_height*
+    (m). Both can be arrays with a value for each point. Steps are adapted so
+    that the local error of each step is below *tolerance* (m), which is
+    also how close the end points are to the stop height. Lines that go
+    below both the start and the stop heights, are longer than *max_length*
+    (m), or take more than *max_steps* steps end as NaN.
+
+    Returns the longitude, latitude, and height of the end points. If
+    *return_traces* is True, also returns a list with an array of the
+    longitude, latitude, height of the points of each line with shape
+    (n_points, 3).
+    """
+    backend = igrf_core.select_backend(backend)
+    g, h = igrf_core.coef_arrays(*coef_cache.coefficients(date, path))
+    longitude, latitude, height, direction, stop_height = np.broadcast_arrays(
+        longitude, latitude, height, direction, stop_height,
+    )
+    shape = longitude.shape
+    position = geodetic_to_cartesian(longitude.ravel(), latitude.ravel(), height.ravel())
+    end, traces = _trace(
+        position, direction.ravel().astype("float64"), g, h,
+        stop_height.ravel().astype("float64"), tolerance, max_step, max_length, max_steps,
+        return_traces, backend,
+    )
+    end = tuple(component.reshape(shape) for component in cartesian_to_geodetic(*end.T))
+    if return_traces:
+        return end, [np.stack(cartesian_to_geodetic(*trace.T), axis=1) for trace in traces]
+    return end
+
+
+def footprints(longitude, latitude, height, date, altitude=110e3, **kwargs):
+    """
+    Footprints of the field lines through geodetic points at an altitude
+
+    Both directions of all points are traced in the same batch. Returns the
+    longitude, latitude (and height) of the footprints along the field, which
+    are in the northern magnetic hemisphere, and against the field, in the
+    southern. Other arguments are passed to trace_field_lines.
+    """
+    longitude, latitude, height = np.broadcast_arrays(longitude, latitude, height)
+    doubled = [np.stack([array, array]) for array in (longitude, latitude, height)]
+    direction = np.reshape([1, -1], (2,) + (1,) * longitude.ndim)
+    result = trace_field_lines(*doubled, date, direction, stop_height=altitude, **kwargs)
+    if kwargs.get("return_traces"):
+        end, traces = result
+        half = len(traces) // 2
+        return (
+            tuple(component[0] for component in end),
+            tuple(component[1] for component in end),
+            traces[:half],
+            traces[half:],
+        )
+    return tuple(component[0] for component in result), tuple(component[1] for component in result)
+
+
+def conjugate_points(longitude, latitude, height, date, **kwargs):
+    """
+    Magnetically conjugate points of geodetic points at the same height
+
+    Each line is traced in the direction that goes away from the Earth until
+    it comes back down to the height of its point. All lines are traced in
+    one batch even if the heights differ. Returns the longitude, latitude,
+    and height of the conjugate points (and the traces if *return_traces*
+    is True, like trace_field_lines). Other arguments are passed to
+    trace_field_lines (except stop_height).
+    """
+    longitude, latitude, height = np.broadcast_arrays(longitude, latitude, height)
+    path = kwargs.get("path", "igrf13coeffs.txt")
+    g, h = igrf_core.coef_arrays(*coef_cache.coefficients(date, path))
+    _, _, bu = igrf_core.field(longitude.ravel(), latitude.ravel(), height.ravel(), g, h)
+    direction = np.where(bu > 0, 1.0, -1.0).reshape(longitude.shape)
+    return trace_field_lines(
+        longitude, latitude, height, date, direction, stop_height=height, **kwargs,
+    )
+
+
+def geodetic_to_cartesian(longitude, latitude, height):
+    """
+    Convert WGS84 geodetic coordinates to Earth centered Cartesian (m)
+
+    Returns an array with shape (..., 3).
+    """
+    lon = np.radians(longitude)
+    lat = np.radians(latitude)
+    prime_radius = igrf_core.SEMIMAJOR_AXIS / np.sqrt(
+        1 - igrf_core.ECCENTRICITY_SQUARED * np.sin(lat)**2
+    )
+    return np.stack([
+        (prime_radius + height) * np.cos(lat) * np.cos(lon),
+        (prime_radius + height) * np.cos(lat) * np.sin(lon),
+        (prime_radius * (1 - igrf_core.ECCENTRICITY_SQUARED) + height) * np.sin(lat),
+    ], axis=-1)
+
+
+def cartesian_to_geodetic(x, y, z):
+    """
+    Convert Earth centered Cartesian coordinates to WGS84 geodetic
+
+    Uses the method of Bowring (1976) with one iteration, which is accurate
+    to better than a millimeter near the surface.
+    """
+    a = igrf_core.SEMIMAJOR_AXIS
+    e2 = igrf_core.ECCENTRICITY_SQUARED
+    b = a * np.sqrt(1 - e2)
+    p = np.hypot(x, y)
+    angle = np.arctan2(z * a, p * b)
+    lat = np.arctan2(
+        z + e2 / (1 - e2) * b * np.sin(angle)**3, p - e2 * a * np.cos(angle)**3,
+    )
+    height = p * np.cos(lat) + z * np.sin(lat) - a * np.sqrt(1 - e2 * np.sin(lat)**2)
+    return np.degrees(np.arctan2(y, x)), np.degrees(lat), height
+
+
+def _field_direction(position, g, h, backend):
+    """
+    Unit vectors of the field in Cartesian coordinates for an (n, 3) array
+    """
+    x, y, z = position.T
+    radius = np.sqrt(x**2 + y**2 + z**2)
+    colatitude = np.arccos(z / radius)
+    longitude = np.arctan2(y, x)
+    if backend == "numba":
+        import igrf_numba
+
+        be, bn, br = igrf_numba.series(longitude, colatitude, radius, g, h, igrf_core.EARTH_RADIUS)
+    else:
+        be, bn, br = igrf_core.column_sums(longitude, colatitude, radius, g, h)
+    cos_lat, sin_lat = np.sin(colatitude), np.cos(colatitude)
+    cos_lon, sin_lon = np.cos(longitude), np.sin(longitude)
+    # Radial, north, and east unit vectors
+    field = (
+        br[:, np.newaxis] * np.stack([cos_lat * cos_lon, cos_lat * sin_lon, sin_lat], axis=1)
+        + bn[:, np.newaxis] * np.stack([-sin_lat * cos_lon, -sin_lat * sin_lon, cos_lat], axis=1)
+        + be[:, np.newaxis] * np.stack([-sin_lon, cos_lon, np.zeros_like(x)], axis=1)
+    )
+    return field / np.linalg.norm(field, axis=1)[:, np.newaxis]
+
+
+def _trace(position, direction, g, h, stop_height, tolerance, max_step, max_length,
+           max_steps, return_traces, backend):
+    """
+    Integrate the lines of an (n, 3) array of Cartesian positions
+
+    Returns the end points (NaN for failed lines) and the traces (or None).
+    """
+    n_lines = position.shape[0]
+    end = np.full((n_lines, 3), np.nan)
+    _, _, start_height = cartesian_to_geodetic(*position.T)
+    # Each line has its own stop height
+    stop_height = np.broadcast_to(stop_height, (n_lines,))
+    floor = np.minimum(start_height, stop_height) - 10 * tolerance - 10e3
+    # State of the active lines
+    active = np.arange(n_lines)
+    position = position.copy()
+    previous_height = start_height
+    step = np.full(n_lines, min(10e3, max_step))
+    length = np.zeros(n_lines)
+    n_steps = np.zeros(n_lines, dtype=int)
+    slope = direction[:, np.newaxis] * _field_direction(position, g, h, backend)
+    history = [(active, position)] if return_traces else None
+
+    while active.size:
+        stages = [slope]
+        for row in _A[1:]:
+            stage_position = position + step[:, np.newaxis] * sum(
+                weight * stage for weight, stage in zip(row, stages) if weight
+            )
+            stages.append(direction[active, np.newaxis] * _field_direction(stage_position, g, h, backend))
+        # The last stage position is the 5th order solution
+        new_position = stage_position
+        error = step * np.linalg.norm(
+            sum(weight * stage for weight, stage in zip(_ERROR, stages) if weight), axis=1,
+        )
+        _, _, new_height = cartesian_to_geodetic(*new_position.T)
+        stop = stop_height[active]
+        crossed = (previous_height >= stop - tolerance) & (new_height < stop)
+        arrived = crossed & (new_height > stop - tolerance)
+        accepted = (error <= tolerance) & (~crossed | arrived)
+        n_steps += 1
+
+        # Accepted steps
+        position = np.where(accepted[:, np.newaxis], new_position, position)
+        slope = np.where(accepted[:, np.newaxis], stages[-1], slope)
+        length = np.where(accepted, length + step, length)
+        previous_height = np.where(accepted, new_height, previous_height)
+        if return_traces:
+            history.append((active[accepted], new_position[accepted]))
+
+        # Next step size from the error, or the secant to the stop height for
+        # steps that overshot it
+        with np.errstate(divide="ignore", invalid="ignore"):
+            factor = np.clip(0.9 * (tolerance / error)**0.2, 0.2, 5)
+            fraction = (previous_height - stop) / (previous_height - new_height)
+        new_step = np.minimum(step * factor, max_step)
+        overshoot = crossed & ~arrived & (error <= tolerance)
+        new_step = np.where(overshoot, step * np.clip(fraction, 0.01, 0.99), new_step)
+        step = new_step
+
+        done = arrived & accepted
+        end[active[done]] = position[done]
+        failed = (
+            (previous_height < floor[active])
+            | (length > max_length)
+            | (n_steps >= max_steps)
+        ) & ~done
+        keep = ~(done | failed)
+        active, position, slope, step = active[keep], position[keep], slope[keep], step[keep]
+        length, n_steps, previous_height = length[keep], n_steps[keep], previous_height[keep]
+
+    traces = None
+    if return_traces:
+        lines = np.concatenate([lines for lines, _ in history])
+        points = np.concatenate([points for _, points in history])
+        order = np.argsort(lines, kind="stable")
+        traces = np.split(points[order], np.cumsum(np.bincount(lines, minlength=n_lines))[:-1])
+    return end, traces
+
+
+def test_cartesian_round_trip():
+    "Check the conversions between geodetic and Cartesian"
+    rng = np.random.default_rng(0)
+    longitude = rng.uniform(-180, 180, 100)
+    latitude = rng.uniform(-90, 90, 100)
+    height = rng.uniform(-1e3, 1e6, 100)
+    back = cartesian_to_geodetic(*geodetic_to_cartesian(longitude, latitude, height).T)
+    np.testing.assert_allclose(back[0], longitude, atol=1e-9)
+    np.testing.assert_allclose(back[1], latitude, atol=1e-9)
+    np.testing.assert_allclose(back[2], height, atol=1e-3)
+    latitude_gc, radius = igrf_core.geodetic_to_spherical(latitude, height)
+    position = geodetic_to_cartesian(longitude, latitude, height)
+    np.testing.assert_allclose(np.linalg.norm(position, axis=1), radius, rtol=1e-12)
+
+
+def test_dipole_conjugate():
+    "Check the symmetric conjugate points and the shape of dipole field lines"
+    g = np.zeros((2, 2))
+    h = np.zeros((2, 2))
+    g[1, 0] = -30000
+    longitude = np.array([10.0, 100, 250])
+    latitude = np.array([30.0, 50, 65])
+    position = geodetic_to_cartesian(longitude, latitude, 0)
+    # Against the field goes up from the northern hemisphere
+    end, traces = _trace(
+        position, -np.ones(3), g, h, 0.0, 0.1, 500e3, 1e9, 10_000, True, "numpy",
+    )
+    end_lon, end_lat, end_height = cartesian_to_geodetic(*end.T)
+    np.testing.assert_allclose(np.mod(end_lon, 360), longitude, atol=1e-6)
+    np.testing.assert_allclose(end_lat, -latitude, atol=1e-5)
+    np.testing.assert_allclose(end_height, 0, atol=0.1)
+    # Dipole field lines have r / sin(colatitude)^2 constant
+    for trace in traces:
+        radius = np.linalg.norm(trace, axis=1)
+        shell = radius / (1 - (trace[:, 2] / radius)**2)
+        np.testing.assert_allclose(shell, shell[0], rtol=1e-6)
+        assert radius.max() > radius[0] * 1.1
+    # Along the field goes down so the point is its own footprint
+    end, _ = _trace(position, np.ones(3), g, h, 0.0, 0.1, 500e3, 1e9, 10_000, False, "numpy")
+    np.testing.assert_allclose(end, position, atol=0.1)
+
+
+def test_igrf_footprints_and_conjugates():
+    "Check the footprints and that the conjugate of the conjugate is the start"
+    import datetime
+
+    date = datetime.datetime(2021, 6, 1)
+    longitude = np.array([-105.0, 20, 140, 147])
+    latitude = np.array([40.0, 60, -35, -42])
+    for backend in igrf_core.available_backends():
+        north, south = footprints(longitude, latitude, 500e3, date, altitude=110e3, backend=backend)
+        assert np.all(north[1] > 0)
+        assert np.all(south[1] < 0)
+        np.testing.assert_allclose(north[2], 110e3, atol=1)
+        np.testing.assert_allclose(south[2], 110e3, atol=1)
+        conjugate = conjugate_points(longitude, latitude, 0, date, backend=backend)
+        assert np.all(np.sign(conjugate[1]) != np.sign(latitude))
+        back = conjugate_points(conjugate[0], conjugate[1], 0, date, backend=backend)
+        np.testing.assert_allclose(back[0], longitude, atol=1e-3)
+        np.testing.assert_allclose(back[1], latitude, atol=1e-3)
+    # The traces are along the field
+    (_, traces) = trace_field_lines(
+        longitude[:2], latitude[:2], 0, date, -1, return_traces=True, backend="numpy",
+    )
+    for trace in traces:
+        position = geodetic_to_cartesian(*trace.T)
+        g, h = igrf_core.coef_arrays(*coef_cache.coefficients(date))
+        segments = np.diff(position, axis=0)
+        segments /= np.linalg.norm(segments, axis=1)[:, np.newaxis]
+        middle = (position[1:] + position[:-1]) / 2
+        tangent = -_field_direction(middle, g, h, "numpy")
+        assert np.all(np.einsum("ij,ij->i", segments, tangent) > 0.999)
+    # Lines that go down into the Earth fail
+    end = trace_field_lines(-105, 40, 0, date, 1, stop_height=100e3)
+    assert np.all(np.isnan(end[0]))
+
+
+def test_conjugate_points_own_heights():
+    "Check that points with different heights are traced together"
+    import datetime
+
+    date = datetime.datetime(2021, 6, 1)
+    longitude = np.array([-105.0, 20, 140])
+    latitude = np.array([40.0, 60, -35])
+    height = np.array([300e3, 450e3, 800e3])
+    conjugate, traces = conjugate_points(longitude, latitude, height, date, return_traces=True)
+    np.testing.assert_allclose(conjugate[2], height, atol=1)
+    for i in range(3):
+        alone = conjugate_points(longitude[i], latitude[i], height[i], date)
+        np.testing.assert_allclose([c[i] for c in conjugate], alone, atol=1e-6)
+        np.testing.assert_allclose(traces[i][0], [longitude[i], latitude[i], height[i]])
+        np.testing.assert_allclose(traces[i][-1], [c[i] for c in conjugate])
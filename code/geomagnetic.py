@@ -0,0 +1,257 @@
+"""
+Geomagnetic (centered dipole) coordinates and magnetic local time
+
+Converts arrays of points between geographic and geomagnetic coordinates
+using the dipole terms g10, g11, h11 of the model interpolated to the time
+of each point. Latitudes are geocentric spherical (see
+igrf_core.geodetic_to_spherical). The geomagnetic north pole is where the
+dipole axis crosses the northern hemisphere and geomagnetic longitude 0 is
+the meridian that contains the geographic south pole.
+"""
+import numpy as np
+
+import coef_cache
+import coef_date
+
+
+def dipole_pole(g10, g11, h11):
+    """
+    Longitude and latitude of the geomagnetic north pole for the dipole terms
+
+    The pole is in the opposite direction of the dipole moment from
+    dipole_moment.dipole_moment. Works on arrays.
+    """
+    amplitude = np.sqrt(g10**2 + g11**2 + h11**2)
+    latitude = 90 - np.degrees(np.arccos(-g10 / amplitude))
+    longitude = np.degrees(np.arctan2(-h11, -g11))
+    return longitude, latitude
+
+
+def geographic_to_geomagnetic(longitude, latitude, times, chunk_size=1_000_000,
+                              path="igrf13coeffs.txt"):
+    """
+    Convert geographic longitude and latitude to geomagnetic
+
+    The coordinates and times (datetimes, numpy.datetime64, or decimal years)
+    are broadcast against each other and each point uses the dipole of its
+    own time. Points are converted in chunks of *chunk_size* to limit the
+    memory used. Returns the geomagnetic longitude and latitude in degrees.
+    """
+    return _transform(longitude, latitude, times, chunk_size, path, inverse=False)
+
+
+def geomagnetic_to_geographic(longitude, latitude, times, chunk_size=1_000_000,
+                              path="igrf13coeffs.txt"):
+    """
+    Convert geomagnetic longitude and latitude to geographic
+
+    The inverse of geographic_to_geomagnetic.
+    """
+    return _transform(longitude, latitude, times, chunk_size, path, inverse=True)
+
+
+def magnetic_local_time(longitude, latitude, times, chunk_size=1_000_000,
+                        path="igrf13coeffs.txt"):
+    """
+    Magnetic local time in hours of geographic points at their times
+
+    It's 12 plus the difference in geomagnetic longitude between the point and
+    the subsolar point divided by 15 degrees per hour, so the magnetic
+    meridian of the Sun is at noon.
+    """
+    longitude, latitude, times = _broadcast(longitude, latitude, times)
+    model = coef_cache.load_model(path)
+    mlt = np.empty(longitude.shape)
+    flat = [array.reshape(-1) for array in (longitude, latitude, times, mlt)]
+    for start in range(0, flat[0].size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        lon, lat, time, result = [array[chunk] for array in flat]
+        pole = _pole(time, model)
+        magnetic_longitude, _ = _rotate(lon, lat, pole, inverse=False)
+        sun_longitude, sun_latitude = subsolar_point(time, path)
+        sun_magnetic_longitude, _ = _rotate(sun_longitude, sun_latitude, pole, inverse=False)
+        result[:] = np.mod(12 + (magnetic_longitude - sun_magnetic_longitude) / 15, 24)
+    return mlt
+
+
+def subsolar_point(times, path="igrf13coeffs.txt"):
+    """
+    Geographic longitude and latitude where the Sun is overhead
+
+    Uses the low precision formulas of the Astronomical Almanac for the solar
+    declination and the equation of time, which are good to about 0.01
+    degrees between 1950 and 2050. Decimal years are converted to dates in
+    the same way as the coefficients of the model in *path* are interpolated
+    (see coef_date.decimal_years).
+    """
+    times = _as_datetime64(_as_times(times), path)
+    days = (times - np.datetime64("2000-01-01T12:00", "us")) / np.timedelta64(1, "D")
+    mean_anomaly = np.radians(357.529 + 0.98560028 * days)
+    mean_longitude = 280.459 + 0.98564736 * days
+    ecliptic_longitude = np.radians(
+        mean_longitude + 1.915 * np.sin(mean_anomaly) + 0.020 * np.sin(2 * mean_anomaly)
+    )
+    obliquity = np.radians(23.439 - 0.00000036 * days)
+    right_ascension = np.degrees(
+        np.arctan2(np.cos(obliquity) * np.sin(ecliptic_longitude), np.cos(ecliptic_longitude))
+    )
+    declination = np.degrees(np.arcsin(np.sin(obliquity) * np.sin(ecliptic_longitude)))
+    # Equation of time in degrees (wrapped to +-180)
+    equation_of_time = np.mod(mean_longitude - right_ascension + 180, 360) - 180
+    hours = (times - times.astype("datetime64[D]")) / np.timedelta64(1, "h")
+    longitude = np.mod(-15 * (hours - 12) - equation_of_time + 180, 360) - 180
+    return longitude, declination
+
+
+def _as_times(times):
+    times = np.asarray(times)
+    if times.dtype == object:
+        times = times.astype("datetime64[us]")
+    return times
+
+
+def _as_datetime64(times, path):
+    """
+    Convert decimal years to datetime64 with coef_date.decimal_years_to_dates
+    """
+    if not np.issubdtype(times.dtype, np.number):
+        return times.astype("datetime64[us]")
+    return coef_date.decimal_years_to_dates(times, coef_cache.load_model(path).years)
+
+
+def _broadcast(longitude, latitude, times):
+    longitude, latitude, times = np.broadcast_arrays(
+        np.asarray(longitude, dtype="float64"), np.asarray(latitude, dtype="float64"),
+        _as_times(times),
+    )
+    return longitude, latitude, times
+
+
+def _transform(longitude, latitude, times, chunk_size, path, inverse):
+    """
+    Rotate the points in chunks with the dipole of each time
+    """
+    longitude, latitude, times = _broadcast(longitude, latitude, times)
+    model = coef_cache.load_model(path)
+    new_longitude = np.empty(longitude.shape)
+    new_latitude = np.empty(longitude.shape)
+    flat = [array.reshape(-1) for array in (longitude, latitude, times, new_longitude, new_latitude)]
+    for start in range(0, flat[0].size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        lon, lat, time, lon_out, lat_out = [array[chunk] for array in flat]
+        lon_out[:], lat_out[:] = _rotate(lon, lat, _pole(time, model), inverse)
+    return new_longitude, new_latitude
+
+
+def _pole(times, model):
+    """
+    Cosine and sine of the colatitude and longitude of the geomagnetic north
+    pole at each time
+    """
+    rows = [model.index[1, 0], model.index[1, 1]]
+    g, h = coef_date.coef_dates(times, model, rows=rows)
+    g10, g11, h11 = g[:, 0], g[:, 1], h[:, 1]
+    amplitude = np.sqrt(g10**2 + g11**2 + h11**2)
+    horizontal = np.hypot(g11, h11)
+    return -g10 / amplitude, horizontal / amplitude, -g11 / horizontal, -h11 / horizontal
+
+
+def _rotate(longitude, latitude, pole, inverse):
+    """
+    Rotate to (or from) the frame whose z axis is the pole
+
+    The rotation is about z by the pole longitude and then about y by the
+    pole colatitude.
+    """
+    cos_theta, sin_theta, cos_phi, sin_phi = pole
+    lon = np.radians(longitude)
+    lat = np.radians(latitude)
+    x = np.cos(lat) * np.cos(lon)
+    y = np.cos(lat) * np.sin(lon)
+    z = np.sin(lat)
+    if not inverse:
+        meridian = cos_phi * x + sin_phi * y
+        x, y, z = (
+            cos_theta * meridian - sin_theta * z,
+            cos_phi * y - sin_phi * x,
+            sin_theta * meridian + cos_theta * z,
+        )
+    else:
+        meridian = cos_theta * x + sin_theta * z
+        x, y, z = (
+            cos_phi * meridian - sin_phi * y,
+            sin_phi * meridian + cos_phi * y,
+            cos_theta * z - sin_theta * x,
+        )
+    return np.degrees(np.arctan2(y, x)), np.degrees(np.arcsin(np.clip(z, -1, 1)))
+
+
+def test_pole():
+    "Check the pole of 2020 and that it matches the dipole moment"
+    import read_coef
+    import dipole_moment
+
+    model = read_coef.read_gauss_model("igrf13coeffs.txt")
+    epoch = list(model.years).index(2020)
+    g10, g11, h11 = model.g[0, epoch], model.g[1, epoch], model.h[1, epoch]
+    longitude, latitude = dipole_pole(g10, g11, h11)
+    np.testing.assert_allclose([longitude, latitude], [-72.68, 80.59], atol=0.01)
+    mx, my, mz = dipole_moment.dipole_moment({1: {0: g10, 1: g11}}, {1: {1: h11}})
+    _, moment_lon, moment_lat = dipole_moment.to_spherical(-mx, -my, -mz)
+    np.testing.assert_allclose([longitude, latitude], [moment_lon, moment_lat])
+    # The pole is at geomagnetic latitude 90 and the geographic north pole at
+    # geomagnetic longitude 180
+    magnetic = geographic_to_geomagnetic([longitude, 0], [latitude, 90], 2020.0)
+    np.testing.assert_allclose(magnetic[1][0], 90)
+    np.testing.assert_allclose(magnetic[0][1], 180)
+
+
+def test_round_trip_and_chunks():
+    "Check the inverse, the per-point times, and chunking against a loop"
+    rng = np.random.default_rng(6)
+    longitude = rng.uniform(-180, 180, 1000)
+    latitude = np.degrees(np.arcsin(rng.uniform(-1, 1, 1000)))
+    times = np.datetime64("1950-01-01") + rng.integers(0, 75 * 365, 1000).astype("timedelta64[D]")
+    magnetic = geographic_to_geomagnetic(longitude, latitude, times, chunk_size=64)
+    back = geomagnetic_to_geographic(*magnetic, times, chunk_size=100)
+    np.testing.assert_allclose(np.mod(back[0] - longitude + 180, 360) - 180, 0, atol=1e-9)
+    np.testing.assert_allclose(back[1], latitude, atol=1e-9)
+    # The geomagnetic colatitude is the angular distance from the pole of
+    # the date
+    model = coef_cache.load_model("igrf13coeffs.txt")
+    for i in range(0, 1000, 97):
+        g, h = coef_date.coef_dates(times[i:i + 1], model)
+        pole_lon, pole_lat = np.radians(dipole_pole(g[0, 0], g[0, 1], h[0, 1]))
+        lon, lat = np.radians(longitude[i]), np.radians(latitude[i])
+        distance = np.arccos(
+            np.sin(lat) * np.sin(pole_lat) + np.cos(lat) * np.cos(pole_lat) * np.cos(lon - pole_lon)
+        )
+        np.testing.assert_allclose(90 - magnetic[1][i], np.degrees(distance), atol=1e-8)
+    # Broadcasting a single time against a grid
+    grid = geographic_to_geomagnetic(longitude.reshape(10, 100), latitude.reshape(10, 100), 2010.5)
+    assert grid[0].shape == (10, 100)
+
+
+def test_magnetic_local_time():
+    "Check the subsolar point and that it's at magnetic noon"
+    import datetime
+
+    longitude, latitude = subsolar_point(np.datetime64("2020-06-21T12:00"))
+    np.testing.assert_allclose(latitude, 23.44, atol=0.01)
+    np.testing.assert_allclose(longitude, 0.4, atol=0.1)
+    time = datetime.datetime(2015, 3, 7, 18, 30)
+    longitude, latitude = subsolar_point([time])
+    mlt = magnetic_local_time(longitude, latitude, [time])
+    np.testing.assert_allclose(mlt, 12, atol=1e-9)
+    # 90 degrees of geomagnetic longitude east of the Sun is 18 MLT
+    sun_magnetic = geographic_to_geomagnetic(longitude, latitude, [time])
+    point = geomagnetic_to_geographic(sun_magnetic[0] + 90, 45, [time])
+    np.testing.assert_allclose(magnetic_local_time(*point, [time]), 18, atol=1e-9)
+    # Decimal years are the same as the dates, counted like the coefficients
+    # (half of the 1826 days from 2015 to 2020 is 2015-07-02T14:24)
+    mlt_years = magnetic_local_time(30, 60, [2015.5])
+    mlt_dates = magnetic_local_time(30, 60, [datetime.datetime(2015, 7, 2, 14, 24)])
+    np.testing.assert_allclose(mlt_years, mlt_dates, atol=1e-6)
+    np.testing.assert_allclose(
+        subsolar_point([2015.5]), subsolar_point([datetime.datetime(2015, 7, 2, 14, 24)]),
+    )
@@ -2,12 +2,9 @@
 Week 6: Calculate the IRGF field at a given point
 """
 import datetime
-import pytest
 import numpy as np
 import boule as bl
-import scipy
-import read_coef
-import coef_date
+import coef_cache
 import legendre
 
 
@@ -17,8 +14,7 @@ EARTH_RADIUS = 6371.2e3  # m
 def igrf(longitude, latitude, height, date):
     """
     """
-    g_all, h_all, g_sv, h_sv, years = read_coef.read_gauss_coeffs("igrf13coeffs.txt")
-    g, h = coef_date.coef_date(date, g_all, h_all, g_sv, h_sv, years)
+    g, h = coef_cache.coefficients(date)
 
     longitude, latitude_gc, radius = bl.WGS84.geodetic_to_spherical(longitude, latitude, height)
 
@@ -36,11 +32,11 @@ def igrf(longitude, latitude, height, date):
         for m in range(0, n + 1):
             cos = np.cos(m * longitude_rad)
             sin = np.sin(m * longitude_rad)
-            if m == 0:
-                h[n][m] = 0
-            be += r_frac * (-m * g[n][m] * sin + m * h[n][m] * cos) * s[n][m] * p[n][m]
-            bn_gc += r_frac * (g[n][m] * cos + h[n][m] * sin) * s[n][m] * dp[n][m]
-            br += (n + 1) * r_frac * (g[n][m] * cos + h[n][m] * sin) * s[n][m] * p[n][m]
+            # There is no h for m=0 (and the cached dicts can't be modified)
+            h_nm = h[n].get(m, 0)
+            be += r_frac * (-m * g[n][m] * sin + m * h_nm * cos) * s[n][m] * p[n][m]
+            bn_gc += r_frac * (g[n][m] * cos + h_nm * sin) * s[n][m] * dp[n][m]
+            br += (n + 1) * r_frac * (g[n][m] * cos + h_nm * sin) * s[n][m] * p[n][m]
     be *= -1 / np.sin(colatitude)
 
     # Rotate the vector from geocentric to geodetic
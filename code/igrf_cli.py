@@ -0,0 +1,225 @@
+"""
+Command line program that calculates the IGRF field for files of points
+
+Reads longitude, latitude, height, and date records and writes Be, Bn, Bu
+(and optionally the intensity) as CSV. Input is read in batches of fixed size
+so that the memory used doesn't depend on the size of the input. Examples:
+
+    python igrf_cli.py points.csv > field.csv
+    cat points.csv | python igrf_cli.py --intensity -o field.csv
+    python igrf_cli.py --binary points.bin > field.csv
+"""
+import io
+import sys
+import time
+import argparse
+import datetime
+import itertools
+import numpy as np
+
+import coef_cache
+import coef_date
+import igrf_core
+
+
+def main(argv=None):
+    """
+    Run the command line program
+    """
+    parser = argparse.ArgumentParser(
+        description="Calculate the IGRF field (Be, Bn, Bu in nT) for files of points.",
+    )
+    parser.add_argument(
+        "input", nargs="?", default="-",
+        help="File with one 'longitude latitude height date' record per line, "
+        "separated by spaces or commas. Height in meters and date as ISO "
+        "(2020-03-01T12:00:00) or decimal year. Reads stdin if omitted or '-'.",
+    )
+    parser.add_argument(
+        "-o", "--output", default="-", help="Output CSV file (default: stdout).",
+    )
+    parser.add_argument(
+        "--binary", action="store_true",
+        help="Input is little-endian float64 records of longitude, latitude, "
+        "height, and decimal year.",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=100_000,
+        help="Number of points calculated at once (default: 100000).",
+    )
+    parser.add_argument(
+        "--intensity", action="store_true", help="Also output the total intensity.",
+    )
+    parser.add_argument(
+        "--backend", choices=igrf_core.BACKENDS, default="auto",
+        help="Calculate with NumPy or the compiled Numba kernel (default: auto, "
+        "which uses Numba if it's installed).",
+    )
+    args = parser.parse_args(argv)
+
+    if args.input == "-":
+        source = sys.stdin.buffer if args.binary else sys.stdin
+    else:
+        source = open(args.input, "rb" if args.binary else "r")
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    if args.binary:
+        batches = read_binary_batches(source, args.batch_size)
+    else:
+        batches = read_text_batches(source, args.batch_size)
+
+    n_points = 0
+    start = time.perf_counter()
+    try:
+        for longitude, latitude, height, dates in batches:
+            be, bn, bu = igrf_core.igrf_track(
+                longitude, latitude, height, dates, backend=args.backend,
+            )
+            columns = [be, bn, bu]
+            if args.intensity:
+                columns.append(np.sqrt(be**2 + bn**2 + bu**2))
+            np.savetxt(output, np.transpose(columns), fmt="%.4f", delimiter=",")
+            output.flush()
+            n_points += longitude.size
+    finally:
+        if source not in (sys.stdin, sys.stdin.buffer):
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    print(
+        f"Calculated {n_points} points in {elapsed:.3f} s "
+        f"({n_points / max(elapsed, 1e-9):.0f} points/s)",
+        file=sys.stderr,
+    )
+    return 0
+
+
+def read_text_batches(stream, batch_size):
+    """
+    Read batches of records from lines of text
+
+    Empty lines and lines starting with # are ignored. Yields arrays of
+    longitude, latitude, height and a list of datetimes.
+    """
+    while True:
+        lines = list(itertools.islice(stream, batch_size))
+        if not lines:
+            return
+        records = [
+            line.replace(",", " ").split()
+            for line in lines
+            if line.strip() and not line.lstrip().startswith("#")
+        ]
+        if not records:
+            continue
+        for record in records:
+            if len(record) != 4:
+                raise ValueError(f"Invalid record '{' '.join(record)}'. Must have 4 columns.")
+        coordinates = np.array([record[:3] for record in records], dtype="float64")
+        dates = [parse_date(record[3]) for record in records]
+        yield coordinates[:, 0], coordinates[:, 1], coordinates[:, 2], dates
+
+
+def read_binary_batches(stream, batch_size):
+    """
+    Read batches of records from little-endian float64 binary data
+
+    Each record is longitude, latitude, height, decimal year. The decimal
+    years are passed on as a float64 array, which igrf_track hands directly
+    to coef_date.coef_dates.
+    """
+    record_size = 4 * 8
+    while True:
+        data = stream.read(batch_size * record_size)
+        if not data:
+            return
+        if len(data) % record_size != 0:
+            raise ValueError("Binary input ends with an incomplete record.")
+        records = np.frombuffer(data, dtype="<f8").reshape(-1, 4)
+        yield records[:, 0], records[:, 1], records[:, 2], records[:, 3]
+
+
+def parse_date(text):
+    """
+    Convert an ISO date or a decimal year to a datetime
+    """
+    try:
+        return decimal_year_to_datetime(float(text))
+    except ValueError:
+        return datetime.datetime.fromisoformat(text)
+
+
+def decimal_year_to_datetime(year, path="igrf13coeffs.txt"):
+    """
+    Convert a decimal year (2020.5) to a datetime
+
+    The years are counted like coef_date.decimal_years for the model in
+    *path*, so the datetime gets the same coefficients as the decimal year.
+    """
+    years = coef_cache.load_model(path).years
+    return coef_date.decimal_years_to_dates(year, years).item()
+
+
+def test_cli_text(tmp_path, capsys):
+    "Check the output for a text file against igrf_batch"
+    lines = [
+        "# longitude latitude height date",
+        "45, 45, 0, 2020-01-01",
+        "",
+        "-30 10 1000 2021-06-15T12:00:00",
+        "100 -60 50000 2022.5",
+    ]
+    path = tmp_path / "points.csv"
+    path.write_text("\n".join(lines))
+    assert main([str(path), "--intensity", "--batch-size", "2"]) == 0
+    captured = capsys.readouterr()
+    output = np.loadtxt(io.StringIO(captured.out), delimiter=",")
+    assert output.shape == (3, 4)
+    assert "points/s" in captured.err
+    dates = [
+        datetime.datetime(2020, 1, 1),
+        datetime.datetime(2021, 6, 15, 12),
+        decimal_year_to_datetime(2022.5),
+    ]
+    points = [(45, 45, 0), (-30, 10, 1000), (100, -60, 50000)]
+    for row, (lon, lat, height), date in zip(output, points, dates):
+        be, bn, bu = igrf_core.igrf_batch(lon, lat, height, date)
+        np.testing.assert_allclose(row[:3], [be, bn, bu], atol=1e-3)
+        np.testing.assert_allclose(row[3], np.sqrt(be**2 + bn**2 + bu**2), atol=1e-3)
+
+
+def test_cli_binary_stdin(tmp_path, monkeypatch):
+    "Check reading binary records from stdin and writing to a file"
+    rng = np.random.default_rng(3)
+    records = np.transpose([
+        rng.uniform(0, 360, 25),
+        rng.uniform(-80, 80, 25),
+        rng.uniform(0, 1e5, 25),
+        rng.uniform(2000, 2024, 25),
+    ])
+    stdin = io.TextIOWrapper(io.BytesIO(records.astype("<f8").tobytes()))
+    monkeypatch.setattr(sys, "stdin", stdin)
+    output = tmp_path / "field.csv"
+    assert main(["--binary", "--batch-size", "10", "-o", str(output)]) == 0
+    field = np.loadtxt(output, delimiter=",")
+    assert field.shape == (25, 3)
+    expected = igrf_core.igrf_track(*np.transpose(records), backend="numpy")
+    np.testing.assert_allclose(field, np.transpose(expected), atol=1e-3)
+    batches = read_binary_batches(io.BytesIO(records.astype("<f8").tobytes()), 10)
+    _, _, _, years = next(batches)
+    assert years.dtype == np.float64
+    np.testing.assert_array_equal(years, records[:10, 3])
+
+
+def test_decimal_year():
+    "Check the conversion of decimal years"
+    assert decimal_year_to_datetime(2020.0) == datetime.datetime(2020, 1, 1)
+    # Half of the 1826 days from 2015 to 2020 and 1.5 years of 365.25 days
+    # after the last epoch
+    assert decimal_year_to_datetime(2015.5) == datetime.datetime(2015, 7, 2, 14, 24)
+    assert decimal_year_to_datetime(2021.5) == datetime.datetime(2021, 7, 1, 21)
+    assert parse_date("2019-02-03") == datetime.datetime(2019, 2, 3)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,656 @@
+"""
+Numerical core of the IGRF calculations that only needs NumPy
+
+Meant for short lived programs and workers that only need field values and
+shouldn't pay for importing plotting, gridding, or testing libraries.
+"""
+import numpy as np
+
+import coef_cache
+import coef_date
+import legendre
+import instrument
+
+
+EARTH_RADIUS = 6371.2e3  # m
+# WGS84 ellipsoid
+SEMIMAJOR_AXIS = 6378137.0  # m
+FLATTENING = 1 / 298.257223563
+ECCENTRICITY_SQUARED = FLATTENING * (2 - FLATTENING)
+BACKENDS = ("auto", "numpy", "numba")
+
+
+def geodetic_to_spherical(latitude, height):
+    """
+    Convert WGS84 geodetic latitude and height to geocentric spherical
+
+    Returns the spherical latitude in degrees and the radius in meters. Same
+    as the conversion of boule.WGS84 without needing boule.
+    """
+    sinlat = np.sin(np.radians(latitude))
+    coslat = np.sqrt(1 - sinlat**2)
+    prime_radius = SEMIMAJOR_AXIS / np.sqrt(1 - ECCENTRICITY_SQUARED * sinlat**2)
+    xy_projection = (height + prime_radius) * coslat
+    z_cartesian = (height + (1 - ECCENTRICITY_SQUARED) * prime_radius) * sinlat
+    radius = np.hypot(xy_projection, z_cartesian)
+    latitude_gc = np.degrees(np.arcsin(z_cartesian / radius))
+    return latitude_gc, radius
+
+
+def coef_arrays(g, h):
+    """
+    Convert the g and h dicts to arrays indexed by [n, m]
+
+    Arrays are returned as they are.
+    """
+    if isinstance(g, np.ndarray):
+        return g, h
+    n_max = len(g)
+    g_array = np.zeros((n_max + 1, n_max + 1))
+    h_array = np.zeros((n_max + 1, n_max + 1))
+    for n in g:
+        for m in g[n]:
+            g_array[n, m] = g[n][m]
+    for n in h:
+        for m in h[n]:
+            h_array[n, m] = h[n][m]
+    return g_array, h_array
+
+
+def order_factors(g, h, p, dp, radius):
+    """
+    Sum the series over degree for each order
+
+    Takes coefficient arrays and the Schmidt normalized Legendre functions
+    from legendre.schmidt_legendre for 1D arrays of points. Returns the
+    factors of Be (before dividing by -sin(colatitude)), Bn, and Br that
+    multiply cos(m lon) (first n_max + 1 rows) and sin(m lon) (last n_max + 1
+    rows) for each point. The coefficients can have extra leading dimensions
+    (for several dates), which are added to the front of the factors.
+    """
+    n_max = g.shape[-1] - 1
+    degree = np.arange(n_max + 1)[:, np.newaxis]
+    orders = np.arange(n_max + 1)[:, np.newaxis]
+    r_frac = (EARTH_RADIUS / radius)**(degree + 2)
+    rp = p * r_frac[:, np.newaxis]
+    rdp = dp * r_frac[:, np.newaxis]
+    g_p = np.einsum("...nm,nmi->...mi", g, rp, optimize=True)
+    h_p = np.einsum("...nm,nmi->...mi", h, rp, optimize=True)
+    g_dp = np.einsum("...nm,nmi->...mi", g, rdp, optimize=True)
+    h_dp = np.einsum("...nm,nmi->...mi", h, rdp, optimize=True)
+    g_np = np.einsum("...nm,nmi->...mi", (degree + 1) * g, rp, optimize=True)
+    h_np = np.einsum("...nm,nmi->...mi", (degree + 1) * h, rp, optimize=True)
+    be = np.concatenate([orders * h_p, -orders * g_p], axis=-2)
+    bn = np.concatenate([g_dp, h_dp], axis=-2)
+    br = np.concatenate([g_np, h_np], axis=-2)
+    return be, bn, br
+
+
+def column_sums(longitude_rad, colatitude, radius, g, h):
+    """
+    Calculate Be, Bn, Br in geocentric coordinates for 1D arrays of points
+
+    The coefficient arrays are indexed by [n, m] or by [point, n, m] to use
+    different coefficients for each point. Runs the Legendre recursion one
+    degree at a time for all orders and adds each degree to the sums as it
+    goes, keeping only the last two degrees. So only O(n_max) values per
+    point are in memory instead of the O(n_max**2) of the full tables from
+    legendre.schmidt_legendre. (The Numba kernel runs the same recursion
+    order by order for each point instead.) Like the recursion, the sums are
+    of P_n^m / sin^m scaled by 1e-280 and are multiplied by sin^m (or
+    sin^(m-1) for the terms divided by sin) at the end, which keeps Be
+    finite at the poles.
+    """
+    n_max = g.shape[-1] - 1
+    a, b, sectoral, _, _ = legendre.schmidt_recursion_tables(n_max)
+    if g.ndim == 2:
+        g = g[np.newaxis]
+        h = h[np.newaxis]
+    shape = (n_max + 1, longitude_rad.size)
+    x = np.cos(colatitude)
+    u = np.sin(colatitude)
+    ratio = EARTH_RADIUS / radius
+    orders = np.arange(n_max + 1)[:, np.newaxis]
+    cos = np.cos(orders * longitude_rad)
+    sin = np.sin(orders * longitude_rad)
+
+    # P / sin^m and dP/dtheta / sin^m of the last two degrees for each order
+    p_1, p_2 = np.zeros(shape), np.zeros(shape)
+    dp_1, dp_2 = np.zeros(shape), np.zeros(shape)
+    # Sums over degree of the terms with cos and sin combined
+    p_cos = np.zeros(shape)
+    p_sin = np.zeros(shape)
+    dp_cos = np.zeros(shape)
+    np_cos = np.zeros(shape)
+    r_frac = ratio**2
+    for n in range(n_max + 1):
+        # Zeros above the diagonal because the recursion reads P_{n-2}^{n-1}
+        # (times b = 0)
+        p = np.zeros(shape)
+        dp = np.zeros(shape)
+        low = slice(0, n)
+        p[low] = a[n, low, np.newaxis] * x * p_1[low] - b[n, low, np.newaxis] * p_2[low]
+        dp[low] = a[n, low, np.newaxis] * (x * dp_1[low] - u * p_1[low]) - b[n, low, np.newaxis] * dp_2[low]
+        p[n] = 1e-280 * sectoral[n]
+        dp[n] = 0
+        if n > 0:
+            m = slice(0, n + 1)
+            # Coefficients of the degree with shape (orders, points or 1)
+            g_n = g[:, n, m].T
+            h_n = h[:, n, m].T
+            g_cos = g_n * cos[m] + h_n * sin[m]
+            g_sin = h_n * cos[m] - g_n * sin[m]
+            rp = r_frac * p[m]
+            p_cos[m] += g_cos * rp
+            p_sin[m] += g_sin * rp
+            dp_cos[m] += g_cos * r_frac * dp[m]
+            np_cos[m] += (n + 1) * g_cos * rp
+        p_1, p_2 = p, p_1
+        dp_1, dp_2 = dp, dp_1
+        r_frac = r_frac * ratio
+
+    # sin^m and sin^(m-1) times 1e280 in log space to avoid underflow
+    with np.errstate(divide="ignore"):
+        log_u = np.log(u)
+    log_scale = 280 * np.log(10)
+    factor = np.exp(log_scale + np.maximum(orders, 1) * log_u)
+    factor[0] = np.exp(log_scale)
+    factor_lower = np.exp(log_scale + np.maximum(orders - 1, 1) * log_u)
+    factor_lower[:2] = np.exp(log_scale)
+    be = -(factor_lower * orders * p_sin).sum(axis=0)
+    bn = (factor * dp_cos).sum(axis=0) + (factor_lower * orders * x * p_cos).sum(axis=0)
+    br = (factor * np_cos).sum(axis=0)
+    return be, bn, br
+
+
+def available_backends():
+    """
+    List the backends that can be used in this environment
+    """
+    backends = ["numpy"]
+    try:
+        import igrf_numba
+    except ImportError:
+        pass
+    else:
+        if igrf_numba.AVAILABLE:
+            backends.append("numba")
+    return backends
+
+
+def select_backend(backend):
+    """
+    Resolve "auto" to "numba" if Numba is installed and "numpy" otherwise
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Invalid backend '{backend}'. Must be one of {BACKENDS}.")
+    if backend == "auto":
+        return available_backends()[-1]
+    if backend not in available_backends():
+        raise ValueError(f"The '{backend}' backend requires Numba to be installed.")
+    return backend
+
+
+def igrf_batch(longitude, latitude, height, date, chunk_size=5000, backend="auto",
+               gradient=False, path="igrf13coeffs.txt"):
+    """
+    Calculate Be, Bn, Bu on arrays of points for a single date.
+
+    The coordinates can be scalars or arrays of any shape as long as they can
+    be broadcast against each other. The outputs have the broadcast shape.
+    The backend is "numpy", "numba" (compiled and parallel, needs Numba), or
+    "auto" to use Numba if it's installed. With NumPy, points are evaluated
+    in chunks of *chunk_size* to limit the memory used by the Legendre
+    functions. The Numba kernel needs no extra memory and ignores it.
+
+    If *gradient* is True, also returns the gradient tensor of the field (see
+    field_gradient) with shape (..., 3, 3). It's only calculated with NumPy,
+    so "auto" uses NumPy and another backend raises ValueError. The
+    coefficients are read from the file at *path*.
+    """
+    if gradient:
+        if backend not in ("auto", "numpy"):
+            select_backend(backend)
+            raise ValueError(
+                f"The gradient can't be calculated with the '{backend}' backend. "
+                "Use 'numpy' or 'auto'.",
+            )
+        backend = "numpy"
+    backend = select_backend(backend)
+    g, h = coef_cache.coefficients(date, path)
+
+    longitude, latitude, height = np.broadcast_arrays(longitude, latitude, height)
+    shape = longitude.shape
+    longitude = longitude.ravel()
+    latitude = latitude.ravel()
+    height = height.ravel()
+
+    if backend == "numba":
+        chunk_size = max(longitude.size, 1)
+    be = np.empty(longitude.size)
+    bn = np.empty(longitude.size)
+    bu = np.empty(longitude.size)
+    if gradient:
+        tensor = np.empty((longitude.size, 3, 3))
+    for start in range(0, longitude.size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        if gradient:
+            be[chunk], bn[chunk], bu[chunk], tensor[chunk] = field_gradient(
+                longitude[chunk], latitude[chunk], height[chunk], g, h,
+            )
+        else:
+            be[chunk], bn[chunk], bu[chunk] = field(
+                longitude[chunk], latitude[chunk], height[chunk], g, h, backend,
+            )
+    if gradient:
+        return (
+            be.reshape(shape), bn.reshape(shape), bu.reshape(shape),
+            tensor.reshape(shape + (3, 3)),
+        )
+    return be.reshape(shape), bn.reshape(shape), bu.reshape(shape)
+
+
+def igrf_track(longitude, latitude, height, times, chunk_size=5000, backend="auto",
+               path="igrf13coeffs.txt"):
+    """
+    Calculate Be, Bn, Bu on samples that each have their own time.
+
+    For survey lines where every sample has a timestamp. The times can be
+    datetimes, numpy.datetime64, or decimal years and are broadcast against
+    the coordinates like in igrf_batch. The coefficients are interpolated for
+    each sample (in chunks of *chunk_size*) from the table of coef_date and
+    all samples are calculated in the same pass, keeping their order.
+    """
+    backend = select_backend(backend)
+    model = coef_cache.load_model(path)
+
+    times = np.asarray(times)
+    if times.dtype == object:
+        times = times.astype("datetime64[us]")
+    longitude, latitude, height, times = np.broadcast_arrays(longitude, latitude, height, times)
+    shape = longitude.shape
+    longitude = longitude.ravel()
+    latitude = latitude.ravel()
+    height = height.ravel()
+    times = times.ravel()
+
+    be = np.empty(longitude.size)
+    bn = np.empty(longitude.size)
+    bu = np.empty(longitude.size)
+    n_max = model.n_max
+    for start in range(0, longitude.size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        with instrument.stage("date interpolation"):
+            g_packed, h_packed = coef_date.coef_dates(times[chunk], model)
+            # Arrays indexed by [sample, n, m] so that the coefficients of
+            # each sample are contiguous
+            g = np.zeros((g_packed.shape[0], n_max + 1, n_max + 1))
+            h = np.zeros((h_packed.shape[0], n_max + 1, n_max + 1))
+            g[:, model.degree, model.order] = g_packed
+            h[:, model.degree, model.order] = h_packed
+        be[chunk], bn[chunk], bu[chunk] = field(
+            longitude[chunk], latitude[chunk], height[chunk], g, h, backend,
+        )
+    return be.reshape(shape), bn.reshape(shape), bu.reshape(shape)
+
+
+def field(longitude, latitude, height, g, h, backend="numpy"):
+    """
+    Calculate Be, Bn, Bu for 1D arrays of points given the coefficients
+
+    The coefficients can be dicts or arrays indexed by [n, m] or by
+    [point, n, m]. The backend must be "numpy" or "numba" (see
+    select_backend).
+    """
+    with instrument.stage("coordinate conversion"):
+        latitude_gc, radius = geodetic_to_spherical(latitude, height)
+        colatitude = np.radians(90 - latitude_gc)
+        longitude_rad = np.radians(longitude)
+
+    g, h = coef_arrays(g, h)
+    # The Legendre recursion is fused into the summation in both backends
+    with instrument.stage("series summation"):
+        if backend == "numba":
+            import igrf_numba
+
+            be, bn_gc, br = igrf_numba.series(
+                longitude_rad, colatitude, radius, g, h, EARTH_RADIUS,
+            )
+        else:
+            be, bn_gc, br = column_sums(longitude_rad, colatitude, radius, g, h)
+
+    with instrument.stage("coordinate conversion"):
+        # Rotate the vector from geocentric to geodetic
+        cos = np.cos(-np.radians(latitude - latitude_gc))
+        sin = np.sin(-np.radians(latitude - latitude_gc))
+        bn = cos * bn_gc + sin * br
+        bu = -sin * bn_gc + cos * br
+
+    return be, bn, bu
+
+
+def field_gradient(longitude, latitude, height, g, h):
+    """
+    Calculate Be, Bn, Bu and their gradient tensor for 1D arrays of points
+
+    The tensor has shape (points, 3, 3) and element [i, j] is the derivative
+    of component i of (Be, Bn, Bu) along direction j of (east, north, up) in
+    nT/m. Both are in the local geodetic frame of each point, which is fixed
+    (the rotation of the frame between points isn't included). The tensor is
+    symmetric with zero trace. Uses the Legendre functions and their first
+    and second derivatives from legendre.schmidt_legendre in the same sums as
+    the field, so it costs a few times the field alone. The tensor divides by
+    sin(colatitude) and isn't defined exactly at the poles.
+    """
+    with instrument.stage("coordinate conversion"):
+        latitude_gc, radius = geodetic_to_spherical(latitude, height)
+        colatitude = np.radians(90 - latitude_gc)
+        longitude_rad = np.radians(longitude)
+
+    g, h = coef_arrays(g, h)
+    n_max = g.shape[0] - 1
+    x = np.cos(colatitude)
+    u = np.sin(colatitude)
+    with instrument.stage("legendre recursion"):
+        p, dp, d2p = legendre.schmidt_legendre(x, n_max, second=True)
+
+    with instrument.stage("series summation"):
+        degree = np.arange(n_max + 1)[:, np.newaxis]
+        orders = np.arange(n_max + 1)[:, np.newaxis]
+        cos = np.cos(orders * longitude_rad)
+        sin = np.sin(orders * longitude_rad)
+        r_frac = (EARTH_RADIUS / radius)**(degree + 2)
+
+        def sums(weights, table):
+            """
+            Sum w_n (R/r)^(n+2) table (g cos + h sin) and the same times m
+            (h cos - g sin) (the longitude derivative) over n and m
+            """
+            table = table * r_frac[:, np.newaxis]
+            g_sum = np.einsum("nm,nmi->mi", weights * g, table, optimize=True)
+            h_sum = np.einsum("nm,nmi->mi", weights * h, table, optimize=True)
+            cos_sum = g_sum * cos + h_sum * sin
+            sin_sum = orders * (h_sum * cos - g_sum * sin)
+            return cos_sum, sin_sum
+
+        ones = np.ones_like(degree)
+        p_cos, p_sin = sums(ones, p)
+        np1_p_cos, _ = sums(degree + 1, p)
+        np2_p_cos, np2_p_sin = sums(degree + 2, p)
+        np12_p_cos, _ = sums((degree + 1) * (degree + 2), p)
+        dp_cos, dp_sin = sums(ones, dp)
+        np2_dp_cos, _ = sums(degree + 2, dp)
+        d2p_cos, _ = sums(ones, d2p)
+        p_sin_1 = p_sin.sum(axis=0)
+        dp_cos_1 = dp_cos.sum(axis=0)
+        np1_p_cos_1 = np1_p_cos.sum(axis=0)
+        cot = x / u
+
+        # Field in the geocentric frame, as in column_sums
+        be = -p_sin_1 / u
+        bn_gc = dp_cos_1
+        br = np1_p_cos_1
+        # Second derivatives of the potential V in the orthonormal spherical
+        # frame (r, theta, lon). B = -grad V so the tensor is minus these.
+        v_rr = np12_p_cos.sum(axis=0) / radius
+        v_rt = -np2_dp_cos.sum(axis=0) / radius
+        v_rl = -np2_p_sin.sum(axis=0) / (radius * u)
+        v_tt = (d2p_cos.sum(axis=0) - np1_p_cos_1) / radius
+        v_tl = (dp_sin.sum(axis=0) - cot * p_sin_1) / (radius * u)
+        v_ll = (
+            -(orders**2 * p_cos).sum(axis=0) / u**2 - np1_p_cos_1 + cot * dp_cos_1
+        ) / radius
+
+    with instrument.stage("coordinate conversion"):
+        # East, north, up is lon, -theta, r
+        tensor = np.empty((longitude_rad.size, 3, 3))
+        tensor[:, 0, 0] = -v_ll
+        tensor[:, 1, 1] = -v_tt
+        tensor[:, 2, 2] = -v_rr
+        tensor[:, 0, 1] = tensor[:, 1, 0] = v_tl
+        tensor[:, 0, 2] = tensor[:, 2, 0] = -v_rl
+        tensor[:, 1, 2] = tensor[:, 2, 1] = v_rt
+        # Rotate the vector and the tensor from geocentric to geodetic
+        cos = np.cos(-np.radians(latitude - latitude_gc))
+        sin = np.sin(-np.radians(latitude - latitude_gc))
+        bn = cos * bn_gc + sin * br
+        bu = -sin * bn_gc + cos * br
+        rotation = np.zeros((longitude_rad.size, 3, 3))
+        rotation[:, 0, 0] = 1
+        rotation[:, 1, 1] = rotation[:, 2, 2] = cos
+        rotation[:, 1, 2] = sin
+        rotation[:, 2, 1] = -sin
+        tensor = rotation @ tensor @ rotation.transpose(0, 2, 1)
+
+    return be, bn, bu, tensor
+
+
+def test_geodetic_to_spherical():
+    "Check the conversion against boule"
+    import boule as bl
+
+    latitude = np.linspace(-90, 90, 37)
+    height = np.linspace(-1e3, 1e6, 37)
+    latitude_gc, radius = geodetic_to_spherical(latitude, height)
+    _, latitude_boule, radius_boule = bl.WGS84.geodetic_to_spherical(0, latitude, height)
+    np.testing.assert_allclose(latitude_gc, latitude_boule, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(radius, radius_boule, rtol=1e-15)
+
+
+def test_igrf_batch():
+    "Check that the batched calculation matches the single point version"
+    import datetime
+    import igrf_fast
+
+    date = datetime.datetime(2021, 3, 15)
+    rng = np.random.default_rng(42)
+    longitude = rng.uniform(-180, 360, size=(4, 5))
+    latitude = rng.uniform(-89, 89, size=(4, 5))
+    height = rng.uniform(0, 500e3, size=(4, 5))
+    for backend in available_backends():
+        be, bn, bu = igrf_batch(longitude, latitude, height, date, chunk_size=7, backend=backend)
+        assert be.shape == bn.shape == bu.shape == (4, 5)
+        for index in np.ndindex(4, 5):
+            be_point, bn_point, bu_point = igrf_fast.igrf(
+                longitude[index], latitude[index], height[index], date,
+            )
+            np.testing.assert_allclose(be[index], be_point, atol=0.2)
+            np.testing.assert_allclose(bn[index], bn_point, atol=0.2)
+            np.testing.assert_allclose(bu[index], bu_point, atol=0.2)
+
+
+def test_igrf_batch_broadcast():
+    "Check that scalars and arrays are broadcast against each other"
+    import datetime
+
+    date = datetime.datetime(2020, 1, 1)
+    for backend in available_backends():
+        be, bn, bu = igrf_batch(np.array([45, 45]), 45, height=0, date=date, backend=backend)
+        assert be.shape == (2,)
+        np.testing.assert_allclose(be, 3093.0, atol=0.2)
+        np.testing.assert_allclose(bn, 22182.0, atol=0.2)
+        np.testing.assert_allclose(bu, -45757.6, atol=0.2)
+
+
+def test_igrf_batch_path(tmp_path):
+    "Check that the coefficients are read from the given file"
+    import datetime
+
+    date = datetime.datetime(2020, 1, 1)
+    path = tmp_path / "coefs.txt"
+    with open("igrf13coeffs.txt") as source, open(path, "w") as copy:
+        for line in source:
+            if line.startswith("g  1  0"):
+                line = line.replace("-29404.8", "-29414.8")
+            copy.write(line)
+    be, bn, bu = igrf_batch(45, 45, 0, date)
+    be_path, bn_path, bu_path = igrf_batch(45, 45, 0, date, path=path)
+    np.testing.assert_allclose(be_path, be)
+    assert abs(bu_path - bu) > 1
+
+
+def test_column_sums_high_degree():
+    "Check the column sums against the full Legendre tables and at the poles"
+    rng = np.random.default_rng(8)
+    n_max = 300
+    degree = np.arange(1, n_max + 2)[:, np.newaxis]
+    g = np.tril(rng.normal(size=(n_max + 1, n_max + 1))) / degree**2
+    h = np.tril(rng.normal(size=(n_max + 1, n_max + 1))) / degree**2
+    h[:, 0] = 0
+    g[0, 0] = 0
+    colatitude = np.radians([0.5, 10, 45, 90, 135, 179])
+    longitude_rad = np.radians([0, 30, 100, 200, 300, 359])
+    radius = np.full(6, 6400e3)
+    be, bn, br = column_sums(longitude_rad, colatitude, radius, g, h)
+    p, dp = legendre.schmidt_legendre(np.cos(colatitude), n_max)
+    be_factors, bn_factors, br_factors = order_factors(g, h, p, dp, radius)
+    orders = np.arange(n_max + 1)[:, np.newaxis]
+    trig = np.vstack([np.cos(orders * longitude_rad), np.sin(orders * longitude_rad)])
+    np.testing.assert_allclose(
+        be, (be_factors * trig).sum(axis=0) * (-1 / np.sin(colatitude)), rtol=1e-9,
+    )
+    np.testing.assert_allclose(bn, (bn_factors * trig).sum(axis=0), rtol=1e-9)
+    np.testing.assert_allclose(br, (br_factors * trig).sum(axis=0), rtol=1e-9)
+    be, bn, br = column_sums(np.zeros(2), np.array([0, np.pi]), radius[:2], g, h)
+    assert np.all(np.isfinite(be))
+    assert np.all(np.isfinite(bn))
+
+
+def test_gradient_finite_differences():
+    "Check the gradient tensor against finite differences of the field"
+    import datetime
+    import pytest
+
+    date = datetime.datetime(2022, 4, 1)
+    longitude = np.array([-40.0, 10, 130, 250])
+    latitude = np.array([-70.0, -5, 35, 80])
+    height = np.array([0.0, 2e3, 100e3, 400e3])
+    be, bn, bu, tensor = igrf_batch(longitude, latitude, height, date, gradient=True)
+    assert tensor.shape == (4, 3, 3)
+    expected = igrf_batch(longitude, latitude, height, date, backend="numpy")
+    for component, value in zip((be, bn, bu), expected):
+        np.testing.assert_allclose(component, value, rtol=1e-10)
+    np.testing.assert_allclose(tensor, tensor.transpose(0, 2, 1), atol=1e-12)
+    np.testing.assert_allclose(np.trace(tensor, axis1=1, axis2=2), 0, atol=1e-12)
+    for backend in ["numpy", "auto"]:
+        result = igrf_batch(longitude, latitude, height, date, gradient=True, backend=backend)
+        np.testing.assert_array_equal(result[3], tensor)
+    with pytest.raises(ValueError):
+        igrf_batch(longitude, latitude, height, date, gradient=True, backend="numba")
+    with pytest.raises(ValueError, match="Invalid backend"):
+        igrf_batch(longitude, latitude, height, date, gradient=True, backend="fortran")
+
+    # Differences of the field in a fixed (Earth centered) frame
+    lon = np.radians(longitude)
+    lat = np.radians(latitude)
+    # Unit vectors of east, north, up in Earth centered coordinates
+    def frame(lon, lat):
+        return np.stack([
+            np.stack([-np.sin(lon), np.cos(lon), np.zeros_like(lon)], axis=-1),
+            np.stack([-np.sin(lat) * np.cos(lon), -np.sin(lat) * np.sin(lon), np.cos(lat)], axis=-1),
+            np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1),
+        ], axis=-2)
+    sinlat2 = np.sin(lat)**2
+    prime = SEMIMAJOR_AXIS / np.sqrt(1 - ECCENTRICITY_SQUARED * sinlat2)
+    meridian = prime * (1 - ECCENTRICITY_SQUARED) / (1 - ECCENTRICITY_SQUARED * sinlat2)
+    step = 50.0
+    shifts = [
+        (np.degrees(step / ((prime + height) * np.cos(lat))), 0, 0),
+        (0, np.degrees(step / (meridian + height)), 0),
+        (0, 0, step),
+    ]
+    center_frame = frame(lon, lat)
+    differences = np.empty((4, 3, 3))
+    for j, (d_lon, d_lat, d_height) in enumerate(shifts):
+        fixed = []
+        for sign in (1, -1):
+            new_lon = longitude + sign * d_lon
+            new_lat = latitude + sign * d_lat
+            vector = np.stack(
+                igrf_batch(new_lon, new_lat, height + sign * d_height, date, backend="numpy"),
+                axis=-1,
+            )
+            earth = np.einsum("pi,pij->pj", vector, frame(np.radians(new_lon), np.radians(new_lat)))
+            fixed.append(np.einsum("pij,pj->pi", center_frame, earth))
+        differences[:, :, j] = (fixed[0] - fixed[1]) / (2 * step)
+    np.testing.assert_allclose(tensor, differences, atol=2e-7)
+
+
+def test_igrf_track():
+    "Check samples with their own times against igrf_batch for each date"
+    import datetime
+
+    dates = [
+        datetime.datetime(2001, 5, 3),
+        datetime.datetime(2019, 12, 31, 18),
+        datetime.datetime(2024, 7, 1),
+    ]
+    rng = np.random.default_rng(11)
+    times = [dates[i] for i in rng.integers(0, 3, 40)]
+    longitude = rng.uniform(-180, 180, 40)
+    latitude = rng.uniform(-89, 89, 40)
+    height = rng.uniform(0, 5e3, 40)
+    for backend in available_backends():
+        be, bn, bu = igrf_track(longitude, latitude, height, times, chunk_size=16, backend=backend)
+        for date in dates:
+            index = [time == date for time in times]
+            expected = igrf_batch(
+                longitude[index], latitude[index], height[index], date, backend=backend,
+            )
+            np.testing.assert_allclose(be[index], expected[0], rtol=1e-12, atol=1e-6)
+            np.testing.assert_allclose(bn[index], expected[1], rtol=1e-12, atol=1e-6)
+            np.testing.assert_allclose(bu[index], expected[2], rtol=1e-12, atol=1e-6)
+    # Decimal years and datetime64 with broadcasting
+    be, _, _ = igrf_track(45, 45, 0, np.array([2020.0, 2021.0]))
+    assert be.shape == (2,)
+    np.testing.assert_allclose(be[0], 3093.0, atol=0.2)
+    np.testing.assert_allclose(be[1], 3123.3, atol=0.2)
+    be_numpy, _, _ = igrf_track(45, 45, 0, np.array(["2001-05-03", "2024-07-01"], dtype="datetime64[s]"))
+    be_datetime, _, _ = igrf_track(45, 45, 0, [dates[0], dates[2]])
+    np.testing.assert_allclose(be_numpy, be_datetime, rtol=1e-12)
+
+
+def test_backends_agree():
+    "Check that all backends give the same field on random points"
+    import datetime
+
+    rng = np.random.default_rng(1)
+    longitude = rng.uniform(-180, 180, 5000)
+    latitude = rng.uniform(-89.9, 89.9, 5000)
+    height = rng.uniform(-1e3, 1e6, 5000)
+    date = datetime.datetime(2023, 5, 1)
+    reference = igrf_batch(longitude, latitude, height, date, backend="numpy")
+    for backend in available_backends():
+        result = igrf_batch(longitude, latitude, height, date, backend=backend)
+        for component, expected in zip(result, reference):
+            np.testing.assert_allclose(component, expected, rtol=1e-10, atol=1e-6)
+
+
+def test_select_backend(monkeypatch):
+    "Check the backend selection and the fallback without Numba"
+    import sys
+    import pytest
+
+    assert select_backend("numpy") == "numpy"
+    assert select_backend("auto") == available_backends()[-1]
+    with pytest.raises(ValueError):
+        select_backend("fortran")
+    # A None entry in sys.modules makes the import fail like a missing package
+    monkeypatch.setitem(sys.modules, "igrf_numba", None)
+    assert available_backends() == ["numpy"]
+    assert select_backend("auto") == "numpy"
+    with pytest.raises(ValueError):
+        select_backend("numba")
+
+
+def test_light_imports():
+    "Check that importing the core doesn't import the heavy libraries"
+    import sys
+    import subprocess
+
+    heavy = ["pytest", "pygmt", "xarray", "verde", "boule", "scipy", "pandas"]
+    code = f"import sys, igrf_core; print([m for m in {heavy} if m in sys.modules])"
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+    )
+    assert output.stdout.strip() == "[]"
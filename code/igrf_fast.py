@@ -3,44 +3,140 @@ Week 8: Make the IGRF code faster
 """
 import time
 import datetime
-import pytest
+import functools
 import numpy as np
-import boule as bl
-import xarray as xr
-import verde as vd
-import pygmt
 
-import read_coef
+import coef_cache
 import coef_date
 import legendre
-import line_profiler
+import instrument
+import igrf_core
+# Moved to igrf_core, kept here so that igrf_fast.igrf_batch still works
+from igrf_core import igrf_batch  # noqa: F401
 
 
+EARTH_RADIUS = igrf_core.EARTH_RADIUS
+# Minimum degree from which the FFT beats the matrix multiplication on grids
+FFT_MIN_DEGREE = 30
+# Maximum number of latitude rows and of values in the Legendre arrays when
+# calculating blocks of grid rows
+GRID_BLOCK_ROWS = 64
+LEGENDRE_BLOCK_SIZE = 2**20
+PRECISIONS = ("float64", "float32")
 
-EARTH_RADIUS = 6371.2e3  # m
 
-
-@line_profiler.profile
-def igrf_grid(region, spacing, height, date):
+def igrf_grid(region, spacing, height, date, method="auto", precision="float64"):
     """
     Make a grid of Bx, By, Bz at a uniform height.
+
+    The method can be "fft" for global grids that cover 360 degrees of
+    longitude, "direct" for any grid, or "auto" to use "fft" when possible
+    and the model is of high enough degree for it to be faster.
+
+    The precision is "float64" or "float32". With "float32" the Legendre
+    recursion and the sums over degree are still done in float64 (they only
+    depend on latitude) but the synthesis of the rows and the grids are in
+    float32, which halves the memory. See precision_report for the error.
     """
-    g_all, h_all, g_sv, h_sv, years = read_coef.read_gauss_coeffs("igrf13coeffs.txt")
-    g, h = coef_date.coef_date(date, g_all, h_all, g_sv, h_sv, years)
+    # Imported here so that the point calculations don't need verde
+    import verde as vd
+
+    g, h = coef_cache.coefficients(date)
 
     longitude, latitude = vd.grid_coordinates(region, spacing=spacing, meshgrid=False)
 
-    shape = (latitude.size, longitude.size)
-    be = np.zeros(shape)
-    bn = np.zeros(shape)
-    bu = np.zeros(shape)
+    be, bn, bu = _igrf_grid_internal(longitude, latitude, height, g, h, method, precision)
+    with instrument.stage("dataset assembly"):
+        grid = _grid_dataset(longitude, latitude, be, bn, bu)
+    return grid
+
+
+def igrf_grid_stack(region, spacing, height, dates, method="auto", secular_variation=False,
+                    path="igrf13coeffs.txt"):
+    """
+    Make grids of Be, Bn, Bu at a uniform height for many dates.
+
+    The coordinate conversion, Legendre functions, and sines and cosines are
+    only calculated once for the grid geometry. The grids of all dates are
+    then one matrix product with the coefficients interpolated for each date
+    (or one FFT of each row). The dates can be datetimes, numpy.datetime64,
+    or decimal years. Returns a Dataset with dimensions time, latitude, and
+    longitude. If *secular_variation* is True, it also has the rates of
+    change be_sv, bn_sv, bu_sv in nT/year, calculated in the same way from
+    the rates of change of the coefficients.
+    """
+    import verde as vd
+    import xarray as xr
+
+    model = coef_cache.load_model(path)
+    times = np.atleast_1d(np.asarray(dates))
+    if times.dtype == object:
+        times = times.astype("datetime64[us]")
+    longitude, latitude = vd.grid_coordinates(region, spacing=spacing, meshgrid=False)
+
+    with instrument.stage("date interpolation"):
+        packed = coef_date.coef_dates(times, model, secular_variation=secular_variation)
+        # Arrays indexed by [date, n, m] with the rates after the values
+        g = np.zeros((len(packed) // 2 * times.size, model.n_max + 1, model.n_max + 1))
+        h = np.zeros_like(g)
+        g[:, model.degree, model.order] = np.concatenate(packed[0::2])
+        h[:, model.degree, model.order] = np.concatenate(packed[1::2])
+
+    be, bn, bu = _igrf_grid_internal(longitude, latitude, height, g, h, method)
+    with instrument.stage("dataset assembly"):
+        dims = ("time", "latitude", "longitude")
+        components = {"be": be, "bn": bn, "bu": bu}
+        variables = {name: (dims, values[:times.size]) for name, values in components.items()}
+        if secular_variation:
+            for name, values in components.items():
+                variables[f"{name}_sv"] = (dims, values[times.size:])
+        grid = xr.Dataset(
+            variables, coords={"time": times, "longitude": longitude, "latitude": latitude},
+        )
+    return grid
+
+
+def precision_report(region, spacing, height, date, method="auto", precision="float32"):
+    """
+    Difference between a grid in the given precision and the float64 grid
+
+    Returns a dict with the maximum absolute and the RMS difference (nT) of
+    each component, the same for the amplitude, and the memory of the three
+    grids in bytes in both precisions. Use it to decide if a lower precision
+    is good enough for a product. Points where the float64 grid isn't finite
+    (Be at the poles) are left out.
+    """
+    reference = igrf_grid(region, spacing, height, date, method=method)
+    grid = igrf_grid(region, spacing, height, date, method=method, precision=precision)
+    report = {}
+    for name in ["be", "bn", "bu", "amplitude"]:
+        if name == "amplitude":
+            value = np.sqrt(sum(
+                grid[component].values.astype("float64")**2 for component in ["be", "bn", "bu"]
+            ))
+            expected = np.sqrt(sum(
+                reference[component].values**2 for component in ["be", "bn", "bu"]
+            ))
+        else:
+            value = grid[name].values.astype("float64")
+            expected = reference[name].values
+        difference = (value - expected)[np.isfinite(expected)]
+        report[name] = {
+            "max": float(np.abs(difference).max()),
+            "rms": float(np.sqrt(np.mean(difference**2))),
+        }
+    report["nbytes"] = {
+        "float64": sum(reference[name].nbytes for name in ["be", "bn", "bu"]),
+        precision: sum(grid[name].nbytes for name in ["be", "bn", "bu"]),
+    }
+    return report
+
 
-    for i, lat in enumerate(latitude):
-        for j, lon in enumerate(longitude):
-            be_point, bn_point, bu_point = _igrf_internal(lon, lat, height, g, h)
-            be[i, j] = be_point
-            bn[i, j] = bn_point
-            bu[i, j] = bu_point
+def _grid_dataset(longitude, latitude, be, bn, bu):
+    """
+    Put the grids of each component in an xarray.Dataset
+    """
+    import xarray as xr
 
     dims = ("latitude", "longitude")
     grid = xr.Dataset(
@@ -54,49 +150,198 @@ def igrf_grid(region, spacing, height, date):
     return grid
 
 
-@line_profiler.profile
+def _igrf_grid_internal(longitude, latitude, height, g, h, method="auto", precision="float64"):
+    """
+    Calculate the field on a regular grid given 1D longitude and latitude
+
+    The coordinate conversion and Legendre functions only depend on latitude
+    and the sines and cosines only on longitude. So they are calculated once
+    per row and column and combined with matrix multiplications or, for
+    global grids, an inverse FFT of each row. Rows are calculated in blocks
+    of _grid_block_rows to limit the memory used. Coefficient arrays with
+    shape (dates, n_max + 1, n_max + 1) give grids with shape (dates,
+    latitude, longitude) from the same Legendre functions and trig.
+    """
+    g, h = igrf_core.coef_arrays(g, h)
+    n_max = g.shape[-1] - 1
+
+    if method not in ("auto", "fft", "direct"):
+        raise ValueError(f"Invalid method '{method}'. Must be 'auto', 'fft', or 'direct'.")
+    if precision not in PRECISIONS:
+        raise ValueError(f"Invalid precision '{precision}'. Must be one of {PRECISIONS}.")
+    dtype = np.dtype(precision)
+    period = _fft_period(longitude, n_max)
+    if method == "fft" and period is None:
+        raise ValueError(
+            "The 'fft' method requires uniformly spaced longitudes covering "
+            f"360 degrees with more than {2 * n_max} points per circle.",
+        )
+    # The matrix multiplication is faster than the FFT for low degrees
+    if method == "direct" or period is None or (method == "auto" and n_max < FFT_MIN_DEGREE):
+        orders = np.arange(n_max + 1)[:, np.newaxis]
+        longitude_rad = np.radians(longitude)
+        trig = np.vstack([np.cos(orders * longitude_rad), np.sin(orders * longitude_rad)])
+        trig = trig.astype(dtype)
+        synthesize = functools.partial(_synthesize_direct, trig=trig)
+    else:
+        synthesize = functools.partial(_synthesize_fft, longitude=longitude)
+
+    shape = g.shape[:-2] + (latitude.size, longitude.size)
+    be = np.empty(shape, dtype=dtype)
+    bn = np.empty(shape, dtype=dtype)
+    bu = np.empty(shape, dtype=dtype)
+    block = _grid_block_rows(n_max)
+    for start in range(0, latitude.size, block):
+        rows = slice(start, start + block)
+        be[..., rows, :], bn[..., rows, :], bu[..., rows, :] = _igrf_grid_rows(
+            longitude, latitude[rows], height, g, h, synthesize, dtype,
+        )
+    return be, bn, bu
+
+
+def _grid_block_rows(n_max):
+    """
+    Number of latitude rows calculated at once on grids
+    """
+    return max(1, min(GRID_BLOCK_ROWS, LEGENDRE_BLOCK_SIZE // (n_max + 1)**2))
+
+
+def _igrf_grid_rows(longitude, latitude, height, g, h, synthesize, dtype=np.float64):
+    """
+    Calculate a block of grid rows with coefficient arrays
+
+    The latitude factors are calculated in float64 and the rows are
+    synthesized and rotated in *dtype*. The factors of all dates (leading
+    dimensions of g and h) are synthesized in one call.
+    """
+    with instrument.stage("coordinate conversion"):
+        latitude_gc, radius = igrf_core.geodetic_to_spherical(latitude, height)
+        colatitude = np.radians(90 - latitude_gc)
+
+    n_max = g.shape[-1] - 1
+    with instrument.stage("legendre recursion"):
+        p, dp = legendre.schmidt_legendre(np.cos(colatitude), n_max)
+
+    with instrument.stage("series summation"):
+        # Latitude factors that multiply cos(m lon) (first n_max + 1 rows)
+        # and sin(m lon) (last n_max + 1 rows)
+        be_lat, bn_lat, br_lat = igrf_core.order_factors(g, h, p, dp, radius)
+
+        def synthesize_rows(lat_factors):
+            # (..., orders, rows) to (..., rows, longitude)
+            lat_factors = np.swapaxes(lat_factors, -1, -2).astype(dtype)
+            rows = synthesize(lat_factors.reshape(-1, lat_factors.shape[-1]))
+            return rows.reshape(lat_factors.shape[:-1] + rows.shape[-1:])
+
+        be = synthesize_rows(be_lat) * (-1 / np.sin(colatitude)).astype(dtype)[:, np.newaxis]
+        bn_gc = synthesize_rows(bn_lat)
+        br = synthesize_rows(br_lat)
+
+    with instrument.stage("coordinate conversion"):
+        # Rotate the vector from geocentric to geodetic
+        cos = np.cos(-np.radians(latitude - latitude_gc)).astype(dtype)[:, np.newaxis]
+        sin = np.sin(-np.radians(latitude - latitude_gc)).astype(dtype)[:, np.newaxis]
+        bn = cos * bn_gc + sin * br
+        bu = -sin * bn_gc + cos * br
+
+    return be, bn, bu
+
+
+def _fft_period(longitude, n_max):
+    """
+    Number of points in 360 degrees if the grid can be synthesized by FFT
+
+    Returns None if the longitudes aren't uniform, don't cover the whole
+    circle, or are too coarse to represent order n_max without aliasing.
+    """
+    if longitude.size < 2:
+        return None
+    spacing = longitude[1] - longitude[0]
+    if not np.allclose(np.diff(longitude), spacing, rtol=0, atol=1e-9):
+        return None
+    period = int(round(360 / spacing))
+    if not np.isclose(period * spacing, 360, rtol=0, atol=1e-8):
+        return None
+    if longitude.size < period or period <= 2 * n_max:
+        return None
+    return period
+
+
+def _synthesize_direct(lat_factors, trig):
+    """
+    Sum the cos(m lon) and sin(m lon) terms with a matrix multiplication
+
+    trig has the cos(m lon) for each order followed by the sin(m lon).
+    """
+    return lat_factors @ trig
+
+
+def _synthesize_fft(lat_factors, longitude):
+    """
+    Sum the cos(m lon) and sin(m lon) terms with an inverse real FFT per row
+
+    Only valid if _fft_period returns a number of points for the longitudes.
+    The FFT is done in the precision of *lat_factors*.
+    """
+    n_orders = lat_factors.shape[1] // 2
+    period = int(round(360 / (longitude[1] - longitude[0])))
+    # Sum of Re{(a_m - i b_m) exp(i m lon)} shifted to start at longitude[0]
+    orders = np.arange(n_orders)
+    complex_dtype = np.result_type(lat_factors.dtype, np.complex64)
+    coefs = (lat_factors[:, :n_orders] - 1j * lat_factors[:, n_orders:]) * np.exp(
+        1j * orders * np.radians(longitude[0])
+    ).astype(complex_dtype)
+    spectrum = np.zeros((lat_factors.shape[0], period // 2 + 1), dtype=complex_dtype)
+    spectrum[:, 0] = period * coefs[:, 0].real
+    spectrum[:, 1:n_orders] = period / 2 * coefs[:, 1:]
+    rows = np.fft.irfft(spectrum, n=period, axis=1)
+    # Repeat the periodic rows if the grid includes the point at 360 degrees
+    return np.take(rows, np.arange(longitude.size) % period, axis=1)
+
+
 def _igrf_internal(longitude, latitude, height, g, h):
     """
     Internal calculation common to both functions
     """
-    longitude, latitude_gc, radius = bl.WGS84.geodetic_to_spherical(longitude, latitude, height)
-
-    colatitude = np.radians(90 - latitude_gc)
-    longitude_rad = np.radians(longitude)
+    with instrument.stage("coordinate conversion"):
+        latitude_gc, radius = igrf_core.geodetic_to_spherical(latitude, height)
+        colatitude = np.radians(90 - latitude_gc)
+        longitude_rad = np.radians(longitude)
 
     n_max = len(g)
-    p = legendre.associated_legendre_functions(np.cos(colatitude), n_max)
-    dp = legendre.associated_legendre_functions_derivative(p)
-    s = legendre.schmidt_normalization(n_max)
-
-    be, bn_gc, br = 0, 0, 0
-    for n in range(1, n_max + 1):
-        r_frac = (EARTH_RADIUS / radius)**(n + 2)
-        for m in range(0, n + 1):
-            cos = np.cos(m * longitude_rad)
-            sin = np.sin(m * longitude_rad)
-            if m == 0:
-                h[n][m] = 0
-            be += r_frac * (-m * g[n][m] * sin + m * h[n][m] * cos) * s[n][m] * p[n][m]
-            bn_gc += r_frac * (g[n][m] * cos + h[n][m] * sin) * s[n][m] * dp[n][m]
-            br += (n + 1) * r_frac * (g[n][m] * cos + h[n][m] * sin) * s[n][m] * p[n][m]
-    be *= -1 / np.sin(colatitude)
-
-    # Rotate the vector from geocentric to geodetic
-    cos = np.cos(-np.radians(latitude - latitude_gc))
-    sin = np.sin(-np.radians(latitude - latitude_gc))
-    bn = cos * bn_gc + sin * br
-    bu = -sin * bn_gc + cos * br
+    with instrument.stage("legendre recursion"):
+        p = legendre.associated_legendre_functions(np.cos(colatitude), n_max)
+        dp = legendre.associated_legendre_functions_derivative(p)
+        s = legendre.schmidt_normalization(n_max)
+
+    with instrument.stage("series summation"):
+        be, bn_gc, br = 0, 0, 0
+        for n in range(1, n_max + 1):
+            r_frac = (EARTH_RADIUS / radius)**(n + 2)
+            for m in range(0, n + 1):
+                cos = np.cos(m * longitude_rad)
+                sin = np.sin(m * longitude_rad)
+                # There is no h for m=0 (and the cached dicts can't be modified)
+                h_nm = h[n].get(m, 0)
+                be += r_frac * (-m * g[n][m] * sin + m * h_nm * cos) * s[n][m] * p[n][m]
+                bn_gc += r_frac * (g[n][m] * cos + h_nm * sin) * s[n][m] * dp[n][m]
+                br += (n + 1) * r_frac * (g[n][m] * cos + h_nm * sin) * s[n][m] * p[n][m]
+        be *= -1 / np.sin(colatitude)
+
+    with instrument.stage("coordinate conversion"):
+        # Rotate the vector from geocentric to geodetic
+        cos = np.cos(-np.radians(latitude - latitude_gc))
+        sin = np.sin(-np.radians(latitude - latitude_gc))
+        bn = cos * bn_gc + sin * br
+        bu = -sin * bn_gc + cos * br
 
     return be, bn, bu
 
 
-@line_profiler.profile
 def igrf(longitude, latitude, height, date):
     """
     """
-    g_all, h_all, g_sv, h_sv, years = read_coef.read_gauss_coeffs("igrf13coeffs.txt")
-    g, h = coef_date.coef_date(date, g_all, h_all, g_sv, h_sv, years)
+    g, h = coef_cache.coefficients(date)
 
     be, bn, bu = _igrf_internal(longitude, latitude, height, g, h)
     return be, bn, bu
@@ -123,7 +368,121 @@ def test_igrf():
         np.testing.assert_allclose(amp, noaa[year][3], atol=0.2)
 
 
+def test_igrf_batch_still_in_igrf_fast():
+    "Check that the batch function is still available from igrf_fast"
+    assert igrf_batch is igrf_core.igrf_batch
+    be, bn, bu = igrf_batch([45, 45], 45, 0, datetime.datetime(2020, 1, 1))
+    np.testing.assert_allclose(bn, 22182.0, atol=0.2)
+
+
+def test_igrf_grid():
+    "Check that the grid matches the single point calculation"
+    date = datetime.datetime(2022, 7, 1)
+    grid = igrf_grid((-20, 50, -60, 75), spacing=5, height=2000, date=date)
+    assert grid.be.shape == (28, 15)
+    for lat in grid.latitude.values[::3]:
+        for lon in grid.longitude.values[::2]:
+            be, bn, bu = igrf(lon, lat, 2000, date)
+            point = grid.sel(longitude=lon, latitude=lat)
+            np.testing.assert_allclose(point.be, be, atol=0.2)
+            np.testing.assert_allclose(point.bn, bn, atol=0.2)
+            np.testing.assert_allclose(point.bu, bu, atol=0.2)
+
+
+def test_igrf_grid_fft():
+    "Check that the FFT synthesis matches direct summation on global grids"
+    date = datetime.datetime(2019, 3, 1)
+    for region in [(0, 360, -80, 80), (-180, 180, -80, 80), (10, 367, -80, 80)]:
+        direct = igrf_grid(region, spacing=3, height=1000, date=date, method="direct")
+        fft = igrf_grid(region, spacing=3, height=1000, date=date, method="fft")
+        for component in ["be", "bn", "bu"]:
+            np.testing.assert_allclose(fft[component], direct[component], rtol=0, atol=1e-8)
+
+
+def test_igrf_grid_fft_fallback():
+    "Check that partial and coarse grids use direct summation or fail"
+    longitude = np.arange(0, 181, 3.0)
+    assert _fft_period(longitude, n_max=13) is None
+    assert _fft_period(np.arange(0, 361, 3.0), n_max=13) == 120
+    assert _fft_period(np.arange(0, 361, 30.0), n_max=13) is None
+    assert _fft_period(np.array([0, 1, 3, 4.0]), n_max=1) is None
+    date = datetime.datetime(2019, 3, 1)
+    region = (0, 180, -80, 80)
+    auto = igrf_grid(region, spacing=3, height=1000, date=date)
+    direct = igrf_grid(region, spacing=3, height=1000, date=date, method="direct")
+    np.testing.assert_array_equal(auto.be, direct.be)
+    import pytest
+
+    with pytest.raises(ValueError):
+        igrf_grid(region, spacing=3, height=1000, date=date, method="fft")
+    with pytest.raises(ValueError):
+        igrf_grid(region, spacing=3, height=1000, date=date, method="bla")
+
+
+def test_igrf_grid_float32():
+    "Check the float32 grids against float64 with both synthesis methods"
+    date = datetime.datetime(2021, 9, 1)
+    for method in ["direct", "fft"]:
+        grid = igrf_grid((0, 360, -89, 89), spacing=4, height=0, date=date,
+                         method=method, precision="float32")
+        assert all(grid[name].dtype == np.float32 for name in ["be", "bn", "bu"])
+        report = precision_report((0, 360, -89, 89), spacing=4, height=0, date=date,
+                                  method=method)
+        assert report["nbytes"]["float32"] * 2 == report["nbytes"]["float64"]
+        for name in ["be", "bn", "bu", "amplitude"]:
+            assert 0 < report[name]["rms"] <= report[name]["max"] < 0.05
+    import pytest
+
+    with pytest.raises(ValueError):
+        igrf_grid((0, 10, 0, 10), spacing=5, height=0, date=date, precision="float16")
+
+
+def test_igrf_grid_stack():
+    "Check the stack against a grid for each date and the rates against differences"
+    dates = [datetime.datetime(1995, 3, 1), datetime.datetime(2010, 1, 1), datetime.datetime(2024, 8, 15)]
+    region = (0, 360, -80, 80)
+    for method in ["direct", "fft"]:
+        stack = igrf_grid_stack(region, spacing=4, height=500, dates=dates, method=method)
+        assert stack.be.dims == ("time", "latitude", "longitude")
+        assert stack.be.shape == (3, 41, 91)
+        for i, date in enumerate(dates):
+            grid = igrf_grid(region, spacing=4, height=500, date=date, method=method)
+            for component in ["be", "bn", "bu"]:
+                np.testing.assert_allclose(stack[component][i], grid[component], rtol=1e-12, atol=1e-8)
+    years = np.array([1987.3, 2003.9, 2022.5])
+    stack = igrf_grid_stack(region, spacing=10, height=0, dates=years, secular_variation=True)
+    after = igrf_grid_stack(region, spacing=10, height=0, dates=years + 0.01)
+    before = igrf_grid_stack(region, spacing=10, height=0, dates=years - 0.01)
+    for component in ["be", "bn", "bu"]:
+        np.testing.assert_allclose(
+            stack[f"{component}_sv"], (after[component].values - before[component].values) / 0.02, atol=1e-6,
+        )
+        assert np.abs(stack[f"{component}_sv"]).max() > 10
+
+
+def test_instrumented_stages():
+    "Check that all stages of a grid are recorded when instrumenting"
+    coef_cache.clear_cache()
+    with instrument.recording():
+        igrf_grid((0, 360, -80, 80), spacing=10, height=0, date=datetime.datetime(2020, 1, 1))
+    stats = instrument.results()
+    stages = [
+        "coefficient load",
+        "date interpolation",
+        "coordinate conversion",
+        "legendre recursion",
+        "series summation",
+        "dataset assembly",
+    ]
+    assert sorted(stats) == sorted(stages)
+    assert stats["coefficient load"]["calls"] == 1
+    assert stats["dataset assembly"]["calls"] == 1
+    assert stats["coordinate conversion"]["calls"] == 2
+
+
 if __name__ == "__main__":
+    import pygmt
+
     start = time.time()
     grid = igrf_grid((0, 360, -90, 90), spacing=3, height=1000, date=datetime.datetime.today())
     print(f"{time.time() - start} s")
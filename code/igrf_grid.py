@@ -5,8 +5,8 @@ import datetime
 import numpy as np
 import xarray as xr
 import verde as vd
-import pygmt
-import igrf
+import coef_cache
+import igrf_fast
 
 
 def igrf_grid(region, spacing, height, date):
@@ -15,17 +15,8 @@ def igrf_grid(region, spacing, height, date):
     """
     longitude, latitude = vd.grid_coordinates(region, spacing=spacing, meshgrid=False)
 
-    shape = (latitude.size, longitude.size)
-    be = np.zeros(shape)
-    bn = np.zeros(shape)
-    bu = np.zeros(shape)
-
-    for i, lat in enumerate(latitude):
-        for j, lon in enumerate(longitude):
-            be_point, bn_point, bu_point = igrf.igrf(lon, lat, height, date)
-            be[i, j] = be_point
-            bn[i, j] = bn_point
-            bu[i, j] = bu_point
+    g, h = coef_cache.coefficients(date)
+    be, bn, bu = igrf_fast._igrf_grid_internal(longitude, latitude, height, g, h)
 
     dims = ("latitude", "longitude")
     grid = xr.Dataset(
@@ -40,6 +31,8 @@ def igrf_grid(region, spacing, height, date):
 
 
 if __name__ == "__main__":
+    import pygmt
+
     grid = igrf_grid((0, 360, -90, 90), spacing=3, height=1000, date=datetime.datetime.today())
     print(grid)
     grid["amplitude"] = np.sqrt(grid.be**2 + grid.bn**2 + grid.bu**2)
@@ -0,0 +1,261 @@
+"""
+Compiled kernel of the IGRF series using Numba
+
+Fuses the Legendre recursion, the sines and cosines of the orders, and the
+sums over degree and order into a single loop per point that runs in
+parallel over the points without holding the GIL. Used by igrf_core when the "numba" backend is
+selected. Without Numba the module still imports (so that its tests are
+collected and skipped) but AVAILABLE is False, the kernels are plain Python,
+and igrf_core doesn't offer the "numba" backend.
+"""
+import math
+import numpy as np
+
+import legendre
+import igrf_point
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+AVAILABLE = numba is not None
+
+
+# Legendre functions are calculated divided by sin(theta)^m and multiplied
+# by 1e-280 (Holmes and Featherstone, 2002). This is log(1e280).
+SCALE_LOG = 280 * math.log(10)
+
+
+def _jit(**options):
+    """
+    Compile with numba.njit and the options, or leave as Python without Numba
+    """
+    if numba is None:
+        return lambda function: function
+    return numba.njit(**options)
+
+
+_prange = range if numba is None else numba.prange
+
+
+def series(longitude_rad, colatitude, radius, g, h, earth_radius):
+    """
+    Calculate Be, Bn, Br in geocentric coordinates for 1D arrays of points
+
+    Takes coefficient arrays indexed by [n, m] or by [point, n, m] to use
+    different coefficients for each point. Bn is the geocentric north
+    component (before rotating to geodetic).
+    """
+    n_max = g.shape[-1] - 1
+    a, b, sectoral, _, _ = legendre.schmidt_recursion_tables(n_max)
+    if g.ndim == 2:
+        g = g[np.newaxis]
+        h = h[np.newaxis]
+    return _series(
+        np.ascontiguousarray(longitude_rad, dtype="float64"),
+        np.ascontiguousarray(colatitude, dtype="float64"),
+        np.ascontiguousarray(radius, dtype="float64"),
+        np.ascontiguousarray(g, dtype="float64"),
+        np.ascontiguousarray(h, dtype="float64"),
+        a, b, sectoral, earth_radius,
+    )
+
+
+@_jit(parallel=True, nogil=True, cache=True)
+def _series(longitude_rad, colatitude, radius, g, h, a, b, sectoral, earth_radius):
+    """
+    Sum the series order by order for each point
+
+    For each order, P_n^m / sin^m and its derivative are calculated with the
+    recursion in n and summed. The sums are then multiplied by sin^m (or
+    sin^(m-1) for the terms that are divided by sin), which keeps Be finite
+    at the poles.
+    """
+    n_max = g.shape[-1] - 1
+    n_points = longitude_rad.size
+    be = np.empty(n_points)
+    bn = np.empty(n_points)
+    br = np.empty(n_points)
+    # All points use the same coefficients if there's only one set
+    stride = 1 if g.shape[0] > 1 else 0
+    for i in _prange(n_points):
+        j = i * stride
+        x = math.cos(colatitude[i])
+        u = math.sin(colatitude[i])
+        log_u = math.log(u) if u > 0 else -math.inf
+        ratio = earth_radius / radius[i]
+        cos_1 = math.cos(longitude_rad[i])
+        sin_1 = math.sin(longitude_rad[i])
+        cos_m = 1.0
+        sin_m = 0.0
+        # (R/r)^(m + 2) for the first degree of each order
+        r_frac_m = ratio * ratio
+        be_i = 0.0
+        bn_i = 0.0
+        br_i = 0.0
+        for m in range(n_max + 1):
+            # Sums of the terms that multiply sin^m and sin^(m-1)
+            be_sum = 0.0
+            bn_sum = 0.0
+            bn_sum_lower = 0.0
+            br_sum = 0.0
+            p_1 = 0.0
+            p_2 = 0.0
+            dp_1 = 0.0
+            dp_2 = 0.0
+            r_frac = r_frac_m
+            for n in range(m, n_max + 1):
+                if n == m:
+                    p = 1e-280 * sectoral[m]
+                    dp = 0.0
+                else:
+                    p = a[n, m] * x * p_1 - b[n, m] * p_2
+                    dp = a[n, m] * (x * dp_1 - u * p_1) - b[n, m] * dp_2
+                if n > 0:
+                    g_cos = g[j, n, m] * cos_m + h[j, n, m] * sin_m
+                    g_sin = h[j, n, m] * cos_m - g[j, n, m] * sin_m
+                    be_sum += r_frac * m * g_sin * p
+                    bn_sum += r_frac * g_cos * dp
+                    bn_sum_lower += r_frac * m * x * g_cos * p
+                    br_sum += r_frac * (n + 1) * g_cos * p
+                p_2 = p_1
+                p_1 = p
+                dp_2 = dp_1
+                dp_1 = dp
+                r_frac *= ratio
+            # sin^m * 1e280 and sin^(m-1) * 1e280 in log space to avoid
+            # underflow and overflow
+            factor = math.exp(SCALE_LOG + m * log_u) if m > 0 else math.exp(SCALE_LOG)
+            bn_i += factor * bn_sum
+            br_i += factor * br_sum
+            if m > 0:
+                factor_lower = math.exp(SCALE_LOG + (m - 1) * log_u) if m > 1 else math.exp(SCALE_LOG)
+                be_i += factor_lower * be_sum
+                bn_i += factor_lower * bn_sum_lower
+            # Angle addition to get cos and sin of (m + 1) lon
+            cos_m, sin_m = cos_m * cos_1 - sin_m * sin_1, sin_m * cos_1 + cos_m * sin_1
+            r_frac_m *= ratio
+        be[i] = -be_i
+        bn[i] = bn_i
+        br[i] = br_i
+    return be, bn, br
+
+
+# Field of a single point without allocating (see igrf_point.PointEvaluator)
+point_series = _jit(cache=True)(igrf_point._point_series)
+
+
+def interpolate(values, lat_position, lon_position, height_position, n_nodes):
+    """
+    Interpolate a table of Be, Bn, Bu with shape (latitude, longitude, height, 3)
+
+    Positions are in units of nodes from the first one. Uses the Lagrange
+    polynomials through the *n_nodes* (2 or 4) nearest nodes in each
+    direction, shifted inwards at the ends, like igrf_table._stencil.
+    """
+    return _interpolate(
+        np.asarray(values),
+        np.ascontiguousarray(lat_position, dtype="float64"),
+        np.ascontiguousarray(lon_position, dtype="float64"),
+        np.ascontiguousarray(height_position, dtype="float64"),
+        n_nodes,
+    )
+
+
+@_jit(cache=True)
+def _lagrange(position, size, n_nodes):
+    """
+    Index of the first node and the weights of the nodes as a tuple
+    """
+    start = min(max(int(math.floor(position)) - (n_nodes // 2 - 1), 0), size - n_nodes)
+    x = position - start
+    if n_nodes == 2:
+        return start, (1 - x, x, 0.0, 0.0)
+    return start, (
+        -(x - 1) * (x - 2) * (x - 3) / 6,
+        x * (x - 2) * (x - 3) / 2,
+        -x * (x - 1) * (x - 3) / 2,
+        x * (x - 1) * (x - 2) / 6,
+    )
+
+
+@_jit(parallel=True, nogil=True, cache=True)
+def _interpolate(values, lat_position, lon_position, height_position, n_nodes):
+    """
+    Sum the weighted nodes around each point
+
+    The weights are tuples instead of arrays because Numba would hoist the
+    allocation of arrays out of the parallel loop and share them between
+    threads.
+    """
+    n_lat, n_lon, n_height, _ = values.shape
+    n_points = lat_position.size
+    result = np.empty((n_points, 3))
+    for p in _prange(n_points):
+        i0, lat_weights = _lagrange(lat_position[p], n_lat, n_nodes)
+        j0, lon_weights = _lagrange(lon_position[p], n_lon, n_nodes)
+        k0, height_weights = _lagrange(height_position[p], n_height, n_nodes)
+        be = 0.0
+        bn = 0.0
+        bu = 0.0
+        for i in range(n_nodes):
+            for j in range(n_nodes):
+                weight = lat_weights[i] * lon_weights[j]
+                for k in range(n_nodes):
+                    node_weight = weight * height_weights[k]
+                    be += node_weight * values[i0 + i, j0 + j, k0 + k, 0]
+                    bn += node_weight * values[i0 + i, j0 + j, k0 + k, 1]
+                    bu += node_weight * values[i0 + i, j0 + j, k0 + k, 2]
+        result[p, 0] = be
+        result[p, 1] = bn
+        result[p, 2] = bu
+    return result
+
+
+def test_series_matches_legendre():
+    "Check the kernel against the NumPy Legendre functions at high degree"
+    import pytest
+
+    pytest.importorskip("numba")
+    rng = np.random.default_rng(5)
+    n_max = 300
+    g = np.tril(rng.normal(size=(n_max + 1, n_max + 1))) / np.arange(1, n_max + 2)[:, np.newaxis]**2
+    h = np.tril(rng.normal(size=(n_max + 1, n_max + 1))) / np.arange(1, n_max + 2)[:, np.newaxis]**2
+    h[:, 0] = 0
+    colatitude = np.radians([0.5, 10, 45, 90, 135, 179])
+    longitude_rad = np.radians([0, 30, 100, 200, 300, 359])
+    radius = np.full(6, 6371.2e3)
+    be, bn, br = series(longitude_rad, colatitude, radius, g, h, 6371.2e3)
+
+    p, dp = legendre.schmidt_legendre(np.cos(colatitude), n_max)
+    n = np.arange(n_max + 1)[:, np.newaxis, np.newaxis]
+    m = np.arange(n_max + 1)[np.newaxis, :, np.newaxis]
+    cos = np.cos(m * longitude_rad)
+    sin = np.sin(m * longitude_rad)
+    gc = g[:, :, np.newaxis] * cos + h[:, :, np.newaxis] * sin
+    gs = h[:, :, np.newaxis] * cos - g[:, :, np.newaxis] * sin
+    degree_one = n > 0
+    np.testing.assert_allclose(br, ((n + 1) * gc * p * degree_one).sum(axis=(0, 1)), rtol=1e-10)
+    np.testing.assert_allclose(bn, (gc * dp * degree_one).sum(axis=(0, 1)), rtol=1e-10)
+    np.testing.assert_allclose(
+        be, -(m * gs * p * degree_one).sum(axis=(0, 1)) / np.sin(colatitude), rtol=1e-10,
+    )
+
+
+def test_series_pole():
+    "Check that the field is finite at the poles"
+    import pytest
+
+    pytest.importorskip("numba")
+    g = np.zeros((3, 3))
+    h = np.zeros((3, 3))
+    g[1, 1] = 1
+    h[2, 1] = 1
+    be, bn, br = series(
+        np.zeros(2), np.array([0, np.pi]), np.full(2, 1.0), g, h, 1.0,
+    )
+    assert np.all(np.isfinite(be))
+    assert np.all(np.isfinite(bn))
+    np.testing.assert_allclose(br, 0, atol=1e-15)
@@ -0,0 +1,107 @@
+"""
+Calculate IGRF grids in parallel by splitting them into latitude bands
+"""
+import os
+import time
+import datetime
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import verde as vd
+
+import coef_cache
+import igrf_core
+import igrf_fast
+
+
+# Coefficients of the current worker process, set once by _init_worker
+_worker_coefs = {}
+
+
+def igrf_grid_parallel(region, spacing, height, date, method="auto", workers=None, band_size=None):
+    """
+    Make a grid of Be, Bn, Bu using a pool of processes.
+
+    The grid is split into bands of about *band_size* latitude rows (by
+    default enough for about 4 bands per worker) that are calculated in
+    *workers* processes (by default one per CPU). Band sizes are rounded up to
+    a multiple of the block of rows used by igrf_fast.igrf_grid so that the
+    result is identical to it.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    g, h = igrf_core.coef_arrays(*coef_cache.coefficients(date))
+
+    longitude, latitude = vd.grid_coordinates(region, spacing=spacing, meshgrid=False)
+
+    if band_size is None:
+        band_size = int(np.ceil(latitude.size / (4 * workers)))
+    # Bands must be made of whole blocks of rows of the serial calculation so
+    # that the results are identical
+    block = igrf_fast._grid_block_rows(g.shape[0] - 1)
+    band_size = block * max(1, int(np.ceil(band_size / block)))
+    bands = [
+        latitude[start:start + band_size]
+        for start in range(0, latitude.size, band_size)
+    ]
+    # The coefficients are sent only once to each worker instead of once per
+    # band. Workers are spawned instead of forked because forking after the
+    # threads of the Numba backend have started can deadlock.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(g, h),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        results = list(
+            executor.map(
+                _grid_band,
+                [longitude] * len(bands),
+                bands,
+                [height] * len(bands),
+                [method] * len(bands),
+            )
+        )
+    be, bn, bu = [np.concatenate(component) for component in zip(*results)]
+    return igrf_fast._grid_dataset(longitude, latitude, be, bn, bu)
+
+
+def _init_worker(g, h):
+    """
+    Store the coefficient arrays in the worker process
+    """
+    _worker_coefs["g"] = g
+    _worker_coefs["h"] = h
+
+
+def _grid_band(longitude, latitude, height, method):
+    """
+    Calculate one band of the grid in a worker process
+    """
+    return igrf_fast._igrf_grid_internal(
+        longitude, latitude, height, _worker_coefs["g"], _worker_coefs["h"], method,
+    )
+
+
+def test_parallel_matches_serial():
+    "Check that the parallel grid is identical to the serial one"
+    date = datetime.datetime(2021, 5, 1)
+    cases = [((0, 360, -80, 80), 1, 50), ((-30, 40, -20, 35), 0.5, None)]
+    for region, spacing, band_size in cases:
+        serial = igrf_fast.igrf_grid(region, spacing=spacing, height=1000, date=date)
+        parallel = igrf_grid_parallel(
+            region, spacing=spacing, height=1000, date=date, workers=2, band_size=band_size,
+        )
+        assert parallel.be.dims == serial.be.dims
+        np.testing.assert_array_equal(parallel.longitude, serial.longitude)
+        np.testing.assert_array_equal(parallel.latitude, serial.latitude)
+        for component in ["be", "bn", "bu"]:
+            np.testing.assert_array_equal(parallel[component], serial[component])
+
+
+if __name__ == "__main__":
+    date = datetime.datetime(2023, 1, 1)
+    start = time.time()
+    grid = igrf_fast.igrf_grid((0, 360, -90, 90), spacing=0.1, height=1000, date=date)
+    print(f"serial: {time.time() - start} s")
+    start = time.time()
+    grid = igrf_grid_parallel((0, 360, -90, 90), spacing=0.1, height=1000, date=date)
+    print(f"parallel: {time.time() - start} s")
@@ -0,0 +1,208 @@
+"""
+Evaluate the field at one point at a time with preallocated buffers
+
+For loops that follow a single moving point and call the field thousands of
+times per second. The evaluator keeps the coefficients of the current date
+and the recursion tables sized to n_max, and each call writes Be, Bn, Bu to
+the same output array. Example:
+
+    evaluator = PointEvaluator(datetime.datetime(2024, 5, 1))
+    for longitude, latitude, height in positions:
+        be, bn, bu = evaluator(longitude, latitude, height)
+"""
+import math
+import numpy as np
+
+import coef_cache
+import igrf_core
+import legendre
+
+
+EARTH_RADIUS = igrf_core.EARTH_RADIUS
+SEMIMAJOR_AXIS = igrf_core.SEMIMAJOR_AXIS
+ECCENTRICITY_SQUARED = igrf_core.ECCENTRICITY_SQUARED
+# Backends of the evaluator. The non-compiled kernel is plain Python, so
+# it's "python" and not "numpy" like in igrf_core.
+BACKENDS = ("auto", "python", "numba")
+# Legendre functions are calculated divided by sin(theta)^m and multiplied
+# by 1e-280 as in igrf_numba. This is log(1e280).
+SCALE_LOG = 280 * math.log(10)
+
+
+class PointEvaluator:
+    """
+    Field of single geodetic points for the coefficients of a date
+
+    With the "numba" backend each call runs a compiled kernel that only
+    uses scalars and the buffers of the evaluator, so nothing is allocated
+    per call. The "python" backend runs the same kernel as plain Python on
+    lists and doesn't use NumPy ("numpy" is accepted as another name for it
+    so that the backends of igrf_core can be used). "auto" picks "numba" if
+    Numba is installed. Change the date with set_date, which reuses the
+    buffers.
+    """
+
+    def __init__(self, date, backend="auto", path="igrf13coeffs.txt"):
+        self.backend = select_backend(backend)
+        self.path = path
+        model = coef_cache.load_model(path)
+        self.n_max = model.n_max
+        self.g = np.zeros((self.n_max + 1, self.n_max + 1))
+        self.h = np.zeros((self.n_max + 1, self.n_max + 1))
+        self.out = np.empty(3)
+        a, b, sectoral, _, _ = legendre.schmidt_recursion_tables(self.n_max)
+        if self.backend == "numba":
+            import igrf_numba
+
+            self._kernel = igrf_numba.point_series
+            self._a, self._b, self._sectoral = a, b, sectoral
+        else:
+            self._kernel = _point_series
+            self._a, self._b, self._sectoral = a.tolist(), b.tolist(), sectoral.tolist()
+            self.out = [0.0, 0.0, 0.0]
+        self.date = None
+        self.set_date(date)
+
+    def set_date(self, date):
+        """
+        Copy the coefficients of a date into the buffers
+        """
+        g, h = igrf_core.coef_arrays(*coef_cache.coefficients(date, self.path))
+        self.g[...] = g
+        self.h[...] = h
+        if self.backend == "numba":
+            self._g, self._h = self.g, self.h
+        else:
+            self._g, self._h = self.g.tolist(), self.h.tolist()
+        self.date = date
+
+    def __call__(self, longitude, latitude, height):
+        """
+        Calculate Be, Bn, Bu (nT) at a geodetic point (degrees and meters)
+
+        Returns the output buffer, which the next call overwrites. Copy it
+        to keep the values.
+        """
+        self._kernel(
+            float(longitude), float(latitude), float(height), self._g, self._h,
+            self._a, self._b, self._sectoral, self.out,
+        )
+        return self.out
+
+
+def select_backend(backend):
+    """
+    Resolve the backend of PointEvaluator to "python" or "numba"
+    """
+    if backend == "numpy":
+        backend = "python"
+    if backend not in BACKENDS:
+        raise ValueError(f"Invalid backend '{backend}'. Must be one of {BACKENDS}.")
+    if backend == "python":
+        return backend
+    core_backend = igrf_core.select_backend(backend)
+    return "numba" if core_backend == "numba" else "python"
+
+
+def _point_series(longitude, latitude, height, g, h, a, b, sectoral, out):
+    """
+    Sum the series for one geodetic point and write Be, Bn, Bu to out
+
+    Same recursion and sums as igrf_numba._series, order by order so that
+    only the last two Legendre functions are kept. igrf_numba compiles this
+    function too, so it must only use scalars and indexing.
+    """
+    n_max = len(g) - 1
+    sin_lat = math.sin(math.radians(latitude))
+    cos_lat = math.cos(math.radians(latitude))
+    prime_radius = SEMIMAJOR_AXIS / math.sqrt(1 - ECCENTRICITY_SQUARED * sin_lat * sin_lat)
+    xy_projection = (height + prime_radius) * cos_lat
+    z_cartesian = (height + (1 - ECCENTRICITY_SQUARED) * prime_radius) * sin_lat
+    radius = math.sqrt(xy_projection * xy_projection + z_cartesian * z_cartesian)
+    # Cosine and sine of the colatitude
+    x = z_cartesian / radius
+    u = xy_projection / radius
+    log_u = math.log(u) if u > 0 else -math.inf
+    ratio = EARTH_RADIUS / radius
+    cos_1 = math.cos(math.radians(longitude))
+    sin_1 = math.sin(math.radians(longitude))
+    cos_m = 1.0
+    sin_m = 0.0
+    r_frac_m = ratio * ratio
+    be = 0.0
+    bn_gc = 0.0
+    br = 0.0
+    for m in range(n_max + 1):
+        be_sum = 0.0
+        bn_sum = 0.0
+        bn_sum_lower = 0.0
+        br_sum = 0.0
+        p_1 = 0.0
+        p_2 = 0.0
+        dp_1 = 0.0
+        dp_2 = 0.0
+        r_frac = r_frac_m
+        for n in range(m, n_max + 1):
+            if n == m:
+                p = 1e-280 * sectoral[m]
+                dp = 0.0
+            else:
+                p = a[n][m] * x * p_1 - b[n][m] * p_2
+                dp = a[n][m] * (x * dp_1 - u * p_1) - b[n][m] * dp_2
+            if n > 0:
+                g_cos = g[n][m] * cos_m + h[n][m] * sin_m
+                g_sin = h[n][m] * cos_m - g[n][m] * sin_m
+                be_sum += r_frac * m * g_sin * p
+                bn_sum += r_frac * g_cos * dp
+                bn_sum_lower += r_frac * m * x * g_cos * p
+                br_sum += r_frac * (n + 1) * g_cos * p
+            p_2 = p_1
+            p_1 = p
+            dp_2 = dp_1
+            dp_1 = dp
+            r_frac *= ratio
+        factor = math.exp(SCALE_LOG + m * log_u) if m > 0 else math.exp(SCALE_LOG)
+        bn_gc += factor * bn_sum
+        br += factor * br_sum
+        if m > 0:
+            factor_lower = math.exp(SCALE_LOG + (m - 1) * log_u) if m > 1 else math.exp(SCALE_LOG)
+            be += factor_lower * be_sum
+            bn_gc += factor_lower * bn_sum_lower
+        cos_m, sin_m = cos_m * cos_1 - sin_m * sin_1, sin_m * cos_1 + cos_m * sin_1
+        r_frac_m *= ratio
+    # Rotate from geocentric to geodetic by the difference of the latitudes
+    cos_difference = cos_lat * u + sin_lat * x
+    sin_difference = sin_lat * u - cos_lat * x
+    out[0] = -be
+    out[1] = cos_difference * bn_gc - sin_difference * br
+    out[2] = sin_difference * bn_gc + cos_difference * br
+
+
+def test_point_evaluator():
+    "Check against the batch calculation for both backends and changing dates"
+    import datetime
+    import pytest
+
+    rng = np.random.default_rng(8)
+    longitude = rng.uniform(-180, 180, 20)
+    latitude = np.append(rng.uniform(-90, 90, 18), [90, -90])
+    height = rng.uniform(0, 1e6, 20)
+    backends = ["python"] + [b for b in igrf_core.available_backends() if b == "numba"]
+    assert select_backend("numpy") == "python"
+    assert select_backend("auto") == backends[-1]
+    with pytest.raises(ValueError):
+        select_backend("fortran")
+    for backend in backends:
+        evaluator = PointEvaluator(datetime.datetime(2020, 1, 1), backend=backend)
+        assert evaluator.backend == backend
+        for date in [datetime.datetime(2020, 1, 1), datetime.datetime(1965, 7, 15)]:
+            evaluator.set_date(date)
+            expected = igrf_core.igrf_batch(longitude, latitude, height, date)
+            values = np.array([
+                np.copy(evaluator(*point)) for point in zip(longitude, latitude, height)
+            ])
+            np.testing.assert_allclose(values, np.transpose(expected), rtol=1e-10, atol=1e-8)
+        result = evaluator(45, 45, 0)
+        assert evaluator(0, 0, 0) is result
+    evaluator = PointEvaluator(datetime.datetime(2020, 1, 1))
+    np.testing.assert_allclose(evaluator(45, 45, 0), [3093.0, 22182.0, -45757.6], atol=0.2)
@@ -0,0 +1,481 @@
+"""
+Local server that answers IGRF queries and batches concurrent requests
+
+Keeps the coefficients and caches in memory between queries. Requests that
+arrive within *window* seconds of each other are evaluated together in one
+call to igrf_core.igrf_track and the results are sent back to each caller.
+The protocol is one JSON object per line over TCP on localhost:
+
+    {"longitude": 45, "latitude": [10, 20], "height": 0, "date": "2021-03-01"}
+    -> {"be": [...], "bn": [...], "bu": [...]}
+    {"command": "stats"}
+    -> {"requests": ..., "latency_ms": {...}, "batch_requests": {...}, ...}
+
+Dates are ISO dates or decimal years. Run with:
+
+    python igrf_server.py --port 8765
+"""
+import json
+import time
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+import numpy as np
+
+import coef_cache
+import igrf_core
+import igrf_cli
+
+
+class IGRFServer:
+    """
+    Server that evaluates the requests received within *window* seconds in
+    one batch of at most *max_points* points (more if a single request is
+    larger). Statistics are kept for the last *history* requests and batches.
+    Each connection has at most *max_pending* requests in progress. Past
+    that, the server stops reading from it until responses are sent. Use it
+    as an async context manager or call start and close.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, window=0.002, max_points=100_000,
+                 backend="auto", path="igrf13coeffs.txt", history=10_000, max_pending=1000):
+        self.host = host
+        self.port = port
+        self.window = window
+        self.max_points = max_points
+        self.backend = igrf_core.select_backend(backend)
+        self.path = path
+        self.max_pending = max_pending
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self._latencies = collections.deque(maxlen=history)
+        self._batch_requests = collections.deque(maxlen=history)
+        self._batch_points = collections.deque(maxlen=history)
+        self._queue = None
+        self._server = None
+        self._batcher = None
+        self._executor = None
+
+    async def start(self):
+        """
+        Load the model, compile the kernels, and start listening
+        """
+        coef_cache.load_model(self.path)
+        # Compile here so that the thread pool of Numba is started by this
+        # thread. Started from the worker thread, it hangs at exit.
+        self._warm_up()
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="igrf-batch")
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch_loop())
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        """
+        Stop listening and cancel the batches in progress
+        """
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown()
+
+    async def serve_forever(self):
+        """
+        Answer requests until cancelled (for example, by Ctrl+C)
+        """
+        await self._server.serve_forever()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exception):
+        await self.close()
+
+    def _warm_up(self):
+        igrf_core.igrf_track(0, 0, 0, np.array([2020.0]), backend=self.backend, path=self.path)
+
+    def stats(self):
+        """
+        Counters, latency percentiles (ms) of all requests including the
+        failed ones, and the sizes of the batches
+        """
+        latencies = np.array(self._latencies) * 1e3
+        result = {
+            "requests": self.requests,
+            "errors": self.errors,
+            "batches": self.batches,
+            "latency_ms": None,
+            "batch_requests": None,
+            "batch_points": None,
+        }
+        if latencies.size:
+            result["latency_ms"] = {
+                f"p{q}": float(np.percentile(latencies, q)) for q in (50, 90, 99)
+            }
+            result["latency_ms"]["max"] = float(latencies.max())
+        for name in ["batch_requests", "batch_points"]:
+            sizes = np.array(getattr(self, f"_{name}"))
+            if sizes.size:
+                result[name] = {"mean": float(sizes.mean()), "max": int(sizes.max())}
+        return result
+
+    async def _handle_connection(self, reader, writer):
+        """
+        Read requests line by line and write the responses in the same order
+
+        Each line is answered by its own task so that the requests of a
+        client that doesn't wait for the responses are batched together. The
+        queue of tasks is bounded, so a client that sends faster than it
+        reads is slowed down instead of growing the queue without limit.
+        """
+        responses = asyncio.Queue(maxsize=self.max_pending)
+
+        async def write_responses():
+            while True:
+                task = await responses.get()
+                if task is None:
+                    break
+                writer.write(json.dumps(await task).encode() + b"\n")
+                await writer.drain()
+
+        writing = asyncio.create_task(write_responses())
+        try:
+            while line := await reader.readline():
+                await responses.put(asyncio.create_task(self._respond(line)))
+            await responses.put(None)
+            await writing
+        except ConnectionError:
+            writing.cancel()
+        finally:
+            writer.close()
+
+    async def _respond(self, line):
+        """
+        Answer a single request
+        """
+        start = time.perf_counter()
+        # The latency of failed requests counts too but not of stats commands
+        timed = True
+        try:
+            request = json.loads(line)
+            if request.get("command") == "stats":
+                timed = False
+                return self.stats()
+            response = await self._evaluate(request)
+        except Exception as error:
+            self.errors += 1
+            return {"error": f"{type(error).__name__}: {error}"}
+        finally:
+            if timed:
+                self._latencies.append(time.perf_counter() - start)
+        self.requests += 1
+        return response
+
+    async def _evaluate(self, request):
+        """
+        Queue the points of a request and wait for its batch
+        """
+        longitude, latitude, height = np.broadcast_arrays(
+            *[np.asarray(request[name], dtype="float64") for name in ("longitude", "latitude", "height")]
+        )
+        date = np.datetime64(igrf_cli.parse_date(str(request["date"])), "us")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((longitude, latitude, height, date, future))
+        be, bn, bu = await future
+        return {
+            "be": be.reshape(longitude.shape).tolist(),
+            "bn": bn.reshape(longitude.shape).tolist(),
+            "bu": bu.reshape(longitude.shape).tolist(),
+        }
+
+    async def _batch_loop(self):
+        """
+        Gather the queued requests over the window and evaluate them together
+
+        Batches are evaluated one at a time in a worker thread so that the
+        event loop keeps accepting connections and answering stats while a
+        large batch runs. Requests that arrive meanwhile wait in the queue
+        for the next batch.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            points = batch[0][0].size
+            deadline = loop.time() + self.window
+            while points < self.max_points:
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                points += item[0].size
+            results = await loop.run_in_executor(self._executor, self._evaluate_batch, batch)
+            self.batches += 1
+            self._batch_requests.append(len(batch))
+            self._batch_points.append(points)
+            for (*_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _evaluate_batch(self, batch):
+        """
+        Calculate the field of all requests in a batch in one call
+
+        If it fails (for example, a date out of range), each request is
+        calculated alone so that only the bad ones get the error.
+        """
+        try:
+            return self._split(batch, self._track(batch))
+        except Exception:
+            if len(batch) == 1:
+                return [self._track_or_error(batch)]
+            return [self._track_or_error([item]) for item in batch]
+
+    def _track_or_error(self, batch):
+        try:
+            return self._track(batch)
+        except Exception as error:
+            return error
+
+    def _track(self, batch):
+        longitude = np.concatenate([item[0].ravel() for item in batch])
+        latitude = np.concatenate([item[1].ravel() for item in batch])
+        height = np.concatenate([item[2].ravel() for item in batch])
+        times = np.concatenate([np.full(item[0].size, item[3]) for item in batch])
+        return igrf_core.igrf_track(
+            longitude, latitude, height, times, backend=self.backend, path=self.path,
+        )
+
+    def _split(self, batch, components):
+        sections = np.cumsum([item[0].size for item in batch])[:-1]
+        return list(zip(*[np.split(component, sections) for component in components]))
+
+
+class Client:
+    """
+    Connection to an IGRFServer that can have many queries in flight
+
+    Responses come back in the order of the requests, so each query waits
+    for the next response in line.
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._pending = collections.deque()
+        self._reading = asyncio.create_task(self._read_responses())
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=8765):
+        """
+        Open a connection to a server
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def query(self, longitude, latitude, height, date):
+        """
+        Get Be, Bn, Bu for points and a date (ISO string, datetime, or year)
+
+        Raises RuntimeError with the message of the server if it fails.
+        """
+        if hasattr(date, "isoformat"):
+            date = date.isoformat()
+        request = {
+            "longitude": np.asarray(longitude).tolist(),
+            "latitude": np.asarray(latitude).tolist(),
+            "height": np.asarray(height).tolist(),
+            "date": date,
+        }
+        response = await self._send(request)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["be"], response["bn"], response["bu"]
+
+    async def stats(self):
+        """
+        Statistics of the server (see IGRFServer.stats)
+        """
+        return await self._send({"command": "stats"})
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        self._reading.cancel()
+
+    async def _send(self, request):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        self._writer.write(json.dumps(request).encode() + b"\n")
+        await self._writer.drain()
+        return await future
+
+    async def _read_responses(self):
+        while line := await self._reader.readline():
+            self._pending.popleft().set_result(json.loads(line))
+        while self._pending:
+            self._pending.popleft().set_exception(ConnectionError("Server closed the connection."))
+
+
+def main(argv=None):
+    """
+    Run the server until interrupted
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--window", type=float, default=0.002, help="Batching window in seconds")
+    parser.add_argument("--backend", default="auto", choices=igrf_core.BACKENDS)
+    args = parser.parse_args(argv)
+
+    async def serve():
+        async with IGRFServer(args.host, args.port, args.window, backend=args.backend) as server:
+            print(f"Listening on {server.host}:{server.port}", flush=True)
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+def test_concurrent_queries_batched():
+    "Check that concurrent clients are batched and get their own results"
+    import datetime
+
+    rng = np.random.default_rng(3)
+    longitude = rng.uniform(-180, 180, (20, 3))
+    latitude = rng.uniform(-89, 89, (20, 3))
+    dates = [datetime.datetime(2000 + i, 6, 1) for i in range(20)]
+
+    async def run():
+        async with IGRFServer(window=0.05) as server:
+            clients = [await Client.connect(port=server.port) for _ in range(20)]
+            results = await asyncio.gather(*[
+                client.query(longitude[i], latitude[i], 100, dates[i])
+                for i, client in enumerate(clients)
+            ])
+            stats = await clients[0].stats()
+            for client in clients:
+                await client.close()
+        return results, stats
+
+    results, stats = asyncio.run(run())
+    for i, result in enumerate(results):
+        expected = igrf_core.igrf_batch(longitude[i], latitude[i], 100, dates[i])
+        for component, value in zip(result, expected):
+            np.testing.assert_allclose(component, value, rtol=1e-10)
+    assert stats["requests"] == 20
+    assert stats["batches"] < 20
+    assert stats["batch_requests"]["max"] > 1
+    assert stats["batch_points"]["max"] == 3 * stats["batch_requests"]["max"]
+    latency = stats["latency_ms"]
+    assert 0 < latency["p50"] <= latency["p90"] <= latency["p99"] <= latency["max"]
+
+
+def test_errors_and_pipelining():
+    "Check that bad requests only fail themselves and responses keep their order"
+    async def run():
+        async with IGRFServer(window=0.05) as server:
+            client = await Client.connect(port=server.port)
+            queries = [
+                client.query(45, 45, 0, "2020-01-01"),
+                client.query(45, 45, 0, "1800-01-01"),
+                client.query([45, 45], 45, 0, 2021.0),
+            ]
+            results = await asyncio.gather(*queries, return_exceptions=True)
+            reader, writer = await asyncio.open_connection(port=server.port)
+            writer.write(b"not json\n")
+            response = json.loads(await reader.readline())
+            writer.close()
+            stats = await client.stats()
+            await client.close()
+        return results, response, stats
+
+    results, response, stats = asyncio.run(run())
+    assert response["error"].startswith("JSONDecodeError")
+    np.testing.assert_allclose(results[0][0], 3093.0, atol=0.2)
+    assert isinstance(results[1], RuntimeError)
+    assert "Invalid date" in str(results[1])
+    assert len(results[2][0]) == 2
+    np.testing.assert_allclose(results[2][0], 3123.3, atol=0.2)
+    assert stats["requests"] == 2
+    assert stats["errors"] == 2
+    assert stats["batches"] >= 1
+
+
+def test_stats_during_batch():
+    "Check that the server keeps answering while a batch is calculated"
+    import threading
+
+    started = threading.Event()
+    release = threading.Event()
+
+    async def run():
+        async with IGRFServer(window=0.01) as server:
+            track = server._track
+
+            def blocked_track(batch):
+                started.set()
+                release.wait(10)
+                return track(batch)
+
+            server._track = blocked_track
+            client = await Client.connect(port=server.port)
+            query = asyncio.create_task(client.query(45, 45, 0, "2020-01-01"))
+            await asyncio.to_thread(started.wait, 10)
+            other = await Client.connect(port=server.port)
+            stats = await asyncio.wait_for(other.stats(), 5)
+            release.set()
+            result = await query
+            for connection in [client, other]:
+                await connection.close()
+        return stats, result
+
+    stats, result = asyncio.run(run())
+    assert stats["requests"] == 0
+    assert stats["batches"] == 0
+    np.testing.assert_allclose(result[0], 3093.0, atol=0.2)
+
+
+def test_failed_latency_and_backpressure():
+    "Check that failures have latencies and a small queue keeps the order"
+    import datetime
+
+    async def run():
+        async with IGRFServer(window=0.01, max_pending=2) as server:
+            client = await Client.connect(port=server.port)
+            failed = await asyncio.gather(
+                *[client.query(0, 0, 0, "1800-01-01") for _ in range(3)],
+                return_exceptions=True,
+            )
+            stats = await client.stats()
+            results = await asyncio.gather(
+                *[client.query(10 * i, 45, 0, 2020.0) for i in range(20)]
+            )
+            await client.close()
+        return failed, stats, results
+
+    failed, stats, results = asyncio.run(run())
+    assert all(isinstance(error, RuntimeError) for error in failed)
+    assert stats["requests"] == 0
+    assert stats["errors"] == 3
+    assert stats["latency_ms"]["max"] > 0
+    for i, result in enumerate(results):
+        expected = igrf_core.igrf_batch(10 * i, 45, 0, datetime.datetime(2020, 1, 1))
+        np.testing.assert_allclose(result[0], expected[0], rtol=1e-10)
+
+
+if __name__ == "__main__":
+    main()
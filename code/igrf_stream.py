@@ -0,0 +1,157 @@
+"""
+Write IGRF grids that don't fit in memory to netCDF files in chunks of rows
+"""
+import os
+import datetime
+import numpy as np
+import netCDF4
+
+import coef_cache
+import igrf_core
+import igrf_fast
+
+
+def igrf_grid_to_netcdf(path, region, spacing, height, date, chunk_rows=256, method="auto"):
+    """
+    Calculate a grid of Be, Bn, Bu in chunks of rows and write them to a file
+
+    Only one chunk of *chunk_rows* latitude rows (rounded up to the blocks
+    used by igrf_fast.igrf_grid) is in memory at a time. The number of rows
+    already written is stored in the file after each chunk. If the file
+    exists, the calculation resumes from the last completed chunk as long as
+    the grid parameters are the same.
+    """
+    import verde as vd
+
+    g, h = igrf_core.coef_arrays(*coef_cache.coefficients(date))
+    n_max = g.shape[0] - 1
+    longitude, latitude = vd.grid_coordinates(region, spacing=spacing, meshgrid=False)
+
+    block = igrf_fast._grid_block_rows(n_max)
+    chunk_rows = block * max(1, int(np.ceil(chunk_rows / block)))
+    attributes = {
+        "region": np.asarray(region, dtype="float64"),
+        "spacing": float(spacing),
+        "height": float(height),
+        "date": date.isoformat(),
+        "method": method,
+    }
+
+    if os.path.exists(path):
+        dataset = netCDF4.Dataset(path, "a")
+        for name, value in attributes.items():
+            if not np.all(dataset.getncattr(name) == value):
+                dataset.close()
+                raise ValueError(
+                    f"Existing file '{path}' has a different '{name}'. "
+                    "Delete it or choose another file name.",
+                )
+    else:
+        dataset = netCDF4.Dataset(path, "w")
+        dataset.createDimension("latitude", latitude.size)
+        dataset.createDimension("longitude", longitude.size)
+        dataset.createVariable("latitude", "f8", ("latitude",))[:] = latitude
+        dataset.createVariable("longitude", "f8", ("longitude",))[:] = longitude
+        for name in ["be", "bn", "bu"]:
+            dataset.createVariable(
+                name, "f8", ("latitude", "longitude"),
+                chunksizes=(min(chunk_rows, latitude.size), longitude.size),
+            )
+        dataset.setncatts(attributes)
+        dataset.completed_rows = 0
+        dataset.sync()
+
+    try:
+        for start in range(int(dataset.completed_rows), latitude.size, chunk_rows):
+            rows = slice(start, start + chunk_rows)
+            be, bn, bu = igrf_fast._igrf_grid_internal(
+                longitude, latitude[rows], height, g, h, method,
+            )
+            dataset["be"][rows] = be
+            dataset["bn"][rows] = bn
+            dataset["bu"][rows] = bu
+            # Only mark the rows as done after they are on disk
+            dataset.sync()
+            dataset.completed_rows = min(start + chunk_rows, latitude.size)
+            dataset.sync()
+    finally:
+        dataset.close()
+    return path
+
+
+def test_stream_matches_in_memory(tmp_path):
+    "Check that the file has the same grid as igrf_grid"
+    import xarray as xr
+
+    date = datetime.datetime(2020, 6, 1)
+    region = (0, 360, -80, 80)
+    path = igrf_grid_to_netcdf(tmp_path / "grid.nc", region, 1, 1000, date, chunk_rows=30)
+    expected = igrf_fast.igrf_grid(region, spacing=1, height=1000, date=date)
+    with xr.open_dataset(path) as grid:
+        assert grid.attrs["completed_rows"] == expected.latitude.size
+        np.testing.assert_array_equal(grid.latitude, expected.latitude)
+        np.testing.assert_array_equal(grid.longitude, expected.longitude)
+        for component in ["be", "bn", "bu"]:
+            np.testing.assert_array_equal(grid[component], expected[component])
+
+
+def test_stream_resume(tmp_path, monkeypatch):
+    "Check that an interrupted run continues from the last completed chunk"
+    import pytest
+    import xarray as xr
+
+    date = datetime.datetime(2020, 6, 1)
+    region = (-60, 60, -80, 80)
+    path = tmp_path / "grid.nc"
+    calculate = igrf_fast._igrf_grid_internal
+    calls = []
+
+    def fail_on_third_chunk(*args):
+        calls.append(args[1][0])
+        if len(calls) == 3:
+            raise KeyboardInterrupt()
+        return calculate(*args)
+
+    monkeypatch.setattr(igrf_fast, "_igrf_grid_internal", fail_on_third_chunk)
+    with pytest.raises(KeyboardInterrupt):
+        igrf_grid_to_netcdf(path, region, 0.5, 1000, date, chunk_rows=64)
+    with netCDF4.Dataset(path) as dataset:
+        assert dataset.completed_rows == 128
+    igrf_grid_to_netcdf(path, region, 0.5, 1000, date, chunk_rows=64)
+    # The 3rd chunk is started again but the first two are not
+    assert len(calls) == 7
+    assert calls[2] == calls[3]
+    monkeypatch.undo()
+    expected = igrf_fast.igrf_grid(region, spacing=0.5, height=1000, date=date)
+    with xr.open_dataset(path) as grid:
+        for component in ["be", "bn", "bu"]:
+            np.testing.assert_array_equal(grid[component], expected[component])
+
+
+def test_light_imports():
+    "Check that importing the streamer doesn't import pytest or xarray"
+    import sys
+    import subprocess
+
+    code = "import sys, igrf_stream; print([m for m in ['pytest', 'xarray'] if m in sys.modules])"
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+    )
+    assert output.stdout.strip() == "[]"
+
+
+def test_stream_different_parameters(tmp_path):
+    "Check that resuming with other parameters fails"
+    import pytest
+
+    date = datetime.datetime(2020, 6, 1)
+    path = igrf_grid_to_netcdf(tmp_path / "grid.nc", (0, 10, 0, 10), 1, 0, date)
+    with pytest.raises(ValueError):
+        igrf_grid_to_netcdf(path, (0, 10, 0, 10), 1, 1000, date)
+
+
+if __name__ == "__main__":
+    igrf_grid_to_netcdf(
+        "igrf_0.01deg.nc", (0, 360, -90, 90), spacing=0.01, height=1000,
+        date=datetime.datetime(2023, 1, 1),
+    )
@@ -0,0 +1,359 @@
+"""
+Lookup table of the IGRF field for one date to query at very high rates
+
+The field is calculated on a regular grid of latitude, longitude, and height
+and queried by cubic (or linear) Lagrange interpolation. The whole grid is
+refined uniformly until the largest interpolation error found at a sample
+of points (compared with the exact series) is below a tolerance. This is an
+estimate and not a proven bound. Tables can be saved and loaded by memory-mapping so that many
+processes share the same copy. Example:
+
+    table = build_table(datetime.datetime(2023, 1, 1), heights=(0, 20e3))
+    table.save("igrf_2023.npy")
+    table = load_table("igrf_2023.npy")
+    be, bn, bu = table.interpolate(longitude, latitude, height)
+"""
+import json
+import pathlib
+import datetime
+import numpy as np
+
+import coef_cache
+import igrf_core
+import igrf_fast
+
+
+METHODS = {"linear": 2, "cubic": 4}
+
+
+class LookupTable:
+    """
+    Be, Bn, Bu on a regular grid and its interpolation
+
+    *values* has shape (latitude, longitude, height, 3). Longitudes start at
+    *longitude_start* and are padded beyond 0 and 360 degrees so that the
+    interpolation can wrap around. Latitudes cover -90 to 90 degrees.
+    *sampled_error* is the largest error found by build_table (in nT).
+    """
+
+    def __init__(self, values, longitude_start, spacing, height_start, height_step,
+                 date, method="cubic", sampled_error=None):
+        if method not in METHODS:
+            raise ValueError(f"Invalid method '{method}'. Must be one of {list(METHODS)}.")
+        self.values = values
+        self.longitude_start = float(longitude_start)
+        self.spacing = float(spacing)
+        self.height_start = float(height_start)
+        self.height_step = float(height_step)
+        self.date = date
+        self.method = method
+        self.sampled_error = sampled_error
+
+    @property
+    def heights(self):
+        "The height of each level of the table"
+        return self.height_start + self.height_step * np.arange(self.values.shape[2])
+
+    def interpolate(self, longitude, latitude, height, backend="auto"):
+        """
+        Interpolate Be, Bn, Bu on arrays of points
+
+        The coordinates are broadcast against each other. Heights must be
+        within the range of the table. The backend can be "numpy", "numba", or
+        "auto" like in igrf_core.igrf_batch.
+        """
+        backend = igrf_core.select_backend(backend)
+        longitude, latitude, height = np.broadcast_arrays(longitude, latitude, height)
+        shape = longitude.shape
+        longitude = longitude.ravel()
+        latitude = latitude.ravel()
+        height = height.ravel()
+        heights = self.heights
+        if np.any(np.abs(latitude) > 90):
+            raise ValueError("Latitudes must be between -90 and 90 degrees.")
+        if np.any((height < heights[0]) | (height > heights[-1])):
+            raise ValueError(
+                f"Heights must be between {heights[0]} and {heights[-1]} m for this table.",
+            )
+        # Positions in units of nodes from the first one
+        lat_position = (latitude + 90) / self.spacing
+        lon_position = (np.mod(longitude, 360) - self.longitude_start) / self.spacing
+        height_position = (height - self.height_start) / self.height_step
+        if backend == "numba":
+            import igrf_numba
+
+            result = igrf_numba.interpolate(
+                self.values, lat_position, lon_position, height_position, METHODS[self.method],
+            )
+        else:
+            result = self._interpolate_numpy(lat_position, lon_position, height_position)
+        return tuple(result[:, component].reshape(shape) for component in range(3))
+
+    def _interpolate_numpy(self, lat_position, lon_position, height_position):
+        """
+        Interpolate with NumPy, gathering all heights of each node at once
+        """
+        n_lat, n_lon, n_height, _ = self.values.shape
+        lat_index, lat_weights = _stencil(lat_position, n_lat, self.method)
+        lon_index, lon_weights = _stencil(lon_position, n_lon, self.method)
+        height_index, height_weights = _stencil(height_position, n_height, self.method)
+        n_points = lat_position.size
+        # Weights of every height level for each point (zero outside the stencil)
+        level_weights = np.zeros((n_points, n_height))
+        points = np.arange(n_points)
+        for k, weight in zip(height_index, height_weights):
+            level_weights[points, k] = weight
+        columns = self.values.reshape(n_lat * n_lon, n_height * 3)
+        result = np.zeros((n_points, n_height * 3))
+        for i, lat_weight in zip(lat_index, lat_weights):
+            for j, lon_weight in zip(lon_index, lon_weights):
+                result += (lat_weight * lon_weight)[:, np.newaxis] * columns[i * n_lon + j]
+        return np.einsum("phc,ph->pc", result.reshape(n_points, n_height, 3), level_weights)
+
+    def save(self, path):
+        """
+        Save the values to a .npy file and the rest to a .json next to it
+
+        The suffix of *path* is replaced by .npy (like np.save adds it to a
+        path without one). Returns the path of the .npy file.
+        """
+        path = pathlib.Path(path).with_suffix(".npy")
+        np.save(path, self.values)
+        metadata = {
+            "longitude_start": self.longitude_start,
+            "spacing": self.spacing,
+            "height_start": self.height_start,
+            "height_step": self.height_step,
+            "date": self.date.isoformat(),
+            "method": self.method,
+            "sampled_error": self.sampled_error,
+        }
+        with open(path.with_suffix(".json"), "w") as metadata_file:
+            json.dump(metadata, metadata_file, indent=2)
+        return path
+
+
+def load_table(path, mmap=True):
+    """
+    Load a table saved with LookupTable.save
+
+    The values are memory-mapped read-only by default so that the operating
+    system shares them between processes that load the same file. The path
+    gets the .npy suffix like in LookupTable.save.
+    """
+    path = pathlib.Path(path).with_suffix(".npy")
+    with open(path.with_suffix(".json")) as metadata_file:
+        metadata = json.load(metadata_file)
+    values = np.load(path, mmap_mode="r" if mmap else None)
+    metadata["date"] = datetime.datetime.fromisoformat(metadata["date"])
+    return LookupTable(values, **metadata)
+
+
+def build_table(date, heights=(0, 10e3), tolerance=2.0, spacing=2.0, height_levels=None,
+                method="cubic", max_refinements=6, n_check=20_000, dtype="float32"):
+    """
+    Make a LookupTable for a date with sampled errors below *tolerance*
+
+    Starts from about *spacing* degrees and *height_levels* levels between
+    the *heights* and refines the whole grid uniformly, halving the spacing
+    of the latitude and longitude or of the heights, until the largest error
+    of any component (in nT) is below the tolerance. The error is sampled
+    against the exact series at the centers of the cells and at *n_check*
+    random points, so it's an estimate and points between the samples can
+    have larger errors. Raises ValueError if it isn't reached after
+    *max_refinements* refinements.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Invalid method '{method}'. Must be one of {list(METHODS)}.")
+    if height_levels is None:
+        height_levels = METHODS[method]
+    # Spacing must divide 180 degrees so that the poles and 360 are nodes
+    intervals = int(np.ceil(180 / spacing))
+    rng = np.random.default_rng(0)
+    for _ in range(max_refinements + 1):
+        table = _table_values(date, 180 / intervals, heights, height_levels, method, dtype)
+        horizontal, vertical = _check_errors(table, date, n_check, rng)
+        table.sampled_error = max(horizontal, vertical)
+        if table.sampled_error <= tolerance:
+            return table
+        # Refine the dimensions whose errors are larger than half of the
+        # tolerance (or the worst one)
+        if horizontal > tolerance / 2 or horizontal >= vertical:
+            intervals *= 2
+        if vertical > tolerance / 2 or vertical > horizontal:
+            height_levels = 2 * height_levels - 1
+    raise ValueError(
+        f"Could not reach an error of {tolerance} nT after {max_refinements} refinements "
+        f"(error {table.sampled_error:.3g} nT with {180 / intervals} degrees and "
+        f"{height_levels} heights).",
+    )
+
+
+def _table_values(date, spacing, heights, height_levels, method, dtype):
+    """
+    Calculate the field on the nodes of a table
+    """
+    g, h = igrf_core.coef_arrays(*coef_cache.coefficients(date))
+    pad = METHODS[method] // 2
+    n_longitude = int(round(360 / spacing))
+    longitude = spacing * np.arange(-pad, n_longitude + pad + 1)
+    latitude = np.linspace(-90, 90, int(round(180 / spacing)) + 1)
+    height_values = np.linspace(heights[0], heights[1], height_levels)
+    values = np.empty((latitude.size, longitude.size, height_levels, 3), dtype=dtype)
+    poles = [0, latitude.size - 1]
+    for k, height in enumerate(height_values):
+        # Be is infinite at the poles in the grid calculation so the pole
+        # rows are calculated with the column sums instead
+        with np.errstate(divide="ignore", invalid="ignore"):
+            components = igrf_fast._igrf_grid_internal(longitude, latitude, height, g, h)
+        pole_longitude, pole_latitude = np.meshgrid(longitude, latitude[poles])
+        pole_components = igrf_core.field(
+            pole_longitude.ravel(), pole_latitude.ravel(), np.full(pole_latitude.size, height), g, h,
+        )
+        for component in range(3):
+            values[:, :, k, component] = components[component]
+            values[poles, :, k, component] = pole_components[component].reshape(2, -1)
+    height_step = height_values[1] - height_values[0] if height_levels > 1 else 1.0
+    return LookupTable(
+        values, longitude[0], spacing, heights[0], height_step, date, method,
+    )
+
+
+def _check_errors(table, date, n_check, rng):
+    """
+    Largest interpolation errors in the horizontal and vertical directions
+
+    The horizontal error is at the centers of the cells and random points on
+    the heights of the table. The vertical error is at random heights on the
+    nodes. Random points anywhere count towards both.
+    """
+    heights = table.heights
+    spacing = table.spacing
+    n_lat, n_lon = table.values.shape[:2]
+    lon_centers = np.arange(0, 360, spacing) + spacing / 2
+    lat_centers = np.arange(-90, 90, spacing) + spacing / 2
+    lon_centers, lat_centers = [
+        coordinate.ravel() for coordinate in np.meshgrid(lon_centers, lat_centers)
+    ]
+    level = rng.integers(0, heights.size, lon_centers.size)
+    horizontal = _max_error(table, date, lon_centers, lat_centers, heights[level])
+    node_lon = spacing * rng.integers(0, int(round(360 / spacing)), n_check)
+    node_lat = spacing * rng.integers(0, n_lat, n_check) - 90
+    vertical = _max_error(
+        table, date, node_lon, node_lat, rng.uniform(heights[0], heights[-1], n_check),
+    )
+    anywhere = _max_error(
+        table, date,
+        rng.uniform(0, 360, n_check),
+        np.degrees(np.arcsin(rng.uniform(-1, 1, n_check))),
+        rng.uniform(heights[0], heights[-1], n_check),
+    )
+    return max(horizontal, anywhere), max(vertical, anywhere)
+
+
+def _max_error(table, date, longitude, latitude, height):
+    """
+    Largest difference of any component between the table and the series
+    """
+    interpolated = table.interpolate(longitude, latitude, height)
+    exact = igrf_core.igrf_batch(longitude, latitude, height, date)
+    return max(np.max(np.abs(a - b)) for a, b in zip(interpolated, exact))
+
+
+def _stencil(position, size, method):
+    """
+    Indices and weights of the nodes used to interpolate at fractional
+    positions along one axis
+
+    Cubic uses the Lagrange polynomial through the 4 nearest nodes and linear
+    the 2 nearest. Near the ends, the nodes are shifted inwards so that the
+    interpolation is as accurate as in the middle.
+    """
+    n_nodes = METHODS[method]
+    start = np.clip(np.floor(position).astype("int64") - (n_nodes // 2 - 1), 0, size - n_nodes)
+    x = position - start
+    if method == "linear":
+        weights = [1 - x, x]
+    else:
+        weights = [
+            -(x - 1) * (x - 2) * (x - 3) / 6,
+            x * (x - 2) * (x - 3) / 2,
+            -x * (x - 1) * (x - 3) / 2,
+            x * (x - 1) * (x - 2) / 6,
+        ]
+    indices = [start + offset for offset in range(n_nodes)]
+    return indices, weights
+
+
+def test_build_table_error():
+    "Check that the sampled error holds on new random points"
+    date = datetime.datetime(2022, 3, 1)
+    table = build_table(date, heights=(0, 20e3), tolerance=0.1)
+    assert table.sampled_error <= 0.1
+    assert table.spacing < 2
+    rng = np.random.default_rng(123)
+    longitude = rng.uniform(-180, 360, 5000)
+    latitude = rng.uniform(-90, 90, 5000)
+    height = rng.uniform(0, 20e3, 5000)
+    exact = igrf_core.igrf_batch(longitude, latitude, height, date)
+    for backend in igrf_core.available_backends():
+        interpolated = table.interpolate(longitude, latitude, height, backend=backend)
+        for a, b in zip(interpolated, exact):
+            np.testing.assert_allclose(a, b, rtol=0, atol=0.1)
+    # Nodes are exact up to the float32 rounding
+    be, _, _ = table.interpolate(table.spacing * 3, -90 + table.spacing * 5, 0)
+    expected, _, _ = igrf_core.igrf_batch(table.spacing * 3, -90 + table.spacing * 5, 0, date)
+    np.testing.assert_allclose(be, expected, atol=0.01)
+
+
+def test_linear_table():
+    "Check that linear tables need more nodes than cubic ones"
+    import pytest
+
+    date = datetime.datetime(2022, 3, 1)
+    cubic = build_table(date, heights=(0, 1e3), tolerance=20, method="cubic")
+    linear = build_table(date, heights=(0, 1e3), tolerance=20, method="linear")
+    assert linear.sampled_error <= 20
+    assert linear.values.shape[0] > cubic.values.shape[0]
+    with pytest.raises(ValueError):
+        build_table(date, tolerance=1e-6, max_refinements=1)
+    with pytest.raises(ValueError):
+        linear.interpolate(0, 0, 2e3)
+    with pytest.raises(ValueError):
+        build_table(date, method="quintic")
+
+
+def test_save_load_mmap(tmp_path):
+    "Check that a loaded table is memory-mapped and gives the same values"
+    date = datetime.datetime(2022, 3, 1)
+    table = build_table(date, heights=(0, 5e3), tolerance=10)
+    path = table.save(tmp_path / "table.npy")
+    loaded = load_table(path)
+    assert isinstance(loaded.values, np.memmap)
+    assert loaded.date == date
+    assert loaded.sampled_error == table.sampled_error
+    points = (np.array([10.5, 200.3]), np.array([-33.3, 71.2]), np.array([100, 4e3]))
+    for a, b in zip(loaded.interpolate(*points), table.interpolate(*points)):
+        np.testing.assert_array_equal(a, b)
+    # np.save adds .npy to a path without a suffix so the returned path and
+    # load_table must too
+    path = table.save(tmp_path / "no_suffix")
+    assert path == tmp_path / "no_suffix.npy"
+    for loaded in [load_table(path), load_table(tmp_path / "no_suffix")]:
+        np.testing.assert_array_equal(loaded.values, table.values)
+
+
+if __name__ == "__main__":
+    import time
+
+    start = time.perf_counter()
+    table = build_table(datetime.datetime(2023, 1, 1), heights=(0, 20e3), tolerance=2)
+    print(
+        f"Built in {time.perf_counter() - start:.1f} s: {table.values.shape} nodes, "
+        f"{table.values.nbytes / 1e6:.1f} MB, sampled error {table.sampled_error:.2f} nT",
+    )
+    rng = np.random.default_rng(0)
+    points = (rng.uniform(0, 360, 1_000_000), rng.uniform(-90, 90, 1_000_000), 1e3)
+    start = time.perf_counter()
+    table.interpolate(*points)
+    print(f"{1e6 / (time.perf_counter() - start):.0f} points/s")
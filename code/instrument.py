@@ -0,0 +1,129 @@
+"""
+Opt-in timing of the stages of the IGRF calculations
+
+Disabled by default, in which case stage() does next to nothing. Enable it
+by setting the environment variable IGRF_INSTRUMENT=1 or with:
+
+    with instrument.recording():
+        igrf_fast.igrf_grid(...)
+    print(instrument.to_json())
+"""
+import os
+import json
+import time
+import contextlib
+
+
+_enabled = os.environ.get("IGRF_INSTRUMENT", "0") not in ("", "0")
+# Stage name -> [number of calls, total wall time in seconds]
+_stats = {}
+_disabled_stage = contextlib.nullcontext()
+
+
+class _Stage:
+    """
+    Context manager that adds its wall time to the statistics of a stage
+    """
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exception):
+        elapsed = time.perf_counter() - self.start
+        entry = _stats.setdefault(self.name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+
+
+def stage(name):
+    """
+    Context manager that times a stage of the calculations if enabled
+    """
+    if not _enabled:
+        return _disabled_stage
+    return _Stage(name)
+
+
+def enabled():
+    """
+    Whether stages are being recorded
+    """
+    return _enabled
+
+
+@contextlib.contextmanager
+def recording(reset_stats=True):
+    """
+    Record the stages run inside the with block
+    """
+    global _enabled
+    previous = _enabled
+    if reset_stats:
+        reset()
+    _enabled = True
+    try:
+        yield
+    finally:
+        _enabled = previous
+
+
+def reset():
+    """
+    Delete the recorded statistics
+    """
+    _stats.clear()
+
+
+def results():
+    """
+    Number of calls and total seconds of each stage as a dict
+    """
+    return {
+        name: {"calls": calls, "seconds": seconds}
+        for name, (calls, seconds) in _stats.items()
+    }
+
+
+def to_json(**kwargs):
+    """
+    The results as a JSON string. Arguments are passed to json.dumps.
+    """
+    return json.dumps(results(), **kwargs)
+
+
+def test_disabled():
+    "Check that nothing is recorded by default"
+    assert not enabled()
+    reset()
+    with stage("something"):
+        pass
+    assert results() == {}
+
+
+def test_recording():
+    "Check that calls and times are recorded in the context manager"
+    with recording():
+        assert enabled()
+        for _ in range(3):
+            with stage("sleep"):
+                time.sleep(0.01)
+        with stage("other"):
+            pass
+    assert not enabled()
+    stats = results()
+    assert stats["sleep"]["calls"] == 3
+    assert stats["sleep"]["seconds"] >= 0.03
+    assert stats["other"]["calls"] == 1
+    assert json.loads(to_json()) == stats
+    with stage("sleep"):
+        pass
+    assert results()["sleep"]["calls"] == 3
+    with recording(reset_stats=False):
+        with stage("sleep"):
+            pass
+    assert results()["sleep"]["calls"] == 4
@@ -0,0 +1,234 @@
+"""
+Fit Gauss coefficients to magnetic field observations by least squares
+
+The normal equations are accumulated over chunks of observations so that the
+memory only depends on the number of coefficients. Example:
+
+    equations = NormalEquations(n_max=13)
+    for chunk in chunks_of_a_survey:
+        equations.add(*chunk)
+    model = equations.solve(damping=1e-3, year=2024.0)
+    read_coef.write_gauss_model("fitted.txt", model)
+"""
+import numpy as np
+
+import legendre
+import igrf_core
+import read_coef
+
+
+def parameter_degree_order(n_max):
+    """
+    Degree, order, and whether it's an h of each parameter of the fit
+
+    Parameters follow the packed order of read_coef (g then h of each (n, m),
+    without the h of m = 0).
+    """
+    degree, order = read_coef.packed_degree_order(n_max)
+    with_h = order > 0
+    index = np.cumsum(np.where(with_h, 2, 1)) - np.where(with_h, 2, 1)
+    n_params = index[-1] + (2 if with_h[-1] else 1)
+    param_degree = np.empty(n_params, dtype=int)
+    param_order = np.empty(n_params, dtype=int)
+    is_h = np.zeros(n_params, dtype=bool)
+    param_degree[index] = degree
+    param_order[index] = order
+    param_degree[index[with_h] + 1] = degree[with_h]
+    param_order[index[with_h] + 1] = order[with_h]
+    is_h[index[with_h] + 1] = True
+    return param_degree, param_order, is_h
+
+
+def design_matrix(longitude, latitude, height, n_max):
+    """
+    Derivatives of Be, Bn, Bu with respect to each parameter
+
+    Takes 1D arrays of geodetic coordinates. Returns an array with shape
+    (points, 3, n_params) with the parameters in the order of
+    parameter_degree_order. Uses the Schmidt normalized Legendre functions of
+    legendre.schmidt_legendre and the same geodetic rotation as the field
+    calculations. Be isn't defined exactly at the poles.
+    """
+    latitude_gc, radius = igrf_core.geodetic_to_spherical(latitude, height)
+    colatitude = np.radians(90 - latitude_gc)
+    longitude_rad = np.radians(longitude)
+    p, dp = legendre.schmidt_legendre(np.cos(colatitude), n_max)
+
+    degree, order, is_h = parameter_degree_order(n_max)
+    r_frac = (igrf_core.EARTH_RADIUS / radius)**(degree[:, np.newaxis] + 2)
+    p = p[degree, order] * r_frac
+    dp = dp[degree, order] * r_frac
+    orders = np.arange(n_max + 1)[:, np.newaxis]
+    cos_m = np.cos(orders * longitude_rad)[order]
+    sin_m = np.sin(orders * longitude_rad)[order]
+    # g multiplies cos(m lon) and h multiplies sin(m lon)
+    trig = np.where(is_h[:, np.newaxis], sin_m, cos_m)
+    # Derivative of the trig with respect to longitude divided by m
+    trig_lon = np.where(is_h[:, np.newaxis], cos_m, -sin_m)
+    be = -order[:, np.newaxis] * p * trig_lon / np.sin(colatitude)
+    bn_gc = dp * trig
+    br = (degree[:, np.newaxis] + 1) * p * trig
+
+    # Rotate the vector from geocentric to geodetic
+    cos = np.cos(-np.radians(latitude - latitude_gc))
+    sin = np.sin(-np.radians(latitude - latitude_gc))
+    bn = cos * bn_gc + sin * br
+    bu = -sin * bn_gc + cos * br
+    return np.stack([be.T, bn.T, bu.T], axis=1)
+
+
+class NormalEquations:
+    """
+    Normal equations of the least-squares fit of Gauss coefficients
+
+    Observations are added in chunks with add and only A^T W A, A^T W d, and
+    d^T W d are kept, which have O(n_params**2) values however many
+    observations there are.
+    """
+
+    def __init__(self, n_max):
+        self.n_max = n_max
+        self.degree, self.order, self.is_h = parameter_degree_order(n_max)
+        n_params = self.degree.size
+        self.ata = np.zeros((n_params, n_params))
+        self.atd = np.zeros(n_params)
+        self.dtd = 0.0
+        self.n_data = 0
+
+    def add(self, longitude, latitude, height, be, bn, bu, weights=None, chunk_size=5000):
+        """
+        Add observations of Be, Bn, Bu (nT) at geodetic coordinates
+
+        The arrays are broadcast against each other. Components that are NaN
+        are left out, so points can have only some of the components. The
+        optional *weights* (for example 1/variance) are broadcast against
+        the components too. The design matrix is built in chunks of
+        *chunk_size* points.
+        """
+        if weights is None:
+            weights = 1.0
+        arrays = np.broadcast_arrays(longitude, latitude, height)
+        longitude, latitude, height = [array.ravel() for array in arrays]
+        data = np.stack(
+            [np.broadcast_to(component, arrays[0].shape).ravel() for component in (be, bn, bu)],
+            axis=1,
+        )
+        weights = np.broadcast_to(weights, data.shape).astype("float64")
+        for start in range(0, longitude.size, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            design = design_matrix(longitude[chunk], latitude[chunk], height[chunk], self.n_max)
+            valid = np.isfinite(data[chunk])
+            design = design[valid]
+            values = data[chunk][valid]
+            weight = weights[chunk][valid]
+            weighted = design * weight[:, np.newaxis]
+            self.ata += weighted.T @ design
+            self.atd += weighted.T @ values
+            self.dtd += float(np.sum(weight * values**2))
+            self.n_data += values.size
+
+    def solve(self, damping=0.0, year=2020.0):
+        """
+        Solve for the coefficients and return a GaussCoefficients model
+
+        *damping* adds damping * |x|^2 to the misfit to stabilize regional or
+        sparse fits. It can be a scalar or an array with a value for each
+        parameter (in the order of parameter_degree_order). The model has a
+        single epoch at *year* and zero secular variation.
+        """
+        coefs = self.solve_parameters(damping)
+        n_coefs = self.n_max * (self.n_max + 3) // 2
+        g = np.zeros((n_coefs, 1))
+        h = np.zeros((n_coefs, 1))
+        # Rows of the packed arrays are the parameters without the h
+        row = np.cumsum(~self.is_h) - 1
+        g[row[~self.is_h], 0] = coefs[~self.is_h]
+        h[row[self.is_h], 0] = coefs[self.is_h]
+        return read_coef.GaussCoefficients(g, h, np.zeros(n_coefs), np.zeros(n_coefs), [year])
+
+    def solve_parameters(self, damping=0.0):
+        """
+        Solve for the parameters in the order of parameter_degree_order
+        """
+        if self.n_data < self.degree.size:
+            raise ValueError(
+                f"Need at least {self.degree.size} observations to fit degree "
+                f"{self.n_max} but only {self.n_data} were added.",
+            )
+        damping = np.broadcast_to(damping, self.degree.shape)
+        return np.linalg.solve(self.ata + np.diag(damping), self.atd)
+
+    def residual_rms(self, parameters):
+        """
+        Weighted RMS of the residuals of the observations for parameters
+
+        Calculated from the accumulated sums without the observations.
+        """
+        misfit = self.dtd - 2 * parameters @ self.atd + parameters @ self.ata @ parameters
+        return float(np.sqrt(max(misfit, 0) / self.n_data))
+
+
+def test_recover_igrf():
+    "Check that fitting the field of IGRF recovers its coefficients"
+    import datetime
+
+    model = read_coef.read_gauss_model("igrf13coeffs.txt")
+    date = datetime.datetime(2020, 1, 1)
+    rng = np.random.default_rng(4)
+    longitude = rng.uniform(-180, 180, 3000)
+    latitude = np.degrees(np.arcsin(rng.uniform(-1, 1, 3000)))
+    height = rng.uniform(0, 600e3, 3000)
+    be, bn, bu = igrf_core.igrf_batch(longitude, latitude, height, date)
+    # Some points only have the vertical component
+    be[::7] = np.nan
+    bn[::7] = np.nan
+    equations = NormalEquations(n_max=13)
+    for chunk in np.array_split(np.arange(3000), 4):
+        equations.add(
+            longitude[chunk], latitude[chunk], height[chunk], be[chunk], bn[chunk], bu[chunk],
+            chunk_size=500,
+        )
+    assert equations.ata.shape == (195, 195)
+    assert equations.n_data == 3 * 3000 - 2 * len(be[::7])
+    fitted = equations.solve(year=2020.0)
+    epoch = list(model.years).index(2020)
+    np.testing.assert_allclose(fitted.g[:, 0], model.g[:, epoch], atol=1e-6)
+    np.testing.assert_allclose(fitted.h[:, 0], model.h[:, epoch], atol=1e-6)
+    assert equations.residual_rms(equations.solve_parameters()) < 1e-3
+
+
+def test_damping_and_writing(tmp_path):
+    "Check that damping stabilizes a regional fit and the model can be written"
+    import datetime
+
+    date = datetime.datetime(2022, 6, 1)
+    rng = np.random.default_rng(2)
+    longitude = rng.uniform(0, 20, 400)
+    latitude = rng.uniform(40, 55, 400)
+    be, bn, bu = igrf_core.igrf_batch(longitude, latitude, 0, date)
+    noise = rng.normal(scale=5, size=(3, 400))
+    equations = NormalEquations(n_max=6)
+    equations.add(longitude, latitude, 0, be + noise[0], bn + noise[1], bu + noise[2])
+    undamped = equations.solve_parameters()
+    damped = equations.solve_parameters(damping=1e-4)
+    # The undamped regional fit is unstable and its coefficients blow up
+    assert np.linalg.norm(damped) < np.linalg.norm(undamped) / 10
+    assert equations.residual_rms(damped) < 6
+    model = equations.solve(damping=1e-4, year=2022.5)
+    path = tmp_path / "regional.txt"
+    read_coef.write_gauss_model(path, model, decimals=4)
+    written = read_coef.read_gauss_model(path)
+    assert written.n_max == 6
+    np.testing.assert_allclose(written.g, model.g, atol=1e-4)
+    np.testing.assert_allclose(written.years, [2022.5])
+    g = np.zeros((7, 7))
+    h = np.zeros((7, 7))
+    g[written.degree, written.order] = written.g[:, 0]
+    h[written.degree, written.order] = written.h[:, 0]
+    predicted = igrf_core.field(longitude, latitude, np.zeros(400), g, h)
+    for component, observed in zip(predicted, (be, bn, bu)):
+        assert np.sqrt(np.mean((component - observed)**2)) < 10
+    import pytest
+
+    with pytest.raises(ValueError):
+        NormalEquations(n_max=6).solve()
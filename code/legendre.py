@@ -2,6 +2,7 @@
 Week 5: Calculate associated Legendre functions, their derivatives, and the
 Schmidt normalization factor.
 """
+import functools
 import numpy as np
 import math
 
@@ -64,6 +65,91 @@ def schmidt_normalization(n_max):
     return s
 
 
+@functools.lru_cache(maxsize=8)
+def schmidt_recursion_tables(n_max):
+    """
+    Coefficients of the recursion for Schmidt semi-normalized functions
+
+    Returns arrays indexed by [n, m] (or [m] for the sectoral values):
+
+    * a, b: P_n^m = a x P_{n-1}^m - b P_{n-2}^m for n > m
+    * sectoral: P_m^m / sin(theta)^m
+    * lower, upper: dP_n^m/dtheta = lower P_n^{m-1} - upper P_n^{m+1}
+
+    The tables of the last 8 n_max are cached and shouldn't be modified.
+    """
+    n = np.arange(n_max + 1, dtype="float64")[:, np.newaxis]
+    m = np.arange(n_max + 1, dtype="float64")[np.newaxis, :]
+    above_diagonal = n > m
+    n2_m2 = np.where(above_diagonal, n**2 - m**2, 1)
+    a = np.where(above_diagonal, (2 * n - 1) / np.sqrt(n2_m2), 0)
+    b = np.where(above_diagonal, np.sqrt(np.clip((n - 1)**2 - m**2, 0, None) / n2_m2), 0)
+    factors = np.sqrt((2 * m[0, 1:] - 1) / (2 * m[0, 1:]))
+    factors[0] = 1
+    sectoral = np.concatenate([[1], np.cumprod(factors)])
+    valid = n >= m
+    lower = np.where(valid, 0.5 * np.sqrt(np.clip((n + m) * (n - m + 1), 0, None)), 0)
+    lower[:, 0] = 0
+    lower[:, 1] *= np.sqrt(2)
+    upper = np.where(valid, 0.5 * np.sqrt(np.clip((n - m) * (n + m + 1), 0, None)), 0)
+    upper[:, 0] = np.sqrt(n[:, 0] * (n[:, 0] + 1) / 2)
+    tables = (a, b, sectoral, lower, upper)
+    for table in tables:
+        table.setflags(write=False)
+    return tables
+
+
+def schmidt_legendre(x, n_max, second=False):
+    """
+    Calculate Schmidt semi-normalized Plm and d/dtheta Plm for arrays x
+
+    Returns arrays with shape (n_max + 1, n_max + 1) + x.shape indexed by
+    [n, m]. Uses the recursion of Holmes and Featherstone (2002), which
+    computes Plm / sin(theta)^m scaled by 1e-280 to avoid underflow, so it
+    is stable up to at least degree 2000. If *second* is True, also returns
+    d2/dtheta2 Plm.
+    """
+    x = np.asarray(x, dtype="float64")
+    a, b, sectoral, lower, upper = schmidt_recursion_tables(n_max)
+    expand = (slice(None),) + (np.newaxis,) * x.ndim
+    scale = 1e-280
+
+    p = np.zeros((n_max + 1, n_max + 1) + x.shape)
+    orders = np.arange(n_max + 1)
+    p[orders, orders] = scale * sectoral[expand]
+    # Calculate all orders m < n of each degree at once
+    for n in range(1, n_max + 1):
+        p[n, :n] = a[n, :n][expand] * x * p[n - 1, :n]
+        if n > 1:
+            p[n, :n] -= b[n, :n][expand] * p[n - 2, :n]
+
+    # Multiply by sin(theta)^m and undo the scaling in log space
+    sin = np.sqrt(1 - x**2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_factor = orders[expand] * np.log(sin) - np.log(scale)
+    log_factor[0] = -np.log(scale)
+    p *= np.exp(log_factor)
+
+    dp = _theta_derivative(p, lower, upper)
+    if second:
+        # The coefficients don't depend on theta so the same relation gives
+        # the second derivative from the first, without dividing by sin
+        return p, dp, _theta_derivative(dp, lower, upper)
+    return p, dp
+
+
+def _theta_derivative(p, lower, upper):
+    """
+    Apply dP_n^m/dtheta = lower P_n^{m-1} - upper P_n^{m+1} to all n and m
+    """
+    dp = np.empty_like(p)
+    expand = (slice(None), slice(None)) + (np.newaxis,) * (p.ndim - 2)
+    dp[:, 0] = 0
+    np.multiply(lower[:, 1:][expand], p[:, :-1], out=dp[:, 1:])
+    dp[:, :-1] -= upper[:, :-1][expand] * p[:, 1:]
+    return dp
+
+
 def test_legendre_functions():
     "Check if the first few degrees match analytical expressions"
     for angle in np.linspace(0, np.pi, 50):
@@ -136,6 +222,61 @@ def test_schmidt():
     np.testing.assert_allclose(np.sqrt(1/12), s[2][2])
 
 
+def test_schmidt_legendre_low_degree():
+    "Check against the unnormalized functions times the Schmidt factor"
+    x = np.cos(np.linspace(0, np.pi, 50))
+    p_dict = associated_legendre_functions(x, 13)
+    dp_dict = associated_legendre_functions_derivative(p_dict)
+    s = schmidt_normalization(13)
+    p, dp = schmidt_legendre(x, 13)
+    assert p.shape == dp.shape == (14, 14, 50)
+    for n in range(1, 14):
+        for m in range(n + 1):
+            np.testing.assert_allclose(p[n, m], s[n][m] * p_dict[n][m], atol=1e-10)
+            np.testing.assert_allclose(dp[n, m], s[n][m] * dp_dict[n][m], atol=1e-10)
+        np.testing.assert_array_equal(p[n, n + 1:], 0)
+
+
+def test_schmidt_legendre_high_degree():
+    "Check that the sum of squares of each degree is 1 up to degree 2000"
+    x = np.array([-1, -0.9999999, -0.5, 0, 0.3, 0.99, 1])
+    p, dp = schmidt_legendre(x, 2000)
+    assert np.all(np.isfinite(p))
+    assert np.all(np.isfinite(dp))
+    np.testing.assert_allclose((p**2).sum(axis=1), 1, rtol=1e-10)
+    # The derivative should match a finite difference of the functions
+    theta = np.arccos(x[2:-1])
+    p_plus, _ = schmidt_legendre(np.cos(theta + 1e-7), 2000)
+    p_minus, _ = schmidt_legendre(np.cos(theta - 1e-7), 2000)
+    np.testing.assert_allclose(dp[:, :, 2:-1], (p_plus - p_minus) / 2e-7, atol=1e-4)
+
+
+def test_schmidt_legendre_second_derivative():
+    "Check the second derivative with the Legendre equation and at the poles"
+    theta = np.linspace(0.1, np.pi - 0.1, 20)
+    x = np.cos(theta)
+    n_max = 60
+    p, dp, d2p = schmidt_legendre(x, n_max, second=True)
+    n = np.arange(n_max + 1)[:, np.newaxis, np.newaxis]
+    m = np.arange(n_max + 1)[np.newaxis, :, np.newaxis]
+    sin = np.sin(theta)
+    expected = -x / sin * dp - (n * (n + 1) - m**2 / sin**2) * p
+    np.testing.assert_allclose(d2p, expected, atol=1e-8)
+    _, _, d2p = schmidt_legendre(np.array([-1.0, 1.0]), n_max, second=True)
+    assert np.all(np.isfinite(d2p))
+    # P_1^0 = cos(theta) and P_1^1 = sin(theta)
+    np.testing.assert_allclose(d2p[1, 0], [1, -1], atol=1e-12)
+    np.testing.assert_allclose(d2p[1, 1], 0, atol=1e-12)
+
+
+def test_schmidt_legendre_scalar():
+    "Check that scalars return arrays of shape (n_max + 1, n_max + 1)"
+    p, dp = schmidt_legendre(0.5, 5)
+    assert p.shape == dp.shape == (6, 6)
+    np.testing.assert_allclose(p[2, 0], 1 / 2 * (3 * 0.5**2 - 1))
+    assert schmidt_recursion_tables(5) is schmidt_recursion_tables(5)
+
+
 if __name__ == "__main__":
     import scipy.special
     n = 13
@@ -4,12 +4,82 @@ Week 2: Creating functions and testing them
 Make a function out of the coefficient reading code from last week.
 """
 import pathlib
-import pytest
+import numpy as np
 
 
-def read_gauss_coeffs(path):
+class GaussCoefficients:
     """
-    Read Gauss coefficients from the NOAA IGRF data file
+    Gauss coefficients of a model stored in packed float64 arrays
+
+    Each row of *g* and *h* (shape ``(n_coefs, n_epochs)``) and of *g_sv* and
+    *h_sv* (shape ``(n_coefs,)``) is one (n, m) pair. Rows are ordered by
+    degree and then order, starting at n=1, m=0. ``index[n, m]`` is the row of
+    a given pair (-1 if it doesn't exist) and ``degree[row]`` and
+    ``order[row]`` go the other way. The h coefficients for m=0 are 0.
+    """
+
+    def __init__(self, g, h, g_sv, h_sv, years):
+        self.g = np.ascontiguousarray(g, dtype="float64")
+        self.h = np.ascontiguousarray(h, dtype="float64")
+        self.g_sv = np.ascontiguousarray(g_sv, dtype="float64")
+        self.h_sv = np.ascontiguousarray(h_sv, dtype="float64")
+        self.years = np.asarray(years, dtype="float64")
+        self.n_max = packed_n_max(self.g.shape[0])
+        self.degree, self.order = packed_degree_order(self.n_max)
+        self.index = np.full((self.n_max + 1, self.n_max + 1), -1)
+        self.index[self.degree, self.order] = np.arange(self.degree.size)
+
+    def as_dicts(self):
+        """
+        Return g, h, g_sv, h_sv, years in the same format as read_gauss_coeffs
+        """
+        g = {}
+        h = {}
+        g_sv = {}
+        h_sv = {}
+        g_rows = self.g.tolist()
+        h_rows = self.h.tolist()
+        g_sv_rows = self.g_sv.tolist()
+        h_sv_rows = self.h_sv.tolist()
+        for row, (n, m) in enumerate(zip(self.degree.tolist(), self.order.tolist())):
+            if m == 0:
+                g[n] = {}
+                g_sv[n] = {}
+                h[n] = {}
+                h_sv[n] = {}
+            g[n][m] = g_rows[row]
+            g_sv[n][m] = g_sv_rows[row]
+            if m > 0:
+                h[n][m] = h_rows[row]
+                h_sv[n][m] = h_sv_rows[row]
+        return g, h, g_sv, h_sv, self.years.tolist()
+
+
+def packed_degree_order(n_max):
+    """
+    Degree and order of each row of the packed coefficient arrays
+    """
+    degree = np.concatenate([np.full(n + 1, n) for n in range(1, n_max + 1)])
+    order = np.concatenate([np.arange(n + 1) for n in range(1, n_max + 1)])
+    return degree, order
+
+
+def packed_n_max(n_coefs):
+    """
+    Maximum degree of a packed array with n_coefs = n_max (n_max + 3) / 2 rows
+    """
+    n_max = int(round((np.sqrt(9 + 8 * n_coefs) - 3) / 2))
+    if n_max * (n_max + 3) // 2 != n_coefs:
+        raise ValueError(f"Invalid number of coefficients '{n_coefs}'.")
+    return n_max
+
+
+def read_gauss_model(path):
+    """
+    Read Gauss coefficients from the NOAA IGRF data file into packed arrays
+
+    The file is parsed in bulk by NumPy instead of line by line so that it
+    can be used for models of high degree.
     """
     if not pathlib.Path(path).exists():
         raise IOError(f"Gauss coefficient file '{path}' not found.")
@@ -17,34 +87,69 @@ def read_gauss_coeffs(path):
         for i in range(3):
             coef_file.readline()
         line = coef_file.readline()
-        years = []
-        for year in line.split()[3:-1]:
-            years.append(float(year))
-        h = {}
-        g = {}
-        h_sv = {}
-        g_sv = {}
-        for line in coef_file:
-            parts = line.split()
-            degree = int(parts[1])
-            order = int(parts[2])
-            if parts[0] == "g":
-                if degree not in g:
-                    g[degree] = {}
-                    g_sv[degree] = {}
-                g[degree][order] = []
-                for coef in parts[3:-1]:
-                    g[degree][order].append(float(coef))
-                g_sv[degree][order] = float(parts[-1])
-            if parts[0] == "h":
-                if degree not in h:
-                    h[degree] = {}
-                    h_sv[degree] = {}
-                h[degree][order] = []
-                for coef in parts[3:-1]:
-                    h[degree][order].append(float(coef))
-                h_sv[degree][order] = float(parts[-1])
-    return g, h, g_sv, h_sv, years
+        years = [float(year) for year in line.split()[3:-1]]
+        # Parse the whole table at once with the g/h column converted to 0/1
+        table = np.loadtxt(
+            coef_file, converters={0: lambda kind: kind == "h"}, ndmin=2,
+        )
+    if table.shape[1] != len(years) + 4:
+        raise ValueError(
+            f"Invalid Gauss coefficient file '{path}'. "
+            f"Expected {len(years) + 4} columns but found {table.shape[1]}.",
+        )
+    is_h = table[:, 0] == 1
+    degree = table[:, 1].astype(int)
+    order = table[:, 2].astype(int)
+    values = table[:, 3:]
+
+    n_max = int(degree.max())
+    n_coefs = n_max * (n_max + 3) // 2
+    # Position of (n, m) in the packed arrays
+    row = degree * (degree + 1) // 2 - 1 + order
+    g = np.zeros((n_coefs, len(years)))
+    h = np.zeros((n_coefs, len(years)))
+    g_sv = np.zeros(n_coefs)
+    h_sv = np.zeros(n_coefs)
+    g[row[~is_h]] = values[~is_h, :-1]
+    g_sv[row[~is_h]] = values[~is_h, -1]
+    h[row[is_h]] = values[is_h, :-1]
+    h_sv[row[is_h]] = values[is_h, -1]
+    return GaussCoefficients(g, h, g_sv, h_sv, years)
+
+
+def write_gauss_model(path, model, decimals=2, comment="Gauss coefficients"):
+    """
+    Write a GaussCoefficients model in the format of the NOAA IGRF data file
+
+    Values are written with *decimals* decimal places. The file can be read
+    back with read_gauss_model.
+    """
+    years = [float(year) for year in model.years]
+    sv_label = f"{int(years[-1])}-{(int(years[-1]) + 5) % 100:02d}"
+    lines = [
+        f"# {comment}, degree n=1,{model.n_max}\n",
+        "# in units nanoTesla (nanoTesla/year for the secular variation (SV))\n",
+        "c/s deg ord " + " ".join(["IGRF"] * len(years)) + " SV\n",
+        "g/h n m " + " ".join(f"{year:.1f}" for year in years) + f" {sv_label}\n",
+    ]
+
+    def line(kind, n, m, values, sv):
+        numbers = " ".join(f"{value:.{decimals}f}" for value in list(values) + [sv])
+        return f"{kind} {n:2d} {m:2d} {numbers}\n"
+
+    for row, (n, m) in enumerate(zip(model.degree.tolist(), model.order.tolist())):
+        lines.append(line("g", n, m, model.g[row], model.g_sv[row]))
+        if m > 0:
+            lines.append(line("h", n, m, model.h[row], model.h_sv[row]))
+    with open(path, "w") as coef_file:
+        coef_file.writelines(lines)
+
+
+def read_gauss_coeffs(path):
+    """
+    Read Gauss coefficients from the NOAA IGRF data file
+    """
+    return read_gauss_model(path).as_dicts()
 
 
 def test_read_all_degrees():
@@ -73,7 +178,77 @@ def test_years():
     assert years == list(range(1900, 2025, 5))
 
 
+def test_model_packed_arrays():
+    "Check the layout of the packed coefficient arrays"
+    model = read_gauss_model("igrf13coeffs.txt")
+    assert model.n_max == 13
+    assert model.g.shape == (104, 25)
+    assert model.h.shape == (104, 25)
+    assert model.g_sv.shape == (104,)
+    assert model.g.dtype == np.float64
+    assert model.g.flags.c_contiguous
+    np.testing.assert_array_equal(model.years, np.arange(1900, 2025, 5))
+    assert model.g[model.index[1, 0], 1] == -31464
+    assert model.h[model.index[1, 1], -1] == 4652.5
+    assert model.g_sv[model.index[1, 0]] == 5.7
+    assert model.index[1, 2] == -1
+    np.testing.assert_array_equal(model.h[model.order == 0], 0)
+    for row, (n, m) in enumerate(zip(model.degree, model.order)):
+        assert model.index[n, m] == row
+
+
+def test_model_dicts_match_file():
+    "Check that the dict view matches a line by line reading of the file"
+    g, h, g_sv, h_sv, years = read_gauss_coeffs("igrf13coeffs.txt")
+    with open("igrf13coeffs.txt") as coef_file:
+        lines = coef_file.readlines()[4:]
+    assert len(lines) == 195
+    for line in lines:
+        parts = line.split()
+        coefs = g if parts[0] == "g" else h
+        sv = g_sv if parts[0] == "g" else h_sv
+        degree, order = int(parts[1]), int(parts[2])
+        assert coefs[degree][order] == [float(coef) for coef in parts[3:-1]]
+        assert sv[degree][order] == float(parts[-1])
+
+
+def test_model_high_degree(tmp_path):
+    "Check reading a synthetic file of higher degree than IGRF"
+    n_max = 60
+    lines = ["#\n", "#\n", "c/s deg ord IGRF SV\n", "g/h n m 2020.0 2020-25\n"]
+    for n in range(1, n_max + 1):
+        for m in range(n + 1):
+            lines.append(f"g {n} {m} {n + m / 100} {-n}\n")
+            if m > 0:
+                lines.append(f"h {n} {m} {-n - m / 100} {n}\n")
+    path = tmp_path / "high_degree.txt"
+    path.write_text("".join(lines))
+    model = read_gauss_model(path)
+    assert model.n_max == n_max
+    assert model.g.shape == (n_max * (n_max + 3) // 2, 1)
+    np.testing.assert_allclose(model.g[:, 0], model.degree + model.order / 100)
+    np.testing.assert_allclose(
+        model.h[:, 0], np.where(model.order > 0, -model.degree - model.order / 100, 0),
+    )
+    np.testing.assert_allclose(model.g_sv, -model.degree)
+
+
+def test_write_read_model(tmp_path):
+    "Check that a written model is read back the same"
+    model = read_gauss_model("igrf13coeffs.txt")
+    path = tmp_path / "written.txt"
+    write_gauss_model(path, model)
+    written = read_gauss_model(path)
+    assert written.n_max == model.n_max
+    np.testing.assert_array_equal(written.years, model.years)
+    for name in ["g", "h", "g_sv", "h_sv"]:
+        np.testing.assert_allclose(getattr(written, name), getattr(model, name), atol=1e-9)
+    assert len(path.read_text().splitlines()) == 4 + 195
+
+
 def test_file_not_found():
     "Check if it fails when given a bad file name"
+    import pytest
+
     with pytest.raises(IOError):
         read_gauss_coeffs("bla.slkdjsldjh")